@@ -0,0 +1,129 @@
+"""A fake OpenAI-compatible chat completions server with configurable latency, for benchmarking without an LLM
+
+Run it on its own with `python -m benchmarks.fake_llm --port 8199 --latency 0.5`, or start it in-process with
+`start_fake_llm`.
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_REPLY = "This is a canned reply from the benchmark's fake language model, standing in for a real completion."
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """Answers /chat/completions requests after the configured delays, streaming the reply word by word if asked"""
+
+    protocol_version = "HTTP/1.1"
+    # Seconds before the first token and between tokens, set by `start_fake_llm`
+    latency = 0.0
+    token_latency = 0.0
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.latency)
+        prompt = body["messages"][-1]["content"]
+        if body.get("response_format"):
+            # Entity extraction asks for JSON, one entry per "Conversation <id>" heading
+            ids = [int(id) for id in re.findall(r"^Conversation (\d+)$", prompt, re.MULTILINE)]
+            reply = json.dumps(
+                {
+                    "conversations": [
+                        {"id": id, "subjects": ["benchmarks"], "entities": ["Hawat"], "keywords": ["latency"]}
+                        for id in ids
+                    ]
+                }
+            )
+        else:
+            reply = _REPLY
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(reply) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if body.get("stream"):
+            self._stream(reply, usage if body.get("stream_options", {}).get("include_usage") else None)
+        else:
+            self._send_json(
+                {
+                    "id": "fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}
+                    ],
+                    "usage": usage,
+                }
+            )
+
+    def _send_json(self, payload: dict) -> None:
+        content = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _stream(self, reply: str, usage: dict | None) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for word in reply.split(" "):
+            time.sleep(self.token_latency)
+            self._write_event({"choices": [{"index": 0, "delta": {"content": f"{word} "}, "finish_reason": None}]})
+        if usage:
+            self._write_event({"choices": [], "usage": usage})
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_event(self, payload: dict) -> None:
+        payload = {
+            "id": "fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "fake",
+        } | payload
+        self._write_chunk(f"data: {json.dumps(payload)}\n\n".encode())
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def start_fake_llm(port: int, latency: float = 0.0, token_latency: float = 0.0) -> ThreadingHTTPServer:
+    """
+    Starts the fake server in a daemon thread.
+
+    Args:
+        port (int): The local port to listen on.
+        latency (float): Seconds to wait before replying, or before the first token when streaming.
+        token_latency (float): Seconds to wait between streamed tokens.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    handler = type("ConfiguredFakeLLMHandler", (FakeLLMHandler,), {"latency": latency, "token_latency": token_latency})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve fake OpenAI-compatible chat completions")
+    parser.add_argument("--port", type=int, default=8199)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before the reply or first token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="seconds between streamed tokens")
+    args = parser.parse_args()
+    start_fake_llm(args.port, args.latency, args.token_latency)
+    print(f"Fake LLM listening on http://127.0.0.1:{args.port}/v1")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
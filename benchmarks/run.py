@@ -0,0 +1,142 @@
+"""Measures Hawat's request path against a benchmark database and a fake language model
+
+Reports p50 and p99 latency for each stage of context building, for recording messages, for whole turns through
+`dispatcher.process_message` and for summarizing conversations, then throughput and latency with several concurrent
+gRPC clients. Point DB_NAME at a database meant for benchmarking, since the benchmark writes messages to it.
+
+    DB_NAME=hawat_bench python -m benchmarks.run --seed 100000 --llm-latency 0.5 --clients 1,8,32
+"""
+
+import argparse
+import os
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fake_llm import start_fake_llm
+
+
+def _percentiles(samples: list[float]) -> tuple[float, float]:
+    if len(samples) < 2:
+        return (samples[0], samples[0]) if samples else (float("nan"), float("nan"))
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return cuts[49], cuts[98]
+
+
+def report(name: str, samples: list[float]) -> None:
+    """Prints the median and 99th percentile of a list of durations in seconds"""
+    p50, p99 = _percentiles(samples)
+    print(f"{name:<40} n={len(samples):<6} p50={p50 * 1000:9.2f}ms  p99={p99 * 1000:9.2f}ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark Hawat's request path")
+    parser.add_argument("--seed", type=int, default=0, help="reset the database and seed this many messages first")
+    parser.add_argument("--iterations", type=int, default=200, help="calls measured per stage")
+    parser.add_argument("--summaries", type=int, default=20, help="conversations summarized in the reflection stage")
+    parser.add_argument("--clients", default="1,4,16", help="comma-separated numbers of concurrent gRPC clients")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to run each gRPC client count")
+    parser.add_argument("--llm-port", type=int, default=8199)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="fake LLM seconds before replying")
+    parser.add_argument("--llm-token-latency", type=float, default=0.0, help="fake LLM seconds between tokens")
+    parser.add_argument("--grpc-port", type=int, default=50061, help="port for the benchmark's Hawat gRPC server")
+    args = parser.parse_args()
+
+    # Hawat reads its settings when its modules are imported, so the fake LLM is configured first
+    start_fake_llm(args.llm_port, args.llm_latency, args.llm_token_latency)
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{args.llm_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ.pop("LLM_BACKENDS", None)
+    os.environ.setdefault("REFLECTION_REQUESTS_PER_MINUTE", "1000000")
+    os.environ["GRPC_PORT"] = str(args.grpc_port)
+
+    # pylint: disable=import-outside-toplevel
+    import grpc
+
+    import hawat.dispatcher as dispatcher
+    import hawat.grpc_server as h_serve
+    import hawat.memory as memory
+    import hawat.proto.chat_pb2 as pb2
+    import hawat.proto.chat_pb2_grpc as pb2_grpc
+    from benchmarks.seed import random_sentence, seed
+    from hawat.embeddings import warm_up_embeddings
+    from hawat.reflection import summarize_conversations
+
+    if args.seed:
+        seed(args.seed, reset=True)
+    warm_up_embeddings()
+    rng = random.Random(1)
+    queries = [random_sentence(rng) for _ in range(args.iterations)]
+
+    print("\nContext building")
+    stages = defaultdict(list)
+    for query in queries:
+        timings = {}
+        start = time.perf_counter()
+        memory.get_formatted_context(query, timings)
+        stages["total"].append(time.perf_counter() - start)
+        for stage, seconds in timings.items():
+            stages[stage].append(seconds)
+    for stage, samples in stages.items():
+        report(f"get_formatted_context.{stage}", samples)
+
+    print("\nPersistence")
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        memory.record_messages([("User", query, None), ("Hawat", random_sentence(rng), None)])
+        samples.append(time.perf_counter() - start)
+    report("record_messages (one turn)", samples)
+
+    print("\nWhole turns")
+    samples = []
+    for query in queries[: max(args.iterations // 4, 1)]:
+        start = time.perf_counter()
+        dispatcher.process_message(query)
+        samples.append(time.perf_counter() - start)
+    memory.flush()
+    report("dispatcher.process_message", samples)
+
+    print("\nReflection")
+    pool = memory.get_connection_pool()
+    with pool.connection() as conn:
+        conn.execute(
+            """UPDATE conversations SET summarized_through = NULL, summary = NULL WHERE id IN (SELECT id FROM conversations ORDER BY id DESC LIMIT %s)""",
+            (args.summaries,),
+        )
+    start = time.perf_counter()
+    summarize_conversations()
+    elapsed = time.perf_counter() - start
+    print(f"{'summarize_conversations':<40} {args.summaries} conversations in {elapsed:.2f}s")
+
+    print("\nConcurrent gRPC clients")
+    threading.Thread(target=h_serve.serve, daemon=True).start()
+    channel_target = f"localhost:{args.grpc_port}"
+    grpc.channel_ready_future(grpc.insecure_channel(channel_target)).result(timeout=30)
+    for clients in [int(n) for n in args.clients.split(",")]:
+        latencies = []
+        lock = threading.Lock()
+        deadline = time.perf_counter() + args.duration
+
+        def run_client(client: int) -> None:
+            client_rng = random.Random(client)
+            with grpc.insecure_channel(channel_target) as channel:
+                stub = pb2_grpc.HawatChatStub(channel)
+                while time.perf_counter() < deadline:
+                    start = time.perf_counter()
+                    stub.send_chat(pb2.ClientChat(message=random_sentence(client_rng)))  # pylint: disable=no-member
+                    with lock:
+                        latencies.append(time.perf_counter() - start)
+
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            list(executor.map(run_client, range(clients)))
+        report(f"send_chat x{clients} clients", latencies)
+        print(f"{'':<40} throughput={len(latencies) / args.duration:.2f} turns/s")
+    memory.flush()
+
+
+if __name__ == "__main__":
+    main()
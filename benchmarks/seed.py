@@ -0,0 +1,167 @@
+"""Fills a benchmark database with a synthetic history of conversations
+
+The messages get random unit-length embeddings rather than real ones, so millions of rows load in minutes. Point
+DB_NAME at a database meant for benchmarking: seeding with `--reset` empties Hawat's tables first.
+
+    DB_NAME=hawat_bench python -m benchmarks.seed 100000 --reset
+"""
+
+import argparse
+import math
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from psycopg import sql
+
+from hawat.embeddings import EMBEDDING_COLUMN
+from hawat.memory import schema
+
+_WORDS = (
+    "postgres vector index latency memory summary garden recipe travel budget python server model coffee music "
+    "weather project deadline meeting book movie running sleep health family weekend kitchen bicycle camera guitar "
+    "river mountain invoice taxes kernel compiler network backup password holiday birthday dinner lunch"
+).split()
+# Indexes dropped while loading and rebuilt afterwards, which is much faster than maintaining them row by row: every
+# HNSW and full-text index on these tables, including compact indexes built by hawat_compact_index
+_BULK_LOAD_TABLES = ("messages", "conversations")
+
+
+def random_sentence(rng: random.Random, words: int = 12) -> str:
+    """A sentence of random words from a small vocabulary, so full-text and keyword searches find matches"""
+    return " ".join(rng.choice(_WORDS) for _ in range(words)).capitalize() + "."
+
+
+def _random_embeddings(rng: np.random.Generator, count: int, dimensions: int) -> np.ndarray:
+    embeddings = rng.standard_normal((count, dimensions), dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def seed(messages: int, conversation_length: int = 20, batch_size: int = 10_000, reset: bool = False) -> None:
+    """
+    Loads `messages` synthetic messages, split into summarized conversations, spread over the past year.
+
+    Args:
+        messages (int): How many messages to load.
+        conversation_length (int): Messages per conversation.
+        batch_size (int): Messages generated and copied per batch.
+        reset (bool): Empty Hawat's tables before loading.
+    """
+    schema.migrate()
+    pool = schema.get_connection_pool()
+    if not pool:
+        raise SystemExit("Could not connect to the database")
+    rng = random.Random(0)
+    np_rng = np.random.default_rng(0)
+    conversations = math.ceil(messages / conversation_length)
+    end = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=1)
+    spacing = timedelta(days=365) / conversations
+    start_time = time.perf_counter()
+
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT dimensions FROM embedding_models WHERE column_name = %s", (EMBEDDING_COLUMN,))
+            dimensions = cur.fetchone()[0]
+            if reset:
+                cur.execute(
+                    "TRUNCATE messages, conversations, conversations_messages, entities, keywords, clusters, "
+                    "cluster_members RESTART IDENTITY"
+                )
+            cur.execute("SELECT COALESCE(Max(id), 0) FROM conversations")
+            first_conversation = cur.fetchone()[0] + 1
+            cur.execute("SELECT COALESCE(Max(id), 0) FROM messages")
+            first_message = cur.fetchone()[0] + 1
+            # Kept to recreate the dropped indexes exactly as they were defined
+            cur.execute(
+                "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = ANY(%s) AND indexdef ~ 'USING (hnsw|gin)'",
+                (list(_BULK_LOAD_TABLES),),
+            )
+            indexes = cur.fetchall()
+            for index, _ in indexes:
+                cur.execute(sql.SQL("DROP INDEX IF EXISTS {index}").format(index=sql.Identifier(index)))
+        conn.commit()
+
+        embedding = sql.Identifier(EMBEDDING_COLUMN)
+        embeddings = _random_embeddings(np_rng, conversations, dimensions)
+        with conn.cursor() as cur:
+            with cur.copy(
+                sql.SQL(
+                    "COPY conversations (id, summary, {embedding}, timestamp) FROM STDIN WITH (FORMAT BINARY)"
+                ).format(embedding=embedding)
+            ) as copy:
+                copy.set_types(["int4", "text", "vector", "timestamp"])
+                for conversation, vector in enumerate(embeddings):
+                    copy.write_row((first_conversation + conversation, random_sentence(rng, 30), vector, end))
+        conn.commit()
+
+        for batch_start in range(0, messages, batch_size):
+            batch = range(batch_start, min(batch_start + batch_size, messages))
+            embeddings = _random_embeddings(np_rng, len(batch), dimensions)
+            with conn.cursor() as cur:
+                with cur.copy(
+                    sql.SQL(
+                        "COPY messages (id, sender, content, {embedding}, timestamp) FROM STDIN WITH (FORMAT BINARY)"
+                    ).format(embedding=embedding)
+                ) as copy:
+                    copy.set_types(["int4", "text", "text", "vector", "timestamp"])
+                    for i, vector in zip(batch, embeddings):
+                        conversation, position = divmod(i, conversation_length)
+                        timestamp = end - spacing * (conversations - conversation) + timedelta(minutes=position)
+                        sender = "User" if position % 2 == 0 else "Hawat"
+                        copy.write_row((first_message + i, sender, random_sentence(rng), vector, timestamp))
+                with cur.copy("COPY conversations_messages (conversation_id, message_id) FROM STDIN") as copy:
+                    for i in batch:
+                        copy.write_row((first_conversation + i // conversation_length, first_message + i))
+            conn.commit()
+            print(f"Loaded {batch.stop} of {messages} messages")
+
+        with conn.cursor() as cur:
+            # Mark every conversation as summarized and its terms as extracted through its last message
+            cur.execute(
+                """
+                UPDATE conversations AS c
+                SET last_message_id = latest.id, last_message_at = latest.timestamp, timestamp = latest.timestamp,
+                    summarized_through = latest.id, terms_extracted_through = latest.id
+                FROM (
+                    SELECT cm.conversation_id, Max(m.id) AS id, Max(m.timestamp) AS timestamp FROM messages AS m
+                    INNER JOIN conversations_messages AS cm ON cm.message_id = m.id
+                    WHERE cm.conversation_id >= %s
+                    GROUP BY cm.conversation_id
+                ) AS latest
+                WHERE latest.conversation_id = c.id
+            """,
+                (first_conversation,),
+            )
+            cur.execute("SELECT setval('messages_id_seq', (SELECT Max(id) FROM messages))")
+            cur.execute("SELECT setval('conversations_id_seq', (SELECT Max(id) FROM conversations))")
+        conn.commit()
+
+        print("Rebuilding indexes")
+        with conn.cursor() as cur:
+            cur.execute("SET maintenance_work_mem = '1GB'")
+            for _, definition in indexes:
+                cur.execute(definition)
+        conn.commit()
+        conn.autocommit = True
+        try:
+            conn.execute("VACUUM ANALYZE messages")
+            conn.execute("VACUUM ANALYZE conversations")
+            conn.execute("VACUUM ANALYZE conversations_messages")
+        finally:
+            conn.autocommit = False
+    print(f"Seeded {messages} messages in {conversations} conversations in {time.perf_counter() - start_time:.1f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fill a benchmark database with synthetic conversations")
+    parser.add_argument("messages", type=int, help="number of messages, e.g. 10000, 100000 or 1000000")
+    parser.add_argument("--conversation-length", type=int, default=20, help="messages per conversation")
+    parser.add_argument("--batch-size", type=int, default=10_000, help="messages copied per transaction")
+    parser.add_argument("--reset", action="store_true", help="empty Hawat's tables before loading")
+    args = parser.parse_args()
+    seed(args.messages, args.conversation_length, args.batch_size, args.reset)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,41 @@
+import logging
+import os
 import threading
 
 import hawat.grpc_server as h_serve
+from hawat.embeddings import EMBEDDING_MODEL_NAME, EMBEDDING_WARMUP, warm_up_embeddings
+from hawat.llm import get_backends
+from hawat.memory.schema import SCHEMA_VERSION, get_active_embedding_model, get_schema_version
+from hawat.metrics import start_metrics_server
 from hawat.reflection import start_reflection_thread
 
+# DEBUG also logs every prompt sent to the chat model
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+logger = logging.getLogger("hawat")
+
 
 def main():
     """Run the full Hawat server and concurrent operations"""
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    schema_version = get_schema_version()
+    if schema_version is not None and schema_version < SCHEMA_VERSION:
+        logger.error(
+            "The database schema is at version %s of %s, run hawat_migrate first", schema_version, SCHEMA_VERSION
+        )
+        raise SystemExit(1)
+    logger.info("Using models: %s", ", ".join(f"{backend.model} ({backend.name})" for backend in get_backends()))
+    active_model = get_active_embedding_model()
+    if active_model and active_model != EMBEDDING_MODEL_NAME:
+        logger.warning("Using embedding model %s, but %s is the active model", EMBEDDING_MODEL_NAME, active_model)
+
+    # Load the embedding model up front so the first chat doesn't wait on it
+    if EMBEDDING_WARMUP:
+        warm_up_embeddings()
+
+    # Serve Prometheus metrics next to gRPC
+    start_metrics_server()
+
     # Start the gRPC server in a separate thread
     grpc_thread = threading.Thread(target=h_serve.serve)
     grpc_thread.start()
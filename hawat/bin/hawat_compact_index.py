@@ -0,0 +1,73 @@
+import argparse
+from sys import stderr
+
+from psycopg import sql
+
+from hawat.embeddings import EMBEDDING_COLUMN, EMBEDDING_DIMENSIONS
+from hawat.memory.schema import (
+    COMPACT_INDEXES,
+    compact_index_definition,
+    create_index_concurrently,
+    get_connection_pool,
+    get_vector_extension_version,
+)
+
+# Tables whose embeddings are searched, and so indexed
+_TABLES = ("messages", "conversations")
+# halfvec, binary_quantize and the bit HNSW operator classes arrived in pgvector 0.7.0
+_MINIMUM_PGVECTOR_VERSION = (0, 7, 0)
+
+
+def main() -> None:
+    """Build the compact HNSW indexes for the embedding column in use"""
+    parser = argparse.ArgumentParser(
+        description="Build compact HNSW indexes on half-precision or binary-quantized embeddings without blocking "
+        "writes. Set VECTOR_INDEX to the same mode and restart Hawat to search them."
+    )
+    parser.add_argument("mode", choices=sorted(COMPACT_INDEXES), help="how the indexed embeddings are compacted")
+    parser.add_argument(
+        "--drop-full-indexes",
+        action="store_true",
+        help="drop the full-precision HNSW indexes afterwards, which is what frees their memory",
+    )
+    args = parser.parse_args()
+
+    pool = get_connection_pool()
+    if not pool:
+        print("Could not connect to the database", file=stderr)
+        raise SystemExit(1)
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT dimensions FROM embedding_models WHERE column_name = %s", (EMBEDDING_COLUMN,))
+        result = cur.fetchone()
+    version = get_vector_extension_version()
+    if version is None or version < _MINIMUM_PGVECTOR_VERSION:
+        installed = ".".join(map(str, version)) if version else "no pgvector"
+        raise SystemExit(f"Compact indexes need pgvector 0.7.0 or later, the database has {installed}")
+    if result is None:
+        raise SystemExit(f"No embedding model uses the column {EMBEDDING_COLUMN}")
+    if result[0] != EMBEDDING_DIMENSIONS:
+        raise SystemExit(
+            f"{EMBEDDING_COLUMN} has {result[0]} dimensions, but EMBEDDING_DIMENSIONS is {EMBEDDING_DIMENSIONS}"
+        )
+
+    for table in _TABLES:
+        index = f"{table}_{EMBEDDING_COLUMN}_{args.mode}_idx"
+        print(f"Building index {index}")
+        create_index_concurrently(
+            pool, index, compact_index_definition(table, EMBEDDING_COLUMN, args.mode, EMBEDDING_DIMENSIONS)
+        )
+    print(f"Built the {args.mode} indexes. Set VECTOR_INDEX={args.mode} and restart Hawat to use them.")
+
+    if args.drop_full_indexes:
+        with pool.connection() as conn:
+            # DROP INDEX CONCURRENTLY can't run inside a transaction
+            conn.autocommit = True
+            try:
+                for table in _TABLES:
+                    index = f"{table}_{EMBEDDING_COLUMN}_idx"
+                    print(f"Dropping index {index}")
+                    conn.execute(
+                        sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {index}").format(index=sql.Identifier(index))
+                    )
+            finally:
+                conn.autocommit = False
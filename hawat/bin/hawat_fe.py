@@ -1,7 +1,10 @@
+import os
+import uuid
 from sys import stderr
 
 import grpc
 from rich.console import Console
+from rich.live import Live
 from rich.markdown import Markdown
 
 import hawat.proto.chat_pb2 as pb2
@@ -10,6 +13,11 @@ import hawat.proto.chat_pb2_grpc as pb2_grpc
 _START_MSG = "Welcome to Hawat!\nType to begin chatting...\n\n"
 _CLOSE_MSG = "---\nClosing. Have a nice day!"
 
+# Whose memories to chat with, empty for the server's default user
+HAWAT_USER_ID = os.getenv("HAWAT_USER_ID", "")
+# Each run of the client is a session of its own unless one is given to resume
+HAWAT_SESSION_ID = os.getenv("HAWAT_SESSION_ID") or uuid.uuid4().hex
+
 
 def main() -> None:
     """Run the simple example Hawat client."""
@@ -20,11 +28,16 @@ def main() -> None:
     try:
         while True:
             client_msg = input("> ")
-            client_chat = pb2.ClientChat(message=client_msg)  # pylint: disable=no-member
-            server_chat = stub.send_chat(client_chat)
-            #print(">>", server_chat.message)
-            print(">> ", end='')
-            console.print(Markdown(server_chat.message))
+            client_chat = pb2.ClientChat(  # pylint: disable=no-member
+                message=client_msg, user_id=HAWAT_USER_ID, session_id=HAWAT_SESSION_ID
+            )
+            print(">>")
+            # Re-render the reply as Markdown each time another piece of it arrives
+            reply = ""
+            with Live(Markdown(reply), console=console, vertical_overflow="visible") as live:
+                for server_chat in stub.stream_chat(client_chat):
+                    reply += server_chat.message
+                    live.update(Markdown(reply))
     except KeyboardInterrupt:
         print(_CLOSE_MSG)
     except Exception as e:
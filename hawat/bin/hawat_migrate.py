@@ -0,0 +1,33 @@
+import argparse
+import logging
+from sys import stderr
+
+from hawat.memory.schema import SCHEMA_VERSION, get_schema_version, migrate
+
+
+def main() -> None:
+    """Bring the database schema up to date"""
+    parser = argparse.ArgumentParser(
+        description="Create Hawat's tables, or apply the schema migrations an existing database hasn't had yet. Run "
+        "it once after installing or upgrading Hawat."
+    )
+    parser.add_argument("--check", action="store_true", help="only report whether migrations are pending")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    version = get_schema_version()
+    if version is None:
+        print("Could not connect to the database", file=stderr)
+        raise SystemExit(1)
+    if args.check:
+        print(f"Schema version {version} of {SCHEMA_VERSION}")
+        raise SystemExit(0 if version >= SCHEMA_VERSION else 1)
+    if version >= SCHEMA_VERSION:
+        print(f"The schema is up to date at version {version}")
+        return
+    try:
+        version = migrate()
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        print(f"Migration failed: {e}", file=stderr)
+        raise SystemExit(1) from e
+    print(f"Migrated the schema to version {version}")
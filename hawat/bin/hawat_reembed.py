@@ -0,0 +1,239 @@
+import argparse
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from sys import stderr
+
+import numpy as np
+from psycopg import sql
+
+from hawat.embeddings import (
+    EMBEDDING_DEVICE,
+    embed_in_worker,
+    embedded_through_column,
+    embedding_column,
+    init_embedding_worker,
+)
+from hawat.memory.schema import EMBEDDING_REGISTRY_REFRESH_SECONDS, create_index_concurrently, get_connection_pool
+
+# (table, column with the text to embed)
+_TABLES = (
+    ("messages", "content"),
+    ("conversations", "summary"),
+)
+# Rows still to embed. Messages never change, so they are read after the checkpoint, or from the start to catch rows
+# whose transactions committed out of id order. Summaries are embedded again whenever they changed since they were.
+_PENDING_ROWS_QUERIES = {
+    "messages": """
+        SELECT id, content, 0 FROM messages WHERE id > %s AND content IS NOT NULL AND {column} IS NULL ORDER BY id
+    """,
+    "conversations": """
+        SELECT id, summary, COALESCE(summarized_through, 0) FROM conversations
+        WHERE id > %s AND summary IS NOT NULL AND {through} IS DISTINCT FROM COALESCE(summarized_through, 0)
+        ORDER BY id
+    """,
+}
+# Copies a batch of embeddings into its table, skipping summaries that changed while they were being embedded
+_WRITE_BATCH_QUERIES = {
+    "messages": "UPDATE messages AS t SET {column} = b.embedding FROM {batch} AS b WHERE t.id = b.id",
+    "conversations": """
+        UPDATE conversations AS t SET {column} = b.embedding, {through} = b.version FROM {batch} AS b
+        WHERE t.id = b.id AND COALESCE(t.summarized_through, 0) = b.version
+    """,
+}
+_BATCH_TABLE = "hawat_reembed_batch"
+
+
+def main() -> None:
+    """Backfill embeddings from another model, build its indexes, and then make it the active model."""
+    parser = argparse.ArgumentParser(
+        description="Embed every message and conversation summary with another model, resuming where a previous run "
+        "stopped, and make it the active model once its HNSW indexes are built."
+    )
+    parser.add_argument("model", help="name of the Sentence Transformer model to embed with")
+    parser.add_argument("--batch-size", type=int, default=256, help="texts embedded per batch")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="embedding processes")
+    parser.add_argument("--device", default=EMBEDDING_DEVICE, help="device the model runs on")
+    parser.add_argument("--no-activate", action="store_true", help="backfill and index without switching models")
+    args = parser.parse_args()
+
+    pool = get_connection_pool()
+    if not pool:
+        print("Could not connect to the database", file=stderr)
+        raise SystemExit(1)
+    column = embedding_column(args.model)
+    # Split the cores between the worker processes instead of letting every worker use all of them
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    # Spawned workers don't inherit the parent's connection pool, threads or locks
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_embedding_worker,
+        initargs=(args.model, args.device, threads),
+    ) as executor:
+        dimensions = len(executor.submit(embed_in_worker, ["dimension probe"]).result()[0])
+        _register_model(pool, args.model, column, dimensions)
+        registered_at = time.monotonic()
+        for table, _ in _TABLES:
+            _backfill(pool, executor, args, table, column, dimensions, resume=True)
+        for table, _ in _TABLES:
+            _build_index(pool, table, column)
+        # Once every Hawat process has seen the registry, new rows are embedded with this model as they are written.
+        # Pick up the rows written before then, including while the indexes were being built.
+        time.sleep(max(0.0, registered_at + EMBEDDING_REGISTRY_REFRESH_SECONDS - time.monotonic()))
+        for table, _ in _TABLES:
+            _backfill(pool, executor, args, table, column, dimensions, resume=False)
+    if not args.no_activate:
+        _activate(pool, args.model)
+        print(f"{args.model} is now the active embedding model. Set EMBEDDING_MODEL_NAME and restart Hawat to use it.")
+
+
+def _register_model(pool, model: str, column: str, dimensions: int) -> None:
+    """Adds the model to the registry, creates its embedding columns and marks it as being backfilled
+
+    Hawat embeds new messages and summaries with every model being backfilled, so rows written during the backfill
+    aren't missed.
+    """
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """INSERT INTO embedding_models (name, column_name, dimensions) VALUES (%s, %s, %s) ON CONFLICT (name) DO NOTHING""",
+            (model, column, dimensions),
+        )
+        cur.execute("""SELECT dimensions FROM embedding_models WHERE name = %s""", (model,))
+        registered_dimensions = cur.fetchone()[0]
+        if registered_dimensions != dimensions:
+            raise SystemExit(f"{model} is registered with {registered_dimensions} dimensions but produces {dimensions}")
+        for table, _ in _TABLES:
+            cur.execute(
+                sql.SQL("ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} VECTOR({dimensions})").format(
+                    table=sql.Identifier(table), column=sql.Identifier(column), dimensions=sql.Literal(dimensions)
+                )
+            )
+        cur.execute(
+            sql.SQL("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS {through} INTEGER").format(
+                through=sql.Identifier(embedded_through_column(column))
+            )
+        )
+        cur.execute("""UPDATE embedding_models SET backfilling = NOT active WHERE name = %s""", (model,))
+        conn.commit()
+
+
+def _backfill(pool, executor, args, table: str, column: str, dimensions: int, resume: bool):
+    """Embeds every row of a table that the model's column is missing or out of date for
+
+    Rows are streamed through a server-side cursor, embedded by the worker processes with a bounded number of batches
+    in flight, and written back with COPY. The messages checkpoint advances with each batch, so an interrupted run
+    resumes where it stopped. Conversations are found by comparing the summary each embedding was computed for with
+    the current one, so summaries that changed since they were embedded are embedded again.
+
+    Args:
+        resume (bool): Whether to start from the messages checkpoint rather than look through every message.
+    """
+    with pool.connection() as read_conn, pool.connection() as write_conn:
+        with write_conn.cursor() as cur:
+            checkpoint = 0
+            if resume and table == "messages":
+                cur.execute("""SELECT messages_checkpoint FROM embedding_models WHERE name = %s""", (args.model,))
+                checkpoint = cur.fetchone()[0]
+            cur.execute(
+                sql.SQL(
+                    "DROP TABLE IF EXISTS {batch}; CREATE TEMP TABLE {batch} (id INTEGER PRIMARY KEY, version INTEGER, embedding VECTOR({dimensions})) ON COMMIT DELETE ROWS"
+                ).format(batch=sql.Identifier(_BATCH_TABLE), dimensions=sql.Literal(dimensions))
+            )
+        write_conn.commit()
+        print(f"Embedding {table} after id {checkpoint}")
+
+        written = 0
+        in_flight = deque()
+        with read_conn.cursor(name=f"hawat_reembed_{table}") as reader:
+            reader.itersize = args.batch_size
+            reader.execute(
+                sql.SQL(_PENDING_ROWS_QUERIES[table]).format(
+                    column=sql.Identifier(column), through=sql.Identifier(embedded_through_column(column))
+                ),
+                (checkpoint,),
+            )
+            for rows in iter(lambda: reader.fetchmany(args.batch_size), []):
+                in_flight.append(
+                    (
+                        [(row[0], row[2]) for row in rows],
+                        executor.submit(embed_in_worker, [row[1] for row in rows]),
+                    )
+                )
+                # Keep every worker busy without reading the whole table into memory
+                if len(in_flight) > args.workers:
+                    written += _write_batch(write_conn, args.model, table, column, *in_flight.popleft())
+                    print(f"Embedded {written} rows of {table}")
+            while in_flight:
+                written += _write_batch(write_conn, args.model, table, column, *in_flight.popleft())
+                print(f"Embedded {written} rows of {table}")
+        read_conn.commit()
+
+        with write_conn.cursor() as cur:
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {batch}").format(batch=sql.Identifier(_BATCH_TABLE)))
+        write_conn.commit()
+
+
+def _write_batch(conn, model: str, table: str, column: str, rows: list[tuple[int, int]], future: Future) -> int:
+    """Copies one batch of embeddings into the table and advances the messages checkpoint in the same transaction
+
+    Args:
+        rows (list[tuple[int, int]]): Each row's id and, for conversations, the `summarized_through` of the summary
+            that was embedded.
+    """
+    embeddings = future.result()
+    with conn.cursor() as cur:
+        with cur.copy(
+            sql.SQL("COPY {batch} (id, version, embedding) FROM STDIN WITH (FORMAT BINARY)").format(
+                batch=sql.Identifier(_BATCH_TABLE)
+            )
+        ) as copy:
+            copy.set_types(["int4", "int4", "vector"])
+            for (id, version), embedding in zip(rows, embeddings):
+                copy.write_row((id, version, np.array(embedding, dtype=np.float32)))
+        cur.execute(
+            sql.SQL(_WRITE_BATCH_QUERIES[table]).format(
+                column=sql.Identifier(column),
+                through=sql.Identifier(embedded_through_column(column)),
+                batch=sql.Identifier(_BATCH_TABLE),
+            )
+        )
+        if table == "messages":
+            cur.execute(
+                """UPDATE embedding_models SET messages_checkpoint = GREATEST(messages_checkpoint, %s) WHERE name = %s""",
+                (max(id for id, _ in rows), model),
+            )
+    conn.commit()
+    return len(rows)
+
+
+def _build_index(pool, table: str, column: str) -> None:
+    """Builds the HNSW index on a model's column without blocking writes, replacing any invalid leftover"""
+    index = f"{table}_{column}_idx"
+    print(f"Building index {index}")
+    create_index_concurrently(
+        pool,
+        index,
+        sql.SQL("ON {table} USING HNSW ({column} vector_cosine_ops)").format(
+            table=sql.Identifier(table), column=sql.Identifier(column)
+        ),
+    )
+
+
+def _activate(pool, model: str) -> None:
+    """Marks the model as the active one in the registry
+
+    Topic clusters from other models are dropped, so reflection clusters every conversation again with this one.
+    """
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("""UPDATE embedding_models SET active = FALSE WHERE active AND name <> %s""", (model,))
+        cur.execute("""UPDATE embedding_models SET active = TRUE, backfilling = FALSE WHERE name = %s""", (model,))
+        cur.execute("""DELETE FROM clusters WHERE embedding_column <> %s""", (embedding_column(model),))
+        cur.execute("""UPDATE conversations SET clustered_through = NULL WHERE clustered_through IS NOT NULL""")
+        conn.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,98 @@
+import time
+from collections.abc import Iterator
+from datetime import datetime, timezone
+
 import hawat.language as language
 import hawat.memory as memory
+from hawat.embeddings import get_embedding
+from hawat.metrics import observe, observe_context_tokens, timed
+from hawat.response_cache import context_fingerprint, get_response_cache
+
+
+def process_message(message, user_id: str = memory.DEFAULT_USER_ID, session_id: str = memory.DEFAULT_SESSION_ID):
+    received = datetime.now(timezone.utc)
+    with timed("turn"):
+        with timed("context"):
+            context, history, retrieved_ids = _build_context(message, user_id, session_id)
+        response = None
+        try:
+            cache_key = _cache_key(message, retrieved_ids, user_id)
+            response = _cached_response(cache_key)
+            if response is None:
+                response = language.get_conversation_response(message, context, history)
+                _cache_response(cache_key, response)
+            return response
+        finally:
+            _record_turn(message, received, response, user_id, session_id)
+
+
+def stream_message(
+    message, user_id: str = memory.DEFAULT_USER_ID, session_id: str = memory.DEFAULT_SESSION_ID
+) -> Iterator[str]:
+    received = datetime.now(timezone.utc)
+    start = time.perf_counter()
+    with timed("context"):
+        context, history, retrieved_ids = _build_context(message, user_id, session_id)
+    response = None
+    try:
+        cache_key = _cache_key(message, retrieved_ids, user_id)
+        response = _cached_response(cache_key)
+        if response is not None:
+            yield response
+            return
+        chunks = []
+        for chunk in language.stream_conversation_response(message, context, history):
+            chunks.append(chunk)
+            yield chunk
+        response = "".join(chunks)
+        _cache_response(cache_key, response)
+    finally:
+        _record_turn(message, received, response, user_id, session_id)
+        observe("turn", time.perf_counter() - start)
+
+
+def _build_context(message: str, user_id: str, session_id: str) -> tuple[str, list | None, dict[str, list]]:
+    """Retrieves the context for a message laid out for the configured prompt layout, and the ids it was built from"""
+    retrieved_ids, token_counts = {}, {}
+    session = {
+        "retrieved_ids": retrieved_ids,
+        "token_counts": token_counts,
+        "user_id": user_id,
+        "session_id": session_id,
+    }
+    if language.PROMPT_LAYOUT == "prefix_cache":
+        history, memory_context = memory.get_layered_context(message, **session)
+        observe_context_tokens(token_counts)
+        return memory_context, history, retrieved_ids
+    context = memory.get_formatted_context(message, **session)
+    observe_context_tokens(token_counts)
+    return context, None, retrieved_ids
+
+
+def _cache_key(message: str, retrieved_ids: dict[str, list], user_id: str) -> tuple[list[float], str] | None:
+    """The message's embedding and context fingerprint, if the response cache is on and retrieval succeeded"""
+    if get_response_cache() is None or not retrieved_ids:
+        return None
+    # Already computed for retrieval, so this is served from the embedding cache
+    return get_embedding(message), context_fingerprint(retrieved_ids, user_id)
+
+
+def _cached_response(cache_key: tuple[list[float], str] | None) -> str | None:
+    if cache_key is None:
+        return None
+    with timed("response_cache.lookup"):
+        return get_response_cache().lookup(*cache_key)
+
+
+def _cache_response(cache_key: tuple[list[float], str] | None, response: str) -> None:
+    if cache_key is not None and response:
+        with timed("response_cache.store"):
+            get_response_cache().store(*cache_key, response)
 
 
-def process_message(message):
-    context = memory.get_formatted_context(message)
-    memory.record_message(message, sender="User")
-    response = language.get_conversation_response(message, context)
-    memory.record_message(response, sender="Hawat")
-    return response
+def _record_turn(message: str, received: datetime, response: str | None, user_id: str, session_id: str) -> None:
+    """Queues the user's message and, if there is one, Hawat's response to be stored together"""
+    turn = [("User", message, received)]
+    if response is not None:
+        turn.append(("Hawat", response, None))
+    memory.enqueue_messages(turn, user_id, session_id)
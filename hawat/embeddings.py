@@ -1,7 +1,406 @@
+import hashlib
+import logging
+import multiprocessing
 import os
+import queue
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
+import numpy as np
+import torch
 from langchain_huggingface import HuggingFaceEmbeddings
 
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+# Dimensions of EMBEDDING_MODEL_NAME's embeddings, which the compact vector indexes are built for
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "384"))
+EMBEDDING_DEVICE = os.getenv("EMBEDDING_DEVICE", "cpu")
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))  # 0 keeps torch's default intra-op thread count
+EMBEDDING_WARMUP = os.getenv("EMBEDDING_WARMUP", "true").lower() in ("1", "true", "yes")
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))  # Entries kept in memory, 0 disables
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR")  # Optional directory for a persistent cache
+# "torch", or "onnx" to run the model's quantized ONNX export with ONNX Runtime, which needs sentence-transformers[onnx]
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# The ONNX file in the model's repository. all-MiniLM-L6-v2 also has model_qint8_avx512_vnni.onnx and
+# model_qint8_arm64.onnx for CPUs that support them.
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+# Lowest cosine similarity the ONNX model may have with the torch model on sample texts before it is refused, since
+# its embeddings are searched against stored torch ones. 0 skips the check.
+EMBEDDING_ONNX_MIN_SIMILARITY = float(os.getenv("EMBEDDING_ONNX_MIN_SIMILARITY", "0.98"))
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "0"))  # Processes running the model, 0 runs it in this one
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))  # Texts coalesced into one batch for a worker
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "2"))  # Wait for other requests to join a batch
+
+# Texts the ONNX and torch models embed to check that they agree
+_ONNX_CHECK_TEXTS = [
+    "Hello! How are you doing today?",
+    "Can you suggest a good name for my new kitten?",
+    "The meeting with the Lisbon team moved to Thursday at 3pm.",
+    "def fibonacci(n): return n if n < 2 else fibonacci(n - 1) + fibonacci(n - 2)",
+    "I'm planning a trip to Japan next spring and want to see the cherry blossoms.",
+]
+
+# The model the database was originally built around, whose embeddings live in the plain `embedding` columns
+ORIGINAL_EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Process-wide embedder, created on first use
+_embedder = None
+_embedder_lock = threading.Lock()
+# In-process embedders for other models whose columns are kept up to date, by model name
+_other_embedders = {}
+# The model loaded in each embedding worker process
+_worker_model = None
+
+# LRU cache of embeddings keyed by a hash of the model name and the text
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def embedding_column(model_name: str) -> str:
+    """
+    Names the column that holds a model's embeddings in the `messages` and `conversations` tables.
+
+    Each model gets its own column, so embeddings from different models are never mixed and a new model can be
+    backfilled next to the one in use.
+
+    Args:
+        model_name (str): The embedding model's name.
+
+    Returns:
+        str: The column name.
+    """
+    if model_name == ORIGINAL_EMBEDDING_MODEL_NAME:
+        return "embedding"
+    slug = re.sub(r"[^a-z0-9]+", "_", model_name.lower()).strip("_")
+    return f"embedding_{slug[-40:]}"
+
+
+# The column this process reads and writes embeddings in
+EMBEDDING_COLUMN = embedding_column(EMBEDDING_MODEL_NAME)
+
+
+def embedded_through_column(column: str) -> str:
+    """
+    Names the `conversations` column that records which summary a model's embedding column was computed from.
+
+    It holds the conversation's `summarized_through` at the time, so summaries that changed since can be found.
+
+    Args:
+        column (str): The model's embedding column.
+
+    Returns:
+        str: The column name.
+    """
+    return f"{column}_through"
+
+
+def load_embedding_model(model_name: str, device: str, backend: str = EMBEDDING_BACKEND) -> HuggingFaceEmbeddings:
+    """Loads a HuggingFace Sentence Transformer with the settings Hawat stores embeddings with
+
+    The "onnx" backend runs the same model quantized to int8. Its embeddings have the same dimensions, and both
+    backends share the model's column, so the ONNX model is only used if `check_onnx_agreement` passes.
+    """
+    model_kwargs = {"device": device}
+    if backend == "onnx":
+        model_kwargs |= {"backend": "onnx", "model_kwargs": {"file_name": EMBEDDING_ONNX_FILE}}
+    model = HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs=model_kwargs,
+        encode_kwargs={"normalize_embeddings": False},
+    )
+    if backend == "onnx" and EMBEDDING_ONNX_MIN_SIMILARITY > 0:
+        check_onnx_agreement(model, load_embedding_model(model_name, device, "torch"))
+    return model
+
+
+def check_onnx_agreement(onnx_model: HuggingFaceEmbeddings, torch_model: HuggingFaceEmbeddings) -> float:
+    """
+    Checks that the quantized ONNX model embeds like the torch model its stored embeddings came from.
+
+    Args:
+        onnx_model (HuggingFaceEmbeddings): The ONNX model.
+        torch_model (HuggingFaceEmbeddings): The same model run with torch.
+
+    Returns:
+        float: The lowest cosine similarity between the two models' embeddings of the sample texts.
+
+    Raises:
+        RuntimeError: If that similarity is below EMBEDDING_ONNX_MIN_SIMILARITY.
+    """
+    onnx_embeddings = np.array(onnx_model.embed_documents(_ONNX_CHECK_TEXTS))
+    torch_embeddings = np.array(torch_model.embed_documents(_ONNX_CHECK_TEXTS))
+    similarities = np.sum(onnx_embeddings * torch_embeddings, axis=1) / (
+        np.linalg.norm(onnx_embeddings, axis=1) * np.linalg.norm(torch_embeddings, axis=1)
+    )
+    similarity = float(similarities.min())
+    if similarity < EMBEDDING_ONNX_MIN_SIMILARITY:
+        raise RuntimeError(
+            f"The ONNX model {EMBEDDING_ONNX_FILE} has a cosine similarity of {similarity:.4f} with the torch model, "
+            f"below EMBEDDING_ONNX_MIN_SIMILARITY ({EMBEDDING_ONNX_MIN_SIMILARITY}). Its embeddings would not match "
+            "the stored ones. Use the torch backend or another EMBEDDING_ONNX_FILE."
+        )
+    logger.info("ONNX model %s agrees with the torch model, cosine similarity %.4f", EMBEDDING_ONNX_FILE, similarity)
+    return similarity
+
+
+def init_embedding_worker(model_name: str, device: str, threads: int) -> None:
+    """Loads the model in a worker process, limited to its share of the cores"""
+    global _worker_model
+    torch.set_num_threads(threads)
+    _worker_model = load_embedding_model(model_name, device)
+
+
+def embed_in_worker(texts: list[str]) -> list[list[float]]:
+    """Embeds a batch with the model loaded by `init_embedding_worker`"""
+    return _worker_model.embed_documents(texts)
+
+
+class Embedder(ABC):
+    """
+    Runs the embedding model on texts that missed the cache.
+
+    Subclasses implement `embed`, and `warm_up` if loading the model takes more than one call.
+    """
+
+    @abstractmethod
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        """Returns the embeddings of the texts, in order"""
+
+    def warm_up(self) -> None:
+        """Loads the model and runs it once"""
+        self.embed(["warm up"])
+
+
+class InProcessEmbedder(Embedder):
+    """Runs the model in this process, one batch at a time"""
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME):
+        self.model_name = model_name
+        self._model = None
+        self._model_lock = threading.Lock()
+        # The HuggingFace fast tokenizer is not safe to share between threads, so inference is serialized
+        self._inference_lock = threading.Lock()
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        model = self._load()
+        with self._inference_lock:
+            return model.embed_documents(texts)
+
+    def _load(self) -> HuggingFaceEmbeddings:
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    if EMBEDDING_THREADS > 0:
+                        torch.set_num_threads(EMBEDDING_THREADS)
+                    self._model = load_embedding_model(self.model_name, EMBEDDING_DEVICE)
+                    logger.info(
+                        "Loaded embedding model %s on %s with %s",
+                        self.model_name,
+                        EMBEDDING_DEVICE,
+                        EMBEDDING_BACKEND,
+                    )
+        return self._model
+
+
+class WorkerPoolEmbedder(Embedder):
+    """
+    Runs the model in worker processes, so inference uses every core and never holds this process's GIL.
+
+    Requests from concurrent threads are coalesced into batches. A batch waits up to EMBEDDING_BATCH_WAIT_MS for other
+    requests to join it, and for as long as every worker is busy, until it holds EMBEDDING_BATCH_SIZE texts. Each
+    worker gets an equal share of the cores for torch's threads.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._threads = max(1, (os.cpu_count() or 1) // workers)
+        self._executor = self._start_executor()
+        self._requests = queue.Queue()
+        self._free_workers = threading.Semaphore(workers)
+        threading.Thread(target=self._coalesce, name="hawat-embedding-batcher", daemon=True).start()
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        future = Future()
+        self._requests.put((texts, future))
+        return future.result()
+
+    def warm_up(self) -> None:
+        # One call per worker, so every worker loads the model before the first real request
+        for future in [self._executor.submit(embed_in_worker, ["warm up"]) for _ in range(self.workers)]:
+            future.result()
+
+    def _start_executor(self) -> ProcessPoolExecutor:
+        logger.info(
+            "Starting %s embedding workers for %s with %s, %s threads each",
+            self.workers,
+            EMBEDDING_MODEL_NAME,
+            EMBEDDING_BACKEND,
+            self._threads,
+        )
+        # Forking a process that already runs threads isn't safe, so the workers start from a fresh interpreter
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_embedding_worker,
+            initargs=(EMBEDDING_MODEL_NAME, EMBEDDING_DEVICE, self._threads),
+        )
+
+    def _coalesce(self) -> None:
+        while True:
+            requests = [self._requests.get()]
+            self._free_workers.acquire()
+            size = len(requests[0][0])
+            deadline = time.monotonic() + EMBEDDING_BATCH_WAIT_MS / 1000
+            while size < EMBEDDING_BATCH_SIZE:
+                try:
+                    request = self._requests.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                requests.append(request)
+                size += len(request[0])
+            self._submit(requests)
+
+    def _submit(self, requests: list[tuple[list[str], Future]]) -> None:
+        batch = [text for texts, _ in requests for text in texts]
+        try:
+            try:
+                future = self._executor.submit(embed_in_worker, batch)
+            except BrokenProcessPool:
+                logger.error("An embedding worker died, restarting the workers")
+                self._executor = self._start_executor()
+                future = self._executor.submit(embed_in_worker, batch)
+        except Exception as e:
+            self._free_workers.release()
+            for _, request in requests:
+                request.set_exception(e)
+            return
+        future.add_done_callback(lambda done: self._resolve(requests, done))
+
+    def _resolve(self, requests: list[tuple[list[str], Future]], done: Future) -> None:
+        self._free_workers.release()
+        try:
+            embeddings = done.result()
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+        start = 0
+        for texts, future in requests:
+            future.set_result(embeddings[start : start + len(texts)])
+            start += len(texts)
+
+
+def get_embedder() -> Embedder:
+    """
+    Returns the process-wide embedder, creating it the first time it is needed.
+
+    Returns:
+        Embedder: A pool of EMBEDDING_WORKERS worker processes, or the model in this process if that is 0.
+    """
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                _embedder = WorkerPoolEmbedder(EMBEDDING_WORKERS) if EMBEDDING_WORKERS > 0 else InProcessEmbedder()
+    return _embedder
+
+
+def set_embedder(embedder: Embedder) -> None:
+    """Replaces the process-wide embedder"""
+    global _embedder
+    _embedder = embedder
+
+
+def warm_up_embeddings() -> None:
+    """Loads the embedding model and runs one inference so the first real request doesn't pay for it."""
+    get_embedder().warm_up()
+
+
+def _get_model_embedder(model_name: str) -> Embedder:
+    """Returns the process-wide embedder for EMBEDDING_MODEL_NAME, or an in-process one for another model"""
+    if model_name == EMBEDDING_MODEL_NAME:
+        return get_embedder()
+    with _embedder_lock:
+        if model_name not in _other_embedders:
+            _other_embedders[model_name] = InProcessEmbedder(model_name)
+        return _other_embedders[model_name]
+
+
+def _cache_key(text: str, model_name: str = EMBEDDING_MODEL_NAME) -> str:
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+
+def _cache_path(key: str) -> str:
+    return os.path.join(EMBEDDING_CACHE_DIR, key[:2], f"{key}.npy")
+
+
+def _cache_put(key: str, embedding: list[float], persist: bool = True) -> None:
+    """Adds an embedding to the in-memory cache and, if configured, to the on-disk cache."""
+    if EMBEDDING_CACHE_SIZE > 0:
+        with _cache_lock:
+            _cache[key] = embedding
+            _cache.move_to_end(key)
+            while len(_cache) > EMBEDDING_CACHE_SIZE:
+                _cache.popitem(last=False)
+    if persist and EMBEDDING_CACHE_DIR:
+        path = _cache_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so concurrent readers never see a partial array
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.asarray(embedding, dtype=np.float32))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error("Error writing embedding cache entry: %s", e)
+
+
+def _cache_get(key: str) -> list[float] | None:
+    """Looks an embedding up in the in-memory cache, then in the on-disk cache."""
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    if EMBEDDING_CACHE_DIR:
+        try:
+            embedding = np.load(_cache_path(key)).tolist()
+            _cache_put(key, embedding, persist=False)
+            return embedding
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def get_embeddings(texts: list[str], model_name: str = EMBEDDING_MODEL_NAME) -> list[list[float]]:
+    """
+    Generates vector embeddings for several texts with a single batched pass through the model.
+
+    Texts that were embedded before are served from the cache, and repeated texts are only embedded once.
+
+    Args:
+        texts (list[str]): The texts to embed.
+        model_name (str): The model to embed them with. Models other than EMBEDDING_MODEL_NAME, such as one that
+            `hawat_reembed` is backfilling, run in this process.
+
+    Returns:
+        list[list[float]]: The embedding vectors, in the same order as `texts`.
+    """
+    keys = [_cache_key(text, model_name) for text in texts]
+    embeddings = [_cache_get(key) for key in keys]
+    missing = {key: text for key, text, embedding in zip(keys, texts, embeddings) if embedding is None}
+    if missing:
+        computed = dict(zip(missing.keys(), _get_model_embedder(model_name).embed(list(missing.values()))))
+        for key, embedding in computed.items():
+            _cache_put(key, embedding)
+        embeddings = [embedding if embedding is not None else computed[key] for key, embedding in zip(keys, embeddings)]
+    return embeddings
+
 
 def get_embedding(text: str) -> list[float]:
     """
@@ -13,8 +412,4 @@ def get_embedding(text: str) -> list[float]:
     Returns:
         list[float]: The embedding vector.
     """
-    model_name = "sentence-transformers/all-MiniLM-L6-v2"
-    model_kwargs = {"device": "cpu"}
-    encode_kwargs = {"normalize_embeddings": False}
-    hf = HuggingFaceEmbeddings(model_name=model_name, model_kwargs=model_kwargs, encode_kwargs=encode_kwargs)
-    return hf.embed_query(text)
+    return get_embeddings([text])[0]
@@ -1,3 +1,8 @@
+import asyncio
+import functools
+import os
+import threading
+from collections.abc import AsyncIterator, Generator
 from concurrent.futures import ThreadPoolExecutor
 
 import grpc
@@ -5,25 +10,93 @@ import grpc
 import hawat.dispatcher as dispatcher
 import hawat.proto.chat_pb2 as pb2
 import hawat.proto.chat_pb2_grpc as pb2_grpc
+from hawat.memory import DEFAULT_SESSION_ID, DEFAULT_USER_ID
+
+GRPC_PORT = int(os.getenv("GRPC_PORT", "50051"))
+# Chats handled at once. Each one holds a thread for its blocking context building and model call, so they run in a
+# pool of their own rather than the event loop's default executor.
+GRPC_CHAT_WORKERS = int(os.getenv("GRPC_CHAT_WORKERS", "32"))
+
+_chat_executor = ThreadPoolExecutor(max_workers=GRPC_CHAT_WORKERS, thread_name_prefix="hawat-chat")
 
 
 def serve():
     """Start a server to transact chat messages over gRPC."""
-    server = grpc.server(ThreadPoolExecutor(max_workers=10))
+    asyncio.run(_serve())
+
+
+async def _serve():
+    server = grpc.aio.server()
     pb2_grpc.add_HawatChatServicer_to_server(ChatServer(), server)
-    server.add_insecure_port("[::]:50051")
-    server.start()
-    server.wait_for_termination()
+    server.add_insecure_port(f"[::]:{GRPC_PORT}")
+    await server.start()
+    await server.wait_for_termination()
+
+
+async def _iterate_in_thread(generator: Generator[str, None, None]) -> AsyncIterator[str]:
+    """Drives a blocking generator in one chat thread, handing its items to the event loop as they are produced
+
+    If iteration stops early, e.g. because the RPC was cancelled, the generator is closed as soon as it produces its
+    next item, so it releases the model's stream and runs its cleanup.
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    stopped = threading.Event()
+    errors = []
+    done = object()
+
+    def put(item) -> None:
+        try:
+            loop.call_soon_threadsafe(items.put_nowait, item)
+        except RuntimeError:  # The event loop has already been closed
+            pass
 
+    def produce() -> None:
+        try:
+            for item in generator:
+                if stopped.is_set():
+                    break
+                put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            generator.close()
+            put(done)
 
-class ChatServer(pb2_grpc.HawatChatServicer):  # pylint: disable=too-few-public-methods
+    loop.run_in_executor(_chat_executor, produce)
+    try:
+        while (item := await items.get()) is not done:
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        stopped.set()
+
+
+def _session(request) -> tuple[str, str]:
+    """The user and session a chat message belongs to, falling back to the defaults for fields the client left empty"""
+    return request.user_id or DEFAULT_USER_ID, request.session_id or DEFAULT_SESSION_ID
+
+
+class ChatServer(pb2_grpc.HawatChatServicer):
     """gRPC service for Hawat chats"""
 
-    def send_chat(self, request, context):
+    async def send_chat(self, request, context):
         """Handle the `send_chat` rpc function
 
         Returns:
             ServerChat: server's response to chat message
         """
-        response_message = dispatcher.process_message(request.message)
+        response_message = await asyncio.get_running_loop().run_in_executor(
+            _chat_executor, functools.partial(dispatcher.process_message, request.message, *_session(request))
+        )
         return pb2.ServerChat(message=response_message)  # pylint: disable=no-member
+
+    async def stream_chat(self, request, context):
+        """Handle the `stream_chat` rpc function
+
+        Yields:
+            ServerChat: pieces of the server's response to chat message as they are generated
+        """
+        async for chunk in _iterate_in_thread(dispatcher.stream_message(request.message, *_session(request))):
+            yield pb2.ServerChat(message=chunk)  # pylint: disable=no-member
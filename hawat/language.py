@@ -1,5 +1,16 @@
 import json
+import logging
 import os
+import time
+from collections.abc import Iterator
+from datetime import datetime
+
+# "template" puts the context and the conversation so far in one user message. "prefix_cache" sends the conversation
+# as separate turns ahead of the retrieved memories, so providers with prefix or KV caches can reuse it across turns.
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "template")
+# "json_object" asks for JSON mode, which most OpenAI-compatible servers support. "json_schema" asks for structured
+# outputs that follow NER_RESPONSE_SCHEMA exactly, where the server supports them.
+NER_RESPONSE_FORMAT = os.getenv("NER_RESPONSE_FORMAT", "json_object")
 
 CONVERSATION_SYSTEM_PROMPT_TEMPLATE = """You are Hawat, a helpful, conversational AI.
 Your purpose is to assist the user by providing effective advice and assistance.
@@ -13,79 +24,243 @@ Consider this context when replying to the User.
 {context}
 ---
 User (just now): {user_message}"""
+MEMORY_USER_PROMPT_TEMPLATE = """For context, you are provided with summaries of some of your earlier conversations and a selection of earlier messages.
+Consider this context when replying to the User's latest message.
+
+{context}
+---
+{user_message}"""
 
 SUMMARY_SYSTEM_PROMPT_TEMPLATE = """The following is a chat conversation between a human, User, and a conversational AI, Hawat. 
 Summarize the conversation as briefly as possible.
 You may use up to five bullet points.
 Summarize the conversation in a single sentence if you can."""
 
-NER_SYSTEM_PROMPT_TEMPLATE = """The following is a chat conversation between a human, User, and a conversational AI, Hawat. Find the keywords, named entities, and the subjects of the conversation.
+INCREMENTAL_SUMMARY_SYSTEM_PROMPT_TEMPLATE = """The following is the summary of a chat conversation between a human, User, and a conversational AI, Hawat, followed by the messages sent since that summary was written.
+Update the summary so that it covers the whole conversation, including the new messages.
+Keep it as brief as possible.
+You may use up to five bullet points.
+Summarize the conversation in a single sentence if you can."""
+INCREMENTAL_SUMMARY_USER_PROMPT_TEMPLATE = """Summary of the conversation so far:
+{summary}
+---
+New messages:
+{messages}"""
+
+NER_SYSTEM_PROMPT_TEMPLATE = """The following are chat conversations between a human, User, and a conversational AI, Hawat, each starting with a line holding its id. For each conversation, find the keywords, named entities, and the subjects of the conversation.
 The response should be a JSON object formatted like this:
 {
-  "subjects": [],
-  "entities": [],
-  "keywords": []
+  "conversations": [
+    {
+      "id": 1,
+      "subjects": [],
+      "entities": [],
+      "keywords": []
+    }
+  ]
 }
 """
+NER_CONVERSATION_TEMPLATE = """Conversation {id}
+===
+{messages}"""
+_TERM_LIST_SCHEMA = {"type": "array", "items": {"type": "string"}}
+NER_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "conversations": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "integer"},
+                    "subjects": _TERM_LIST_SCHEMA,
+                    "entities": _TERM_LIST_SCHEMA,
+                    "keywords": _TERM_LIST_SCHEMA,
+                },
+                "required": ["id", "subjects", "entities", "keywords"],
+                "additionalProperties": False,
+            },
+        }
+    },
+    "required": ["conversations"],
+    "additionalProperties": False,
+}
 
-from openai import OpenAI
+from hawat.llm import complete_chat, stream_chat
+from hawat.metrics import observe, timed
 
-_client = OpenAI(
-    base_url=os.getenv("OPENAI_API_BASE", "https://openrouter.ai/api/v1"),
-    api_key=os.getenv("OPENAI_API_KEY"),
-)
-_model = os.getenv("OPENAI_CHAT_MODEL", "deepseek/deepseek-r1-0528:free")  # Default chat model
-print(f"Using model: {_model}")
+logger = logging.getLogger(__name__)
 
 
-def send_to_model(system_prompt: str, user_prompt: str) -> str:
-    response = _client.chat.completions.create(
-        model=_model,
-        messages=[
+def send_to_model(system_prompt: str, user_prompt: str, timeout: float | None = None, **kwargs) -> str:
+    return complete_chat(
+        [
             {"role": "system", "content": system_prompt},
             {
                 "role": "user",
                 "content": user_prompt,
             },
         ],
+        timeout=timeout,
+        **kwargs,
     )
-    return response.choices[0].message.content
 
 
-def get_conversation_response(user_message: str, context: str = "") -> str:
+def stream_from_model(system_prompt: str, user_prompt: str, timeout: float | None = None) -> Iterator[str]:
+    """Yields the model's reply piece by piece as the API streams it back"""
+    yield from stream_chat(
+        [
+            {"role": "system", "content": system_prompt},
+            {
+                "role": "user",
+                "content": user_prompt,
+            },
+        ],
+        timeout=timeout,
+    )
+
+
+def get_conversation_response(
+    user_message: str, context: str = "", history: list[tuple[int, str, str, datetime, int]] | None = None
+) -> str:
     """
     Gets a chat completion from an OpenAI-compatible API.
 
     Args:
-        system_prompt (str): The system prompt for the chat.
-        user_prompt (str): The user prompt for the chat.
+        user_message (str): The User's most recent message.
+        context (str): The formatted conversational context, or only the retrieved memories if `history` is given.
+        history (list | None): The conversation so far, oldest first, to send as separate turns.
 
     Returns:
         str: The completed chat response.
     """
-    user_prompt = CONVERSATION_USER_PROMPT_TEMPLATE.format(context=context, user_message=user_message)
-    print(user_prompt)
-    return send_to_model(CONVERSATION_SYSTEM_PROMPT_TEMPLATE, user_prompt)
+    with timed("prompt"):
+        messages = build_conversation_messages(user_message, context, history)
+    logger.debug("Prompt:\n%s", messages[-1]["content"])
+    with timed("llm"):
+        return complete_chat(messages)
 
 
-def get_conversation_summary(formatted_convo: str) -> str:
-    """Gets a summary of the conversation between User and Hawat"""
+def stream_conversation_response(
+    user_message: str, context: str = "", history: list[tuple[int, str, str, datetime, int]] | None = None
+) -> Iterator[str]:
+    """
+    Streams a chat completion from an OpenAI-compatible API.
+
+    Args:
+        user_message (str): The User's most recent message.
+        context (str): The formatted conversational context, or only the retrieved memories if `history` is given.
+        history (list | None): The conversation so far, oldest first, to send as separate turns.
+
+    Yields:
+        str: Pieces of the chat response as they are generated.
+    """
+    with timed("prompt"):
+        messages = build_conversation_messages(user_message, context, history)
+    logger.debug("Prompt:\n%s", messages[-1]["content"])
+    # Timed by hand, since a span left open across yields would leak into the consumer's context
+    start = time.perf_counter()
+    first_chunk = True
+    for chunk in stream_chat(messages):
+        if first_chunk:
+            observe("llm.first_chunk", time.perf_counter() - start)
+            first_chunk = False
+        yield chunk
+    observe("llm", time.perf_counter() - start)
+
+
+def build_conversation_messages(
+    user_message: str, context: str = "", history: list[tuple[int, str, str, datetime, int]] | None = None
+) -> list[dict]:
+    """
+    Lays out the chat messages for a conversation turn.
+
+    Without `history`, the context and the User's message share a single user message. With it, the system prompt and
+    the earlier turns come first, unchanged from the previous request apart from the new turns at the end, and the
+    retrieved memories that vary from turn to turn are sent last along with the User's message.
+
+    Args:
+        user_message (str): The User's most recent message.
+        context (str): The formatted conversational context, or only the retrieved memories if `history` is given.
+        history (list | None): The conversation so far, oldest first.
+
+    Returns:
+        list[dict]: The chat messages.
+    """
+    if history is None:
+        user_prompt = CONVERSATION_USER_PROMPT_TEMPLATE.format(context=context, user_message=user_message)
+        return [
+            {"role": "system", "content": CONVERSATION_SYSTEM_PROMPT_TEMPLATE},
+            {"role": "user", "content": user_prompt},
+        ]
+    messages = [{"role": "system", "content": CONVERSATION_SYSTEM_PROMPT_TEMPLATE}]
+    # The turns carry no relative timestamps, which would change the prefix on every request
+    messages += [{"role": "assistant" if m[1] == "Hawat" else "user", "content": m[2]} for m in history]
+    messages.append(
+        {"role": "user", "content": MEMORY_USER_PROMPT_TEMPLATE.format(context=context, user_message=user_message)}
+    )
+    return messages
+
+
+def get_conversation_summary(formatted_convo: str, previous_summary: str | None = None) -> str:
+    """Gets a summary of the conversation between User and Hawat
+
+    Args:
+        formatted_convo (str): The conversation's messages, or only its new messages if `previous_summary` is given.
+        previous_summary (str | None): The summary of the conversation up to the first message in `formatted_convo`.
+
+    Returns:
+        str: The summary of the whole conversation.
+    """
+    if previous_summary:
+        return send_to_model(
+            INCREMENTAL_SUMMARY_SYSTEM_PROMPT_TEMPLATE,
+            INCREMENTAL_SUMMARY_USER_PROMPT_TEMPLATE.format(summary=previous_summary, messages=formatted_convo),
+        )
     return send_to_model(SUMMARY_SYSTEM_PROMPT_TEMPLATE, formatted_convo)
 
 
 def get_conversation_keys_names_subjects(formatted_convo: str) -> dict[str, list[str]] | None:
     """Gets subjects, named entities, and keywords from a conversation"""
-    content = send_to_model(NER_SYSTEM_PROMPT_TEMPLATE, formatted_convo)
+    return get_conversations_keys_names_subjects({0: formatted_convo}).get(0)
+
+
+def get_conversations_keys_names_subjects(formatted_convos: dict[int, str]) -> dict[int, dict[str, list[str]]]:
+    """Gets subjects, named entities, and keywords from several conversations with a single request
+
+    Args:
+        formatted_convos (dict[int, str]): Each conversation's messages, keyed by the conversation's id.
+
+    Returns:
+        dict[int, dict[str, list[str]]]: The "subjects", "entities" and "keywords" of each conversation, keyed by id.
+            Conversations missing from the model's response, or with malformed entries, are left out.
+    """
+    if NER_RESPONSE_FORMAT == "json_schema":
+        response_format = {
+            "type": "json_schema",
+            "json_schema": {"name": "conversation_terms", "strict": True, "schema": NER_RESPONSE_SCHEMA},
+        }
+    else:
+        response_format = {"type": "json_object"}
+    content = send_to_model(
+        NER_SYSTEM_PROMPT_TEMPLATE,
+        "\n\n".join(NER_CONVERSATION_TEMPLATE.format(id=id, messages=convo) for id, convo in formatted_convos.items()),
+        response_format=response_format,
+    )
     try:
         output = json.loads(content)
-        if not (
-            isinstance(output["entities"], list)
-            and isinstance(output["keywords"], list)
-            and isinstance(output["subjects"], list)
-        ):
-            raise TypeError
-        return output
-    except Exception as e:
-        print(f"Bad JSON response: {e}")
-        print(f"Response: {content}")
-        return None
+    except json.JSONDecodeError as e:
+        logger.warning("Bad JSON response: %s\nResponse: %s", e, content)
+        return {}
+    entries = output.get("conversations") if isinstance(output, dict) else None
+    if not isinstance(entries, list):
+        logger.warning("Response is missing the conversations list: %s", content)
+        return {}
+    terms = {}
+    for entry in entries:
+        if not (isinstance(entry, dict) and entry.get("id") in formatted_convos):
+            continue
+        lists = {key: entry.get(key) for key in ("subjects", "entities", "keywords")}
+        if all(isinstance(value, list) and all(isinstance(term, str) for term in value) for value in lists.values()):
+            terms[entry["id"]] = lists
+    return terms
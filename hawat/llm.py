@@ -0,0 +1,323 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections.abc import Iterator
+
+import httpx
+from openai import APIConnectionError, APIStatusError, APITimeoutError, OpenAI
+
+from hawat.metrics import register_collector
+
+# An ordered JSON list of OpenAI-compatible endpoints to fail over across, e.g.
+# [{"name": "lm-studio", "base_url": "http://localhost:1234/v1", "model": "qwen3-8b"}, {"name": "openrouter"}]
+# Fields left out fall back to OPENAI_API_BASE, OPENAI_API_KEY and OPENAI_CHAT_MODEL. "api_key_env" names an
+# environment variable to read the key from instead of putting it in the list, and "stream_usage": false turns off
+# asking for token usage on streams for servers that reject stream_options.
+LLM_BACKENDS = os.getenv("LLM_BACKENDS")
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "120"))  # Per call, and between streamed chunks
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("LLM_CONNECT_TIMEOUT_SECONDS", "5"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))  # Shared by every backend
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "8"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))  # Calls in flight per backend
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "1"))  # Wait for a busy backend's slot
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))  # Extra passes over the backend list
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "1"))
+LLM_FAILURE_THRESHOLD = int(os.getenv("LLM_FAILURE_THRESHOLD", "3"))  # Consecutive failures before skipping a backend
+LLM_COOLDOWN_SECONDS = float(os.getenv("LLM_COOLDOWN_SECONDS", "30"))
+
+DEFAULT_BASE_URL = os.getenv("OPENAI_API_BASE", "https://openrouter.ai/api/v1")
+DEFAULT_MODEL = os.getenv("OPENAI_CHAT_MODEL", "deepseek/deepseek-r1-0528:free")  # Default chat model
+
+logger = logging.getLogger(__name__)
+
+# One connection pool for every backend, so idle keep-alive connections are reused across calls and threads
+_http_client = httpx.Client(
+    limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS),
+    timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=LLM_CONNECT_TIMEOUT_SECONDS),
+)
+
+
+class BackendUnavailable(Exception):
+    """Raised when a backend is cooling down or has no free slot for another call"""
+
+
+class LLMBackend:
+    """
+    A chat completion provider.
+
+    Subclasses implement `_complete` and `_stream`. The base class limits how many calls are in flight, takes the
+    backend out of rotation after repeated failures, and keeps latency and error metrics.
+    """
+
+    def __init__(self, name: str, model: str, max_concurrency: int = LLM_MAX_CONCURRENCY):
+        self.name = name
+        self.model = model
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._unavailable_until = 0.0
+        self._metrics = {
+            "requests": 0,
+            "errors": 0,
+            "latency_seconds_total": 0.0,
+            "last_error": None,
+            "prompt_tokens": 0,
+            "cached_prompt_tokens": 0,
+        }
+
+    def complete(self, messages: list[dict], timeout: float, **kwargs) -> str:
+        """Returns the reply to a list of chat messages"""
+        self._acquire()
+        start = time.perf_counter()
+        try:
+            content = self._complete(messages, timeout, **kwargs)
+        except Exception as e:
+            self._record(start, e)
+            raise
+        finally:
+            self._slots.release()
+        self._record(start)
+        return content
+
+    def stream(self, messages: list[dict], timeout: float, **kwargs) -> Iterator[str]:
+        """Yields the reply to a list of chat messages piece by piece"""
+        self._acquire()
+        start = time.perf_counter()
+        try:
+            yield from self._stream(messages, timeout, **kwargs)
+        except Exception as e:
+            self._record(start, e)
+            raise
+        finally:
+            self._slots.release()
+        self._record(start)
+
+    def metrics(self) -> dict:
+        """Returns the backend's call counts, total latency, most recent error and prompt cache usage"""
+        with self._lock:
+            metrics = dict(self._metrics, available=time.monotonic() >= self._unavailable_until)
+        prompt_tokens = metrics["prompt_tokens"]
+        metrics["prompt_cache_hit_rate"] = metrics["cached_prompt_tokens"] / prompt_tokens if prompt_tokens else None
+        return metrics
+
+    def record_usage(self, prompt_tokens: int, cached_prompt_tokens: int) -> None:
+        """Adds a call's prompt tokens, and how many of them the provider served from its prompt cache"""
+        with self._lock:
+            self._metrics["prompt_tokens"] += prompt_tokens
+            self._metrics["cached_prompt_tokens"] += cached_prompt_tokens
+
+    def _complete(self, messages: list[dict], timeout: float, **kwargs) -> str:
+        raise NotImplementedError
+
+    def _stream(self, messages: list[dict], timeout: float, **kwargs) -> Iterator[str]:
+        raise NotImplementedError
+
+    def _acquire(self) -> None:
+        if time.monotonic() < self._unavailable_until:
+            raise BackendUnavailable(f"{self.name} is cooling down after repeated failures")
+        # Don't let one slow provider tie up every worker; the caller moves on to the next backend instead
+        if not self._slots.acquire(timeout=LLM_QUEUE_TIMEOUT_SECONDS):
+            raise BackendUnavailable(f"{self.name} has {LLM_MAX_CONCURRENCY} calls in flight")
+
+    def _record(self, start: float, error: Exception | None = None) -> None:
+        with self._lock:
+            self._metrics["requests"] += 1
+            self._metrics["latency_seconds_total"] += time.perf_counter() - start
+            if error is None:
+                self._consecutive_failures = 0
+                return
+            self._metrics["errors"] += 1
+            self._metrics["last_error"] = repr(error)
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= LLM_FAILURE_THRESHOLD:
+                self._unavailable_until = time.monotonic() + LLM_COOLDOWN_SECONDS
+                self._consecutive_failures = 0
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """An OpenAI-compatible chat completions API, such as OpenRouter, LM Studio, Ollama, or vLLM"""
+
+    def __init__(self, name: str, base_url: str, api_key: str | None, model: str, stream_usage: bool = True, **kwargs):
+        super().__init__(name, model, **kwargs)
+        # Ask for token usage at the end of streams, which not every OpenAI-compatible server accepts
+        self._stream_usage = stream_usage
+        # Retries are handled by `complete_chat` so that they can move on to the next backend
+        self._client = OpenAI(
+            base_url=base_url, api_key=api_key or "not-needed", http_client=_http_client, max_retries=0
+        )
+
+    def _complete(self, messages: list[dict], timeout: float, **kwargs) -> str:
+        response = self._client.chat.completions.create(model=self.model, messages=messages, timeout=timeout, **kwargs)
+        self._record_response_usage(response.usage)
+        return response.choices[0].message.content
+
+    def _stream(self, messages: list[dict], timeout: float, **kwargs) -> Iterator[str]:
+        if self._stream_usage:
+            kwargs.setdefault("stream_options", {"include_usage": True})
+        stream = self._client.chat.completions.create(
+            model=self.model, messages=messages, timeout=timeout, stream=True, **kwargs
+        )
+        with stream:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                if chunk.usage:
+                    self._record_response_usage(chunk.usage)
+
+    def _record_response_usage(self, usage) -> None:
+        if usage is None:
+            return
+        # OpenAI, OpenRouter, vLLM and llama.cpp report prompt cache hits as cached_tokens
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.record_usage(usage.prompt_tokens or 0, (getattr(details, "cached_tokens", None) or 0) if details else 0)
+
+
+def _load_backends() -> list[LLMBackend]:
+    """Builds the backends listed in LLM_BACKENDS, or a single one from the OPENAI_* settings"""
+    configs = json.loads(LLM_BACKENDS) if LLM_BACKENDS else [{}]
+    if not isinstance(configs, list) or not configs:
+        raise ValueError(f"LLM_BACKENDS must be a JSON list of at least one backend, got {LLM_BACKENDS!r}")
+    backends = []
+    for i, config in enumerate(configs):
+        api_key = os.getenv(config["api_key_env"]) if "api_key_env" in config else config.get("api_key")
+        backends.append(
+            OpenAICompatibleBackend(
+                name=config.get("name", f"backend-{i}"),
+                base_url=config.get("base_url", DEFAULT_BASE_URL),
+                api_key=api_key or os.getenv("OPENAI_API_KEY"),
+                model=config.get("model", DEFAULT_MODEL),
+                stream_usage=config.get("stream_usage", True),
+                max_concurrency=config.get("max_concurrency", LLM_MAX_CONCURRENCY),
+            )
+        )
+    return backends
+
+
+_backends = _load_backends()
+
+
+def set_backends(backends: list[LLMBackend]) -> None:
+    """Replaces the backends chat completions are sent to, in the order they are tried"""
+    global _backends
+    if not backends:
+        raise ValueError("At least one LLM backend is needed")
+    _backends = list(backends)
+
+
+def get_backends() -> list[LLMBackend]:
+    """Returns the backends chat completions are sent to, in the order they are tried"""
+    return list(_backends)
+
+
+def get_backend_metrics() -> dict[str, dict]:
+    """Returns each backend's call counts, total latency, most recent error and prompt cache usage, keyed by name"""
+    return {backend.name: backend.metrics() for backend in _backends}
+
+
+# Prometheus name, type and description of the backend metrics exported on /metrics
+_EXPORTED_BACKEND_METRICS = {
+    "requests": ("hawat_llm_requests_total", "counter", "Chat completion calls made to each backend."),
+    "errors": ("hawat_llm_errors_total", "counter", "Chat completion calls to each backend that failed."),
+    "latency_seconds_total": ("hawat_llm_latency_seconds_total", "counter", "Seconds spent in calls to each backend."),
+    "prompt_tokens": ("hawat_llm_prompt_tokens_total", "counter", "Prompt tokens sent to each backend."),
+    "cached_prompt_tokens": (
+        "hawat_llm_cached_prompt_tokens_total",
+        "counter",
+        "Prompt tokens each backend served from its prompt cache.",
+    ),
+    "available": ("hawat_llm_backend_available", "gauge", "Whether each backend is in rotation (1) or cooling down."),
+}
+
+
+def _render_backend_metrics() -> list[str]:
+    metrics = get_backend_metrics()
+    lines = []
+    for key, (name, metric_type, documentation) in _EXPORTED_BACKEND_METRICS.items():
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+        lines += [f'{name}{{backend="{backend}"}} {float(values[key])}' for backend, values in metrics.items()]
+    return lines
+
+
+register_collector(_render_backend_metrics)
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Whether another attempt, on this backend or the next, might succeed"""
+    if isinstance(error, APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return isinstance(error, (BackendUnavailable, APIConnectionError, APITimeoutError, httpx.TransportError))
+
+
+def _backoff(attempt: int) -> None:
+    # Full jitter keeps concurrent callers from retrying in lockstep
+    time.sleep(random.uniform(0, LLM_RETRY_BASE_SECONDS * 2**attempt))
+
+
+def complete_chat(messages: list[dict], timeout: float | None = None, **kwargs) -> str:
+    """
+    Gets a chat completion, trying each backend in order and retrying the list with jittered backoff.
+
+    Args:
+        messages (list[dict]): The chat messages, as `{"role": ..., "content": ...}` dicts.
+        timeout (float | None): Seconds to wait for each attempt. Defaults to LLM_TIMEOUT_SECONDS.
+        **kwargs: Extra arguments for the chat completions API, such as `response_format`.
+
+    Returns:
+        str: The completed chat response.
+    """
+    timeout = timeout or LLM_TIMEOUT_SECONDS
+    error = None
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        if attempt:
+            _backoff(attempt - 1)
+        for backend in _backends:
+            try:
+                return backend.complete(messages, timeout, **kwargs)
+            except Exception as e:
+                if not _is_retryable(e):
+                    raise
+                if not isinstance(e, BackendUnavailable):
+                    logger.warning("Error getting a chat completion from %s: %s", backend.name, e)
+                error = e
+    raise error
+
+
+def stream_chat(messages: list[dict], timeout: float | None = None, **kwargs) -> Iterator[str]:
+    """
+    Streams a chat completion, failing over like `complete_chat` until the first piece of the reply arrives.
+
+    Once a backend has started replying, errors are raised to the caller instead of starting the reply over.
+
+    Args:
+        messages (list[dict]): The chat messages, as `{"role": ..., "content": ...}` dicts.
+        timeout (float | None): Seconds to wait for each attempt to connect and between pieces of the reply.
+            Defaults to LLM_TIMEOUT_SECONDS.
+        **kwargs: Extra arguments for the chat completions API.
+
+    Yields:
+        str: Pieces of the chat response as they are generated.
+    """
+    timeout = timeout or LLM_TIMEOUT_SECONDS
+    error = None
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        if attempt:
+            _backoff(attempt - 1)
+        for backend in _backends:
+            stream = backend.stream(messages, timeout, **kwargs)
+            try:
+                first = next(stream, None)
+            except Exception as e:
+                if not _is_retryable(e):
+                    raise
+                if not isinstance(e, BackendUnavailable):
+                    logger.warning("Error streaming a chat completion from %s: %s", backend.name, e)
+                error = e
+                continue
+            if first is not None:
+                yield first
+                yield from stream
+            return
+    raise error
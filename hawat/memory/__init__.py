@@ -1,9 +1,12 @@
 from hawat.memory.context import (
-    format_message_log,
+    get_context_records,
     get_formatted_context,
     get_immediate_conversational_context,
+    get_layered_context,
     get_relevant_messages_by_vector_similarity,
 )
 from hawat.memory.conversations import get_current_conversation_id
-from hawat.memory.messages import record_message
-from hawat.memory.schema import get_connection_pool
+from hawat.memory.formatting import format_message_log
+from hawat.memory.messages import record_message, record_messages
+from hawat.memory.schema import DEFAULT_SESSION_ID, DEFAULT_USER_ID, get_connection_pool
+from hawat.memory.writer import enqueue_message, enqueue_messages, flush, get_pending_messages
@@ -0,0 +1,140 @@
+import logging
+import os
+
+import numpy as np
+from psycopg import sql
+
+from hawat.embeddings import EMBEDDING_COLUMN
+from hawat.memory.schema import get_connection_pool
+
+logger = logging.getLogger(__name__)
+
+# Cosine distance from the nearest centroid beyond which a conversation starts a new cluster
+CLUSTER_DISTANCE_THRESHOLD = float(os.getenv("CLUSTER_DISTANCE_THRESHOLD", "0.5"))
+# Conversations a cluster takes before the next close conversation starts a new one, so searching a cluster stays cheap
+CLUSTER_MAX_SIZE = int(os.getenv("CLUSTER_MAX_SIZE", "200"))
+# Clusters per user. Once a user has this many, conversations join their nearest cluster however far or full it is.
+CLUSTER_MAX_PER_USER = int(os.getenv("CLUSTER_MAX_PER_USER", "2000"))
+
+# Arbitrary key for the advisory locks that serialize changes to a user's clusters, paired with a hash of the user
+_CLUSTER_LOCK_KEY = 4_281_767
+
+# Summarized conversations whose summary is newer than their cluster assignment, oldest first
+_UNCLUSTERED_CONVERSATIONS_QUERY = sql.SQL(
+    """
+    SELECT id, user_id, {embedding}, summarized_through FROM conversations
+    WHERE summarized_through > COALESCE(clustered_through, 0) AND {embedding} IS NOT NULL
+    ORDER BY id LIMIT %s
+"""
+).format(embedding=sql.Identifier(EMBEDDING_COLUMN))
+# The user's nearest cluster and how many clusters the user has
+_NEAREST_CLUSTER_QUERY = """
+    SELECT id, size, centroid <=> %(embedding)s AS distance, Count(*) OVER () FROM clusters
+    WHERE user_id = %(user_id)s AND embedding_column = %(embedding_column)s
+    ORDER BY distance LIMIT 1
+"""
+_CREATE_CLUSTER_QUERY = """
+    INSERT INTO clusters (user_id, embedding_column, centroid, size)
+    VALUES (%(user_id)s, %(embedding_column)s, %(embedding)s, 0)
+    RETURNING id
+"""
+_ASSIGN_MEMBER_QUERY = """
+    INSERT INTO cluster_members (conversation_id, cluster_id) VALUES (%s, %s)
+    ON CONFLICT (conversation_id) DO UPDATE SET cluster_id = EXCLUDED.cluster_id
+"""
+# Moves the centroids of the clusters that gained or lost a conversation to the mean of their members' embeddings
+_UPDATE_CENTROIDS_QUERY = sql.SQL(
+    """
+    UPDATE clusters AS cl SET centroid = stats.centroid, size = stats.size
+    FROM (
+        SELECT cm.cluster_id, Avg(c.{embedding}) AS centroid, Count(*) AS size FROM cluster_members AS cm
+        INNER JOIN conversations AS c ON c.id = cm.conversation_id
+        WHERE cm.cluster_id = ANY(%s)
+        GROUP BY cm.cluster_id
+    ) AS stats
+    WHERE cl.id = stats.cluster_id
+"""
+).format(embedding=sql.Identifier(EMBEDDING_COLUMN))
+_DELETE_EMPTY_CLUSTERS_QUERY = """
+    DELETE FROM clusters AS cl
+    WHERE id = ANY(%s) AND NOT EXISTS (SELECT 1 FROM cluster_members WHERE cluster_id = cl.id)
+"""
+
+
+def get_unclustered_conversations(limit: int) -> list[tuple[int, str, np.ndarray, int]]:
+    """Retrieves summarized conversations that haven't been assigned to a cluster since their summary changed
+
+    The conversations are found through the `conversations_unclustered_idx` partial index.
+
+    Args:
+        limit (int): The most conversations to return.
+
+    Returns:
+        list[tuple[int, str, np.ndarray, int]]: Each conversation's id, user, summary embedding and the id of the
+            newest message its summary covers.
+    """
+    pool = get_connection_pool()
+    conversations = []
+    if pool:
+        try:
+            with pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(_UNCLUSTERED_CONVERSATIONS_QUERY, (limit,))
+                conversations = cur.fetchall()
+        except Exception as e:
+            logger.error("Error getting unclustered conversations: %s", e)
+    return conversations
+
+
+def assign_conversation_cluster(
+    conversation_id: int, user_id: str, embedding: np.ndarray, summarized_through: int
+) -> bool:
+    """Assigns a conversation to its user's nearest topic cluster, or to a new cluster, in one pass of k-means
+
+    The conversation joins the nearest cluster if that is within CLUSTER_DISTANCE_THRESHOLD and has room for it, and
+    otherwise starts a cluster of its own, unless the user already has CLUSTER_MAX_PER_USER clusters. The centroids
+    of the clusters it joins and leaves are then recomputed from their members, and clusters left empty are removed.
+    The user's advisory lock is held for the transaction, so concurrent assignments can't start duplicate clusters.
+
+    Args:
+        conversation_id (int): The conversation's id.
+        user_id (str): The user the conversation belongs to.
+        embedding (np.ndarray): The embedding of the conversation's summary.
+        summarized_through (int): Id of the newest message the summary covers, recorded as `clustered_through`.
+
+    Returns:
+        bool: Whether the conversation was assigned.
+    """
+    pool = get_connection_pool()
+    if not pool:
+        return False
+    try:
+        with pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", (_CLUSTER_LOCK_KEY, user_id))
+            cur.execute("SELECT cluster_id FROM cluster_members WHERE conversation_id = %s", (conversation_id,))
+            previous = cur.fetchone()
+            previous_id = previous[0] if previous else None
+            params = {"user_id": user_id, "embedding_column": EMBEDDING_COLUMN, "embedding": embedding}
+            cur.execute(_NEAREST_CLUSTER_QUERY, params)
+            nearest = cur.fetchone()
+            cluster_id = None
+            if nearest is not None:
+                nearest_id, size, distance, clusters = nearest
+                # A conversation moving within its own cluster doesn't need room for itself
+                has_room = size - (nearest_id == previous_id) < CLUSTER_MAX_SIZE
+                if (distance <= CLUSTER_DISTANCE_THRESHOLD and has_room) or clusters >= CLUSTER_MAX_PER_USER:
+                    cluster_id = nearest_id
+            if cluster_id is None:
+                cur.execute(_CREATE_CLUSTER_QUERY, params)
+                cluster_id = cur.fetchone()[0]
+            cur.execute(_ASSIGN_MEMBER_QUERY, (conversation_id, cluster_id))
+            changed = [cluster_id] if previous_id in (None, cluster_id) else [cluster_id, previous_id]
+            cur.execute(_UPDATE_CENTROIDS_QUERY, (changed,))
+            cur.execute(_DELETE_EMPTY_CLUSTERS_QUERY, (changed,))
+            cur.execute(
+                "UPDATE conversations SET clustered_through = %s WHERE id = %s", (summarized_through, conversation_id)
+            )
+            conn.commit()
+        return True
+    except Exception as e:
+        logger.error("Error clustering conversation %s: %s", conversation_id, e)
+        return False
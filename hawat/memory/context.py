@@ -1,15 +1,63 @@
+import logging
 import os
+import time
 from datetime import datetime, timedelta, timezone
 
 import numpy as np
 from arrow import Arrow
-from pgvector.psycopg import register_vector
+from psycopg import sql
 
-from hawat.embeddings import get_embedding
-from hawat.memory.schema import get_connection_pool
+from hawat.embeddings import EMBEDDING_COLUMN, EMBEDDING_DIMENSIONS, get_embedding
+from hawat.memory.conversations import CONVO_THRESHOLD
+from hawat.memory.formatting import format_message_log
+from hawat.memory.schema import (
+    DEFAULT_SESSION_ID,
+    DEFAULT_USER_ID,
+    compact_index_distance,
+    get_connection_pool,
+    get_vector_extension_version,
+)
+from hawat.memory.terms import query_terms
+from hawat.memory.writer import get_pending_messages
+from hawat.metrics import observe
+from hawat.tokens import count_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+# hnsw.iterative_scan arrived in pgvector 0.8.0. Before that, "hnsw" is a reserved prefix and setting it is an error.
+_ITERATIVE_SCAN_VERSION = (0, 8, 0)
 
 CONTEXT_TIME_WINDOW_MINUTES = int(os.getenv("CONTEXT_TIME_WINDOW_MINUTES", "5"))  # Default to last 5 minutes
 TOP_K_SIMILAR_MESSAGES = int(os.getenv("TOP_K_SIMILAR_MESSAGES", "3"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))  # Candidate list size for HNSW searches
+# pgvector 0.8+ keeps scanning the HNSW index until filtered queries fill their LIMIT, "off" to disable. It is
+# skipped on older versions, which reject the setting.
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "relaxed_order")
+# "vector" searches the full-precision HNSW indexes. "halfvec" and "bit" search the compact indexes built by
+# `hawat_compact_index` instead, then re-rank the nearest COMPACT_INDEX_CANDIDATES by their exact distance.
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "vector")
+COMPACT_INDEX_CANDIDATES = int(os.getenv("COMPACT_INDEX_CANDIDATES", "50"))
+# Rank similar messages by a mix of vector similarity, full-text relevance and recency instead of similarity alone
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "false").lower() in ("1", "true", "yes")
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "50"))  # Candidates taken from each index before re-ranking
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", "1.0"))
+HYBRID_TEXT_WEIGHT = float(os.getenv("HYBRID_TEXT_WEIGHT", "0.5"))
+HYBRID_RECENCY_WEIGHT = float(os.getenv("HYBRID_RECENCY_WEIGHT", "0.2"))
+HYBRID_RECENCY_HALF_LIFE_DAYS = float(os.getenv("HYBRID_RECENCY_HALF_LIFE_DAYS", "30"))
+# Prefer conversations whose extracted entities or keywords appear in the message, topping up with plain similarity
+ENTITY_PREFILTER = os.getenv("ENTITY_PREFILTER", "false").lower() in ("1", "true", "yes")
+# Search only the conversations in the CLUSTER_PROBES topic clusters nearest the message, and their messages, instead
+# of the whole history. Until reflection has clustered any of the user's conversations, the whole history is searched.
+CLUSTER_RETRIEVAL = os.getenv("CLUSTER_RETRIEVAL", "false").lower() in ("1", "true", "yes")
+CLUSTER_PROBES = int(os.getenv("CLUSTER_PROBES", "3"))
+# Token budgets for each section of the context, 0 for no limit. Whatever the related conversations and similar
+# messages leave unused goes to the current conversation.
+CURRENT_CONVERSATION_TOKEN_BUDGET = int(os.getenv("CURRENT_CONVERSATION_TOKEN_BUDGET", "3000"))
+RELATED_CONVERSATIONS_TOKEN_BUDGET = int(os.getenv("RELATED_CONVERSATIONS_TOKEN_BUDGET", "750"))
+SIMILAR_MESSAGES_TOKEN_BUDGET = int(os.getenv("SIMILAR_MESSAGES_TOKEN_BUDGET", "750"))
+# When the conversation history is over budget, its oldest turns are dropped in steps of this many messages, so the
+# start of the prompt stays the same for several turns in a row and provider prefix caches can keep reusing it
+HISTORY_TRIM_STEP = int(os.getenv("HISTORY_TRIM_STEP", "8"))
 
 CONVO_CONTEXT_TEMPLATE = """Summaries of some prior conversations related to the current topic
 ===
@@ -25,120 +73,725 @@ The current conversation starts here
 ===
 {current}
 """
+MEMORY_CONTEXT_TEMPLATE = """Summaries of some prior conversations related to the current topic
+===
+{convos}
+
+
+Individual messages from other conversations that may be related to the current discussion
+===
+{messages}
+"""
 NONE_AVAILABLE = ["None available"]
+ENTRY_SEPARATOR = "\n---\n"
+OMITTED_MESSAGES_TEMPLATE = "[{count} earlier messages in this conversation omitted]"
+TRUNCATED_MARKER = " [...]"
 
+_IMMEDIATE_CONTEXT_QUERY = """
+    SELECT id, sender, content, timestamp FROM messages
+    WHERE user_id = %(user_id)s AND session_id = %(session_id)s AND timestamp >= %(window_start)s
+    ORDER BY timestamp ASC
+"""
+# The session's most recently active conversation, if it is recent enough to still be going
+_CURRENT_CONVERSATION_ID_QUERY = """
+    SELECT id FROM conversations
+    WHERE user_id = %(user_id)s AND session_id = %(session_id)s AND last_message_at >= %(since)s
+    ORDER BY last_message_at DESC LIMIT 1
+"""
+# Every message of the current conversation
+_CURRENT_CONVERSATION_QUERY = f"""
+    SELECT m.id, m.sender, m.content, m.timestamp FROM messages AS m
+    INNER JOIN conversations_messages AS cm ON cm.message_id = m.id
+    WHERE cm.conversation_id = ({_CURRENT_CONVERSATION_ID_QUERY})
+    ORDER BY m.timestamp ASC
+"""
+# Messages of the current conversation, which the prompt already holds
+_CURRENT_CONVERSATION_MESSAGES = f"""
+    SELECT message_id FROM conversations_messages WHERE conversation_id = ({_CURRENT_CONVERSATION_ID_QUERY})
+"""
+# Orders rows by their distance to the query embedding the way the HNSW indexes VECTOR_INDEX selects can serve
+_INDEXED_DISTANCE = (
+    sql.SQL("{embedding} <=> %(embedding)s").format(embedding=sql.Identifier(EMBEDDING_COLUMN))
+    if VECTOR_INDEX == "vector"
+    else compact_index_distance(sql.Identifier(EMBEDDING_COLUMN), VECTOR_INDEX, EMBEDDING_DIMENSIONS)
+)
+# Rows taken from an index search before ranking them by exact distance. The full-precision indexes rank exactly.
+_INDEX_CANDIDATES = TOP_K_SIMILAR_MESSAGES if VECTOR_INDEX == "vector" else COMPACT_INDEX_CANDIDATES
+# Distances use the cosine operator to match the vector_cosine_ops HNSW indexes. Messages of the session's current
+# conversation are already in the prompt, so they are filtered out here rather than after the search. Every search
+# only reads the user's own messages and conversations.
+_VECTOR_RELEVANT_MESSAGES_QUERY = sql.SQL(
+    """
+    SELECT id, sender, content, timestamp FROM (
+        SELECT id, sender, content, timestamp, {embedding} AS embedding FROM messages
+        WHERE user_id = %(user_id)s AND id NOT IN ({current_messages})
+        ORDER BY {indexed_distance} LIMIT %(candidates)s
+    ) AS candidates
+    ORDER BY embedding <=> %(embedding)s LIMIT %(limit)s
+"""
+).format(
+    embedding=sql.Identifier(EMBEDDING_COLUMN),
+    indexed_distance=_INDEXED_DISTANCE,
+    current_messages=sql.SQL(_CURRENT_CONVERSATION_MESSAGES),
+)
+# Takes the nearest candidates from the HNSW index and the best full-text matches from the GIN index, then ranks
+# them by a weighted sum of cosine similarity, text relevance and exponential recency decay
+_HYBRID_RELEVANT_MESSAGES_QUERY = sql.SQL(
+    """
+    WITH vector_candidates AS (
+        SELECT id FROM messages
+        WHERE user_id = %(user_id)s AND id NOT IN ({current_messages})
+        ORDER BY {indexed_distance} LIMIT %(candidates)s
+    ), text_candidates AS (
+        SELECT id FROM messages
+        WHERE to_tsvector('english', content) @@ websearch_to_tsquery('english', %(query)s)
+            AND user_id = %(user_id)s AND id NOT IN ({current_messages})
+        ORDER BY ts_rank_cd(to_tsvector('english', content), websearch_to_tsquery('english', %(query)s), 32) DESC
+        LIMIT %(candidates)s
+    )
+    SELECT id, sender, content, timestamp
+    FROM messages
+    WHERE id IN (SELECT id FROM vector_candidates UNION SELECT id FROM text_candidates)
+    ORDER BY
+        %(vector_weight)s * (1 - ({embedding} <=> %(embedding)s))
+        + %(text_weight)s * ts_rank_cd(to_tsvector('english', content), websearch_to_tsquery('english', %(query)s), 32)
+        + %(recency_weight)s
+            * exp(-ln(2) * extract(epoch FROM (now() AT TIME ZONE 'UTC' - timestamp)) / %(half_life_seconds)s)
+        DESC
+    LIMIT %(limit)s
+"""
+).format(
+    embedding=sql.Identifier(EMBEDDING_COLUMN),
+    indexed_distance=_INDEXED_DISTANCE,
+    current_messages=sql.SQL(_CURRENT_CONVERSATION_MESSAGES),
+)
+# Conversations sharing an entity or keyword with the message, looked up in the GIN indexes
+_TERM_MATCHES = """
+    SELECT conversation_id FROM entities WHERE names && %(terms)s::text[]
+    UNION SELECT conversation_id FROM keywords WHERE terms && %(terms)s::text[]
+"""
+# The nearest messages from conversations that share a term with the message come first, and the nearest messages
+# overall from the HNSW index fill any remaining places
+_PREFILTERED_RELEVANT_MESSAGES_QUERY = sql.SQL(
+    """
+    SELECT id, sender, content, timestamp FROM (
+        SELECT DISTINCT ON (id) * FROM (
+            (
+                SELECT m.id, m.sender, m.content, m.timestamp, 0 AS tier, m.{embedding} <=> %(embedding)s AS distance
+                FROM messages AS m INNER JOIN conversations_messages AS cm ON cm.message_id = m.id
+                WHERE cm.conversation_id IN ({matches}) AND m.user_id = %(user_id)s
+                    AND m.id NOT IN ({current_messages})
+                ORDER BY distance LIMIT %(limit)s
+            ) UNION ALL (
+                SELECT id, sender, content, timestamp, 1 AS tier, {embedding} <=> %(embedding)s AS distance
+                FROM messages WHERE user_id = %(user_id)s AND id NOT IN ({current_messages})
+                ORDER BY {indexed_distance} LIMIT %(candidates)s
+            )
+        ) AS candidates ORDER BY id, tier
+    ) AS ranked
+    ORDER BY tier, distance LIMIT %(limit)s
+"""
+).format(
+    embedding=sql.Identifier(EMBEDDING_COLUMN),
+    indexed_distance=_INDEXED_DISTANCE,
+    matches=sql.SQL(_TERM_MATCHES),
+    current_messages=sql.SQL(_CURRENT_CONVERSATION_MESSAGES),
+)
+# The user's topic clusters whose centroids are nearest the message
+_NEAREST_CLUSTERS = """
+    SELECT id FROM clusters WHERE user_id = %(user_id)s AND embedding_column = %(embedding_column)s
+    ORDER BY centroid <=> %(embedding)s LIMIT %(clusters)s
+"""
+# Ranks the messages of the nearest clusters' conversations, and of conversations that haven't been clustered yet, by
+# exact distance. Users without clusters get the HNSW search over their whole history instead.
+_CLUSTERED_RELEVANT_MESSAGES_QUERY = sql.SQL(
+    """
+    WITH nearest_clusters AS ({nearest_clusters}), scope AS (
+        SELECT conversation_id FROM cluster_members WHERE cluster_id IN (SELECT id FROM nearest_clusters)
+        UNION ALL
+        SELECT id FROM conversations WHERE user_id = %(user_id)s AND clustered_through IS NULL
+    )
+    SELECT id, sender, content, timestamp FROM (
+        (
+            SELECT m.id, m.sender, m.content, m.timestamp, m.{embedding} <=> %(embedding)s AS distance
+            FROM messages AS m INNER JOIN conversations_messages AS cm ON cm.message_id = m.id
+            WHERE cm.conversation_id IN (SELECT conversation_id FROM scope) AND m.user_id = %(user_id)s
+                AND m.id NOT IN ({current_messages}) AND EXISTS (SELECT 1 FROM nearest_clusters)
+            ORDER BY distance LIMIT %(limit)s
+        ) UNION ALL (
+            SELECT id, sender, content, timestamp, {embedding} <=> %(embedding)s AS distance FROM messages
+            WHERE user_id = %(user_id)s AND id NOT IN ({current_messages})
+                AND NOT EXISTS (SELECT 1 FROM nearest_clusters)
+            ORDER BY {indexed_distance} LIMIT %(candidates)s
+        )
+    ) AS candidates
+    ORDER BY distance LIMIT %(limit)s
+"""
+).format(
+    embedding=sql.Identifier(EMBEDDING_COLUMN),
+    indexed_distance=_INDEXED_DISTANCE,
+    nearest_clusters=sql.SQL(_NEAREST_CLUSTERS),
+    current_messages=sql.SQL(_CURRENT_CONVERSATION_MESSAGES),
+)
+if HYBRID_RETRIEVAL:
+    _RELEVANT_MESSAGES_QUERY = _HYBRID_RELEVANT_MESSAGES_QUERY
+elif ENTITY_PREFILTER:
+    _RELEVANT_MESSAGES_QUERY = _PREFILTERED_RELEVANT_MESSAGES_QUERY
+elif CLUSTER_RETRIEVAL:
+    _RELEVANT_MESSAGES_QUERY = _CLUSTERED_RELEVANT_MESSAGES_QUERY
+else:
+    _RELEVANT_MESSAGES_QUERY = _VECTOR_RELEVANT_MESSAGES_QUERY
+_VECTOR_RELATED_CONVERSATIONS_QUERY = sql.SQL(
+    """
+    SELECT id, summary, timestamp FROM (
+        SELECT id, summary, timestamp, {embedding} AS embedding FROM conversations
+        WHERE user_id = %(user_id)s AND summary IS NOT NULL
+        ORDER BY {indexed_distance} LIMIT %(candidates)s
+    ) AS candidates
+    ORDER BY embedding <=> %(embedding)s LIMIT %(limit)s
+"""
+).format(embedding=sql.Identifier(EMBEDDING_COLUMN), indexed_distance=_INDEXED_DISTANCE)
+_PREFILTERED_RELATED_CONVERSATIONS_QUERY = sql.SQL(
+    """
+    SELECT id, summary, timestamp FROM (
+        SELECT DISTINCT ON (id) * FROM (
+            (
+                SELECT id, summary, timestamp, 0 AS tier, {embedding} <=> %(embedding)s AS distance
+                FROM conversations WHERE user_id = %(user_id)s AND summary IS NOT NULL AND id IN ({matches})
+                ORDER BY distance LIMIT %(limit)s
+            ) UNION ALL (
+                SELECT id, summary, timestamp, 1 AS tier, {embedding} <=> %(embedding)s AS distance
+                FROM conversations WHERE user_id = %(user_id)s AND summary IS NOT NULL
+                ORDER BY {indexed_distance} LIMIT %(candidates)s
+            )
+        ) AS candidates ORDER BY id, tier
+    ) AS ranked
+    ORDER BY tier, distance LIMIT %(limit)s
+"""
+).format(embedding=sql.Identifier(EMBEDDING_COLUMN), indexed_distance=_INDEXED_DISTANCE, matches=sql.SQL(_TERM_MATCHES))
+# Ranks the nearest clusters' conversations, and the conversations that haven't been clustered yet, by exact
+# distance, falling back to the HNSW search without clusters
+_CLUSTERED_RELATED_CONVERSATIONS_QUERY = sql.SQL(
+    """
+    WITH nearest_clusters AS ({nearest_clusters}), scope AS (
+        SELECT conversation_id FROM cluster_members WHERE cluster_id IN (SELECT id FROM nearest_clusters)
+        UNION ALL
+        SELECT id FROM conversations WHERE user_id = %(user_id)s AND clustered_through IS NULL
+    )
+    SELECT id, summary, timestamp FROM (
+        (
+            SELECT id, summary, timestamp, {embedding} <=> %(embedding)s AS distance FROM conversations
+            WHERE id IN (SELECT conversation_id FROM scope) AND user_id = %(user_id)s AND summary IS NOT NULL
+                AND EXISTS (SELECT 1 FROM nearest_clusters)
+            ORDER BY distance LIMIT %(limit)s
+        ) UNION ALL (
+            SELECT id, summary, timestamp, {embedding} <=> %(embedding)s AS distance FROM conversations
+            WHERE user_id = %(user_id)s AND summary IS NOT NULL AND NOT EXISTS (SELECT 1 FROM nearest_clusters)
+            ORDER BY {indexed_distance} LIMIT %(candidates)s
+        )
+    ) AS candidates
+    ORDER BY distance LIMIT %(limit)s
+"""
+).format(
+    embedding=sql.Identifier(EMBEDDING_COLUMN),
+    indexed_distance=_INDEXED_DISTANCE,
+    nearest_clusters=sql.SQL(_NEAREST_CLUSTERS),
+)
+if ENTITY_PREFILTER:
+    _RELATED_CONVERSATIONS_QUERY = _PREFILTERED_RELATED_CONVERSATIONS_QUERY
+elif CLUSTER_RETRIEVAL:
+    _RELATED_CONVERSATIONS_QUERY = _CLUSTERED_RELATED_CONVERSATIONS_QUERY
+else:
+    _RELATED_CONVERSATIONS_QUERY = _VECTOR_RELATED_CONVERSATIONS_QUERY
+_RETRIEVAL_MODES = {
+    "HYBRID_RETRIEVAL": HYBRID_RETRIEVAL,
+    "ENTITY_PREFILTER": ENTITY_PREFILTER,
+    "CLUSTER_RETRIEVAL": CLUSTER_RETRIEVAL,
+}
+if sum(_RETRIEVAL_MODES.values()) > 1:
+    # The modes don't combine, so all but the first one set are ignored for each search
+    logger.warning(
+        "%s are set together, but only one applies to each search: similar messages use %s and related "
+        "conversations use %s",
+        ", ".join(mode for mode, enabled in _RETRIEVAL_MODES.items() if enabled),
+        next(mode for mode, enabled in _RETRIEVAL_MODES.items() if enabled),
+        "ENTITY_PREFILTER" if ENTITY_PREFILTER else "CLUSTER_RETRIEVAL",
+    )
 
-def format_message_log(messages: list[tuple[int, str, str, datetime, int]]) -> list[str]:
-    # message_tuple[1] is the sender, message_tuple[4] is minutes ago, message_tuple[2] is the content
-    return [
-        f"{message_tuple[1]} [{Arrow.fromdatetime(message_tuple[3]).humanize()}]:\n{message_tuple[2]}"
-        for message_tuple in messages
-    ]
 
+def get_formatted_context(
+    message: str,
+    timings: dict[str, float] | None = None,
+    token_counts: dict[str, int] | None = None,
+    retrieved_ids: dict[str, list] | None = None,
+    user_id: str = DEFAULT_USER_ID,
+    session_id: str = DEFAULT_SESSION_ID,
+) -> str:
+    """
+    Builds the context block for a user message from the ongoing conversation and similar memories.
 
-def get_formatted_context(message):
-    conversational_context = get_immediate_conversational_context()
-    relevant_messages = get_relevant_messages_by_vector_similarity(message)
-    related_convos = get_related_conversations_by_vector_similarity(message) or NONE_AVAILABLE
+    Each section is kept within its token budget. Related conversations and similar messages keep their best matches,
+    and the current conversation drops its oldest turns.
 
-    # Remove "relevant messages" that are already in conversational context
-    to_remove = {m[0] for m in conversational_context}.intersection({m[0] for m in relevant_messages})
-    ready_relevant_messages = (
-        format_message_log(sorted([m for m in relevant_messages if m[0] not in to_remove], key=lambda m: m[3]))
-        or NONE_AVAILABLE
+    Args:
+        message (str): The user's message.
+        timings (dict[str, float] | None): If given, filled with the seconds spent in each stage of context building.
+        token_counts (dict[str, int] | None): If given, filled with the tokens used by each section and in total.
+        retrieved_ids (dict[str, list] | None): If given, filled with the ids of the similar messages and related
+            conversations that were retrieved, and of the current conversation.
+        user_id (str): The user whose memories are searched.
+        session_id (str): The user's session, whose ongoing conversation is the current conversation.
+
+    Returns:
+        str: The formatted context.
+    """
+    timings = timings if timings is not None else {}
+    token_counts = token_counts if token_counts is not None else {}
+    conversational_context, relevant_messages, related_convos = get_context_records(
+        message, timings=timings, retrieved_ids=retrieved_ids, user_id=user_id, session_id=session_id
     )
-    ready_conversational_context = format_message_log(conversational_context)
-    ready_conversational_context = ready_conversational_context or ["Starting a new conversation."]
 
-    # Format the deduplicated and sorted messages.
+    start = time.perf_counter()
+    ready_related_convos, convos_tokens = _fit_to_budget(related_convos, RELATED_CONVERSATIONS_TOKEN_BUDGET)
+    # Similar messages arrive most similar first, so the best ones are kept and then shown in the order they were sent
+    fitted_messages, messages_tokens = _fit_to_budget(
+        format_message_log(relevant_messages), SIMILAR_MESSAGES_TOKEN_BUDGET
+    )
+    ready_relevant_messages = [
+        formatted for _, formatted in sorted(zip(relevant_messages, fitted_messages), key=lambda pair: pair[0][3])
+    ]
+
+    current_budget = CURRENT_CONVERSATION_TOKEN_BUDGET
+    if current_budget > 0:
+        current_budget += max(RELATED_CONVERSATIONS_TOKEN_BUDGET - convos_tokens, 0)
+        current_budget += max(SIMILAR_MESSAGES_TOKEN_BUDGET - messages_tokens, 0)
+    # Fill the budget from the newest turn backwards so the oldest turns are the ones dropped
+    newest_first, _ = _fit_to_budget(format_message_log(conversational_context)[::-1], current_budget)
+    ready_conversational_context = newest_first[::-1]
+    if len(ready_conversational_context) < len(conversational_context):
+        omitted = len(conversational_context) - len(ready_conversational_context)
+        ready_conversational_context.insert(0, OMITTED_MESSAGES_TEMPLATE.format(count=omitted))
+
+    sections = {
+        "related_conversations": ENTRY_SEPARATOR.join(ready_related_convos or NONE_AVAILABLE),
+        "similar_messages": ENTRY_SEPARATOR.join(ready_relevant_messages or NONE_AVAILABLE),
+        "current_conversation": ENTRY_SEPARATOR.join(ready_conversational_context or ["Starting a new conversation."]),
+    }
     context = CONVO_CONTEXT_TEMPLATE.format(
-        convos="\n---\n".join(related_convos),
-        messages="\n---\n".join(ready_relevant_messages),
-        current="\n---\n".join(ready_conversational_context),
+        convos=sections["related_conversations"],
+        messages=sections["similar_messages"],
+        current=sections["current_conversation"],
     )
+    for section, text in sections.items():
+        token_counts[section] = count_tokens(text)
+    token_counts["total"] = count_tokens(context)
+    _record_stage(timings, "format", start)
 
     return context
 
 
-def get_immediate_conversational_context() -> list[tuple[int, str, str, datetime, int]]:
-    """Retrieves the most recent conversational context from the database within a specified time window."""
+def _fit_to_budget(entries: list[str], budget: int) -> tuple[list[str], int]:
+    """
+    Takes entries in priority order until the token budget is spent.
+
+    An entry that doesn't fit ends the section, except for the first one, which is shortened to fit instead so a single
+    long entry can't empty the section.
+
+    Args:
+        entries (list[str]): The formatted entries, highest priority first.
+        budget (int): The most tokens the entries and their separators may use, or 0 for no limit.
+
+    Returns:
+        tuple[list[str], int]: The entries that fit, in the same order, and the tokens they use.
+    """
+    separator_tokens = count_tokens(ENTRY_SEPARATOR)
+    kept, used = [], 0
+    for entry in entries:
+        tokens = count_tokens(entry) + (separator_tokens if kept else 0)
+        if budget > 0 and used + tokens > budget:
+            if not kept:
+                entry = truncate_to_tokens(entry, budget - count_tokens(TRUNCATED_MARKER)) + TRUNCATED_MARKER
+                kept.append(entry)
+                used = count_tokens(entry)
+            break
+        kept.append(entry)
+        used += tokens
+    return kept, used
+
+
+def get_layered_context(
+    message: str,
+    timings: dict[str, float] | None = None,
+    token_counts: dict[str, int] | None = None,
+    retrieved_ids: dict[str, list] | None = None,
+    user_id: str = DEFAULT_USER_ID,
+    session_id: str = DEFAULT_SESSION_ID,
+) -> tuple[list[tuple[int, str, str, datetime, int]], str]:
+    """
+    Builds the context for a user message as the current conversation's history and a separate block of memories.
+
+    Unlike `get_formatted_context`, the history is the whole current conversation rather than a sliding time window,
+    and it is trimmed in steps of HISTORY_TRIM_STEP messages. The history therefore changes only by growing at the end
+    from one turn to the next, which lets it be sent as a stable, cacheable prefix ahead of the memories.
+
+    Args:
+        message (str): The user's message.
+        timings (dict[str, float] | None): If given, filled with the seconds spent in each stage of context building.
+        token_counts (dict[str, int] | None): If given, filled with the tokens used by each section and in total.
+        retrieved_ids (dict[str, list] | None): If given, filled with the ids of the similar messages and related
+            conversations that were retrieved, and of the current conversation.
+        user_id (str): The user whose memories are searched.
+        session_id (str): The user's session, whose ongoing conversation is the current conversation.
+
+    Returns:
+        tuple: The conversation history, oldest first, and the formatted memories.
+    """
+    timings = timings if timings is not None else {}
+    token_counts = token_counts if token_counts is not None else {}
+    history, relevant_messages, related_convos = get_context_records(
+        message,
+        timings=timings,
+        whole_conversation=True,
+        retrieved_ids=retrieved_ids,
+        user_id=user_id,
+        session_id=session_id,
+    )
+
+    start = time.perf_counter()
+    ready_related_convos, _ = _fit_to_budget(related_convos, RELATED_CONVERSATIONS_TOKEN_BUDGET)
+    history = _trim_history(history, CURRENT_CONVERSATION_TOKEN_BUDGET)
+    fitted_messages, _ = _fit_to_budget(format_message_log(relevant_messages), SIMILAR_MESSAGES_TOKEN_BUDGET)
+    ready_relevant_messages = [
+        formatted for _, formatted in sorted(zip(relevant_messages, fitted_messages), key=lambda pair: pair[0][3])
+    ]
+
+    sections = {
+        "related_conversations": ENTRY_SEPARATOR.join(ready_related_convos or NONE_AVAILABLE),
+        "similar_messages": ENTRY_SEPARATOR.join(ready_relevant_messages or NONE_AVAILABLE),
+    }
+    memory_context = MEMORY_CONTEXT_TEMPLATE.format(
+        convos=sections["related_conversations"], messages=sections["similar_messages"]
+    )
+    for section, text in sections.items():
+        token_counts[section] = count_tokens(text)
+    token_counts["current_conversation"] = sum(count_tokens(m[2]) for m in history)
+    token_counts["total"] = count_tokens(memory_context) + token_counts["current_conversation"]
+    _record_stage(timings, "format", start)
+
+    return history, memory_context
+
+
+def _trim_history(
+    history: list[tuple[int, str, str, datetime, int]], budget: int
+) -> list[tuple[int, str, str, datetime, int]]:
+    """Drops the oldest messages, HISTORY_TRIM_STEP at a time, until the rest fit in the token budget"""
+    if budget <= 0:
+        return history
+    tokens = [count_tokens(m[2]) for m in history]
+    dropped, total = 0, sum(tokens)
+    while total > budget and dropped < len(history):
+        total -= tokens[dropped]
+        dropped += 1
+    if dropped:
+        step = max(HISTORY_TRIM_STEP, 1)
+        dropped = min(-(-dropped // step) * step, len(history) - 1)
+    return history[dropped:]
+
+
+def get_context_records(
+    message: str,
+    query_embedding: list[float] | None = None,
+    timings: dict[str, float] | None = None,
+    whole_conversation: bool = False,
+    retrieved_ids: dict[str, list] | None = None,
+    user_id: str = DEFAULT_USER_ID,
+    session_id: str = DEFAULT_SESSION_ID,
+) -> tuple[list[tuple[int, str, str, datetime, int]], list[tuple[int, str, str, datetime, int]], list[str]]:
+    """
+    Retrieves the immediate conversational context, similar messages and related conversations in one round trip.
+
+    The three queries are sent together in a pipeline over a single pooled connection, so the database works through
+    them back to back instead of waiting on the client between queries.
+
+    Args:
+        message (str): The user's message, used for the similarity searches.
+        query_embedding (list[float] | None): The message's embedding, if it has already been computed.
+        timings (dict[str, float] | None): If given, filled with the seconds spent in each stage.
+        whole_conversation (bool): Return every message of the current conversation instead of only those within
+            CONTEXT_TIME_WINDOW_MINUTES.
+        retrieved_ids (dict[str, list] | None): If given, filled with the ids of the similar messages under
+            "messages", of the related conversations under "conversations" and of the session's current
+            conversation, if it has one, under "current_conversation". Left empty while the session's first
+            messages are still queued for writing.
+        user_id (str): The user whose messages and conversations are searched.
+        session_id (str): The user's session, whose messages make up the immediate conversational context.
+
+    Returns:
+        tuple: The immediate conversational context, the similar messages, and the related conversation summaries.
+    """
+    timings = timings if timings is not None else {}
+    retrieved_ids = retrieved_ids if retrieved_ids is not None else {}
+    conversational_context, relevant_messages, related_convos = [], [], []
+
+    start = time.perf_counter()
+    if query_embedding is None:
+        query_embedding = get_embedding(message)
+    _record_stage(timings, "embedding", start)
+
+    # Snapshot queued messages before reading, so a message written in between shows up at least once
+    pending_messages = get_pending_messages(user_id, session_id)
+    pool = get_connection_pool()
+    if pool:
+        try:
+            start = time.perf_counter()
+            with pool.connection() as conn:
+                start = _record_stage(timings, "connection", start)
+                embedding = np.array(query_embedding)
+                with (
+                    conn.pipeline(),
+                    conn.cursor() as window_cur,
+                    conn.cursor() as messages_cur,
+                    conn.cursor() as convos_cur,
+                    conn.cursor() as conversation_cur,
+                ):
+                    _tune_vector_search(conn)
+                    _execute_window_query(window_cur, whole_conversation, _time_window_start(), user_id, session_id)
+                    messages_cur.execute(
+                        _RELEVANT_MESSAGES_QUERY,
+                        _relevant_messages_params(message, embedding, user_id, session_id),
+                        prepare=True,
+                    )
+                    convos_cur.execute(
+                        _RELATED_CONVERSATIONS_QUERY,
+                        _related_conversations_params(message, embedding, user_id),
+                        prepare=True,
+                    )
+                    conversation_cur.execute(
+                        _CURRENT_CONVERSATION_ID_QUERY,
+                        {"user_id": user_id, "session_id": session_id, "since": _current_conversation_since()},
+                        prepare=True,
+                    )
+                    # Results arrive in order, so each stage is the extra time spent waiting on its result
+                    current_time = datetime.now(timezone.utc)
+                    conversational_context = _message_records(window_cur.fetchall(), current_time)
+                    start = _record_stage(timings, "time_window", start)
+                    relevant_messages = _message_records(messages_cur.fetchall(), current_time)
+                    start = _record_stage(timings, "message_knn", start)
+                    convo_rows = convos_cur.fetchall()
+                    related_convos = _conversation_summaries(convo_rows)
+                    _record_stage(timings, "conversation_knn", start)
+                    current_conversation = conversation_cur.fetchone()
+                    # The conversation is identified rather than its messages, so the same question asked again
+                    # within it retrieves the same ids even though the conversation has grown in between. A session
+                    # whose first messages are still queued has no conversation to identify yet, and no ids.
+                    if current_conversation is not None or not pending_messages:
+                        retrieved_ids["messages"] = [m[0] for m in relevant_messages]
+                        retrieved_ids["conversations"] = [row[0] for row in convo_rows]
+                        retrieved_ids["current_conversation"] = list(current_conversation or ())
+        except Exception as e:
+            logger.error("Error retrieving context records: %s", e)
+            # A failed similarity search aborts the whole pipeline, so the conversation is read again on its own
+            # rather than leaving the prompt without it
+            if not conversational_context:
+                conversational_context = _retrieve_conversation_window(whole_conversation, user_id, session_id)
+    return _with_pending(conversational_context, pending_messages), relevant_messages, related_convos
+
+
+def _execute_window_query(cur, whole_conversation: bool, window_start: datetime, user_id: str, session_id: str) -> None:
+    """Runs the query for the current conversation, or for the session's messages since `window_start`"""
+    session = {"user_id": user_id, "session_id": session_id}
+    if whole_conversation:
+        cur.execute(_CURRENT_CONVERSATION_QUERY, session | {"since": _current_conversation_since()}, prepare=True)
+    else:
+        cur.execute(_IMMEDIATE_CONTEXT_QUERY, session | {"window_start": window_start}, prepare=True)
+
+
+def _retrieve_conversation_window(
+    whole_conversation: bool, user_id: str, session_id: str
+) -> list[tuple[int, str, str, datetime, int]]:
+    """Reads the immediate conversational context by itself, without the similarity searches"""
+    pool = get_connection_pool()
+    if pool:
+        try:
+            with pool.connection() as conn, conn.cursor() as cur:
+                _execute_window_query(cur, whole_conversation, _time_window_start(), user_id, session_id)
+                return _message_records(cur.fetchall(), datetime.now(timezone.utc))
+        except Exception as e:
+            logger.error("Error retrieving the current conversation: %s", e)
+    return []
+
+
+def _with_pending(
+    messages: list[tuple[int, str, str, datetime, int]], pending_messages: list[tuple[None, str, str, datetime, int]]
+) -> list[tuple[int | None, str, str, datetime, int]]:
+    """Appends queued messages that were not yet in the database when it was read"""
+    written = {(m[1], m[2], m[3]) for m in messages}
+    return messages + [m for m in pending_messages if (m[1], m[2], m[3]) not in written]
+
+
+def _time_window_start() -> datetime:
+    """Returns the start of the immediate conversational context window as naive UTC, like stored timestamps"""
+    return datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(minutes=CONTEXT_TIME_WINDOW_MINUTES)
+
+
+def _current_conversation_since() -> datetime:
+    """Returns the earliest last activity, as naive UTC, of a conversation that is still current"""
+    return datetime.now(timezone.utc).replace(tzinfo=None) - CONVO_THRESHOLD
+
+
+def _tune_vector_search(conn) -> None:
+    """Sets the HNSW search parameters for the rest of the transaction
+
+    Each setting runs on its own cursor, so in pipeline mode its result can't be mistaken for a query's.
+    """
+    ef_search = max(HNSW_EF_SEARCH, HYBRID_CANDIDATES if HYBRID_RETRIEVAL else _INDEX_CANDIDATES)
+    conn.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(ef_search),), prepare=True)
+    if HNSW_ITERATIVE_SCAN != "off" and (get_vector_extension_version() or ()) >= _ITERATIVE_SCAN_VERSION:
+        conn.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", (HNSW_ITERATIVE_SCAN,), prepare=True)
+
+
+def _relevant_messages_params(
+    query_string: str, embedding: np.ndarray, user_id: str = DEFAULT_USER_ID, session_id: str = DEFAULT_SESSION_ID
+) -> dict:
+    """Parameters for `_RELEVANT_MESSAGES_QUERY`"""
+    return {
+        "user_id": user_id,
+        "session_id": session_id,
+        "since": _current_conversation_since(),
+        "query": query_string,
+        "terms": query_terms(query_string) if ENTITY_PREFILTER else [],
+        "embedding": embedding,
+        "limit": TOP_K_SIMILAR_MESSAGES,
+        "candidates": HYBRID_CANDIDATES if HYBRID_RETRIEVAL else _INDEX_CANDIDATES,
+        "vector_weight": HYBRID_VECTOR_WEIGHT,
+        "text_weight": HYBRID_TEXT_WEIGHT,
+        "recency_weight": HYBRID_RECENCY_WEIGHT,
+        "half_life_seconds": HYBRID_RECENCY_HALF_LIFE_DAYS * 86400,
+        "clusters": CLUSTER_PROBES,
+        "embedding_column": EMBEDDING_COLUMN,
+    }
+
+
+def _related_conversations_params(query_string: str, embedding: np.ndarray, user_id: str = DEFAULT_USER_ID) -> dict:
+    """Parameters for `_RELATED_CONVERSATIONS_QUERY`"""
+    return {
+        "user_id": user_id,
+        "terms": query_terms(query_string) if ENTITY_PREFILTER else [],
+        "embedding": embedding,
+        "limit": TOP_K_SIMILAR_MESSAGES,
+        "candidates": _INDEX_CANDIDATES,
+        "clusters": CLUSTER_PROBES,
+        "embedding_column": EMBEDDING_COLUMN,
+    }
+
+
+def _record_stage(timings: dict[str, float], stage: str, start: float) -> float:
+    """Records the seconds elapsed since `start` for a stage and returns the current time for the next stage
+
+    The stage is also exported to the metrics endpoint as "context.<stage>".
+    """
+    now = time.perf_counter()
+    timings[stage] = now - start
+    observe(f"context.{stage}", timings[stage])
+    return now
+
+
+def _message_records(rows, current_time: datetime) -> list[tuple[int, str, str, datetime, int]]:
+    """Converts message rows to (id, sender, content, timestamp, minutes ago) tuples"""
+    return [
+        (
+            row[0],
+            row[1],
+            row[2],
+            row[3],
+            int((current_time - row[3].replace(tzinfo=timezone.utc)).total_seconds() / 60),
+        )
+        for row in rows
+    ]
+
+
+def _conversation_summaries(rows) -> list[str]:
+    """Formats conversation rows as summaries for the prompt"""
+    return [
+        f"Conversation ID: {row[0]} [{Arrow.fromdatetime(row[2].replace(tzinfo=timezone.utc)).humanize()}]\nSummary:\n{row[1]}"
+        for row in rows
+    ]
+
+
+def get_immediate_conversational_context(
+    user_id: str = DEFAULT_USER_ID, session_id: str = DEFAULT_SESSION_ID
+) -> list[tuple[int, str, str, datetime, int]]:
+    """Retrieves a session's most recent conversational context from the database within a specified time window.
+
+    Messages that are still queued for writing are included at the end.
+    """
+    pending_messages = get_pending_messages(user_id, session_id)
     pool = get_connection_pool()
     messages = []
     if pool:
         try:
             with pool.connection() as conn:
-                register_vector(conn)
                 with conn.cursor() as cur:
-                    time_threshold = datetime.now(timezone.utc) - timedelta(minutes=CONTEXT_TIME_WINDOW_MINUTES)
                     cur.execute(
-                        "SELECT id, sender, content, timestamp FROM messages WHERE timestamp >= %s ORDER BY timestamp ASC",
-                        (time_threshold,),
+                        _IMMEDIATE_CONTEXT_QUERY,
+                        {"user_id": user_id, "session_id": session_id, "window_start": _time_window_start()},
                     )
-                    current_time = datetime.now(timezone.utc)
-                    messages = [
-                        (
-                            row[0],
-                            row[1],
-                            row[2],
-                            row[3],
-                            int((current_time - row[3].replace(tzinfo=timezone.utc)).total_seconds() / 60),
-                        )
-                        for row in cur.fetchall()
-                    ]
+                    messages = _message_records(cur.fetchall(), datetime.now(timezone.utc))
         except Exception as e:
-            print(f"Error retrieving immediate conversational context: {e}")
-    return messages
+            logger.error("Error retrieving immediate conversational context: %s", e)
+    return _with_pending(messages, pending_messages)
 
 
-def get_related_conversations_by_vector_similarity(query_string: str) -> list[str]:
-    """Retrieves conversations most relevant to the query string using vector similarity"""
+def get_related_conversations_by_vector_similarity(
+    query_string: str, query_embedding: list[float] | None = None, user_id: str = DEFAULT_USER_ID
+) -> list[str]:
+    """Retrieves the user's conversations most relevant to the query string using vector similarity"""
     pool = get_connection_pool()
     conversations = []
     if pool:
         try:
             with pool.connection() as conn:
-                register_vector(conn)
-                query_embedding = get_embedding(query_string)
+                if query_embedding is None:
+                    query_embedding = get_embedding(query_string)
                 with conn.cursor() as cur:
+                    _tune_vector_search(conn)
                     cur.execute(
-                        "SELECT id, summary, timestamp FROM conversations WHERE summary IS NOT NULL ORDER BY embedding <-> %s LIMIT %s",
-                        (np.array(query_embedding), TOP_K_SIMILAR_MESSAGES),
+                        _RELATED_CONVERSATIONS_QUERY,
+                        _related_conversations_params(query_string, np.array(query_embedding), user_id),
                     )
-                    conversations = [
-                        f"Conversation ID: {row[0]} [{Arrow.fromdatetime(row[2].replace(tzinfo=timezone.utc)).humanize()}]\nSummary:\n{row[1]}"
-                        for row in cur.fetchall()
-                    ]
+                    conversations = _conversation_summaries(cur.fetchall())
         except Exception as e:
-            print(f"Error retrieving related conversations by vector similarity: {e}")
+            logger.error("Error retrieving related conversations by vector similarity: %s", e)
     return conversations
 
 
-def get_relevant_messages_by_vector_similarity(query_string: str) -> list[tuple[int, str, str, datetime, int]]:
-    """Retrieves messages most relevant to the query string using vector similarity."""
+def get_relevant_messages_by_vector_similarity(
+    query_string: str,
+    query_embedding: list[float] | None = None,
+    user_id: str = DEFAULT_USER_ID,
+    session_id: str = DEFAULT_SESSION_ID,
+) -> list[tuple[int, str, str, datetime, int]]:
+    """Retrieves the user's messages most relevant to the query string using vector similarity.
+
+    Messages of the session's current conversation are excluded. With HYBRID_RETRIEVAL, full-text
+    relevance and recency are blended into the ranking, and with CLUSTER_RETRIEVAL only the nearest topic clusters
+    are searched.
+    """
     pool = get_connection_pool()
     messages = []
     if pool:
         try:
             with pool.connection() as conn:
-                register_vector(conn)
-                query_embedding = get_embedding(query_string)
+                if query_embedding is None:
+                    query_embedding = get_embedding(query_string)
                 with conn.cursor() as cur:
+                    _tune_vector_search(conn)
                     cur.execute(
-                        "SELECT id, sender, content, timestamp FROM messages ORDER BY embedding <-> %s LIMIT %s",
-                        (np.array(query_embedding), TOP_K_SIMILAR_MESSAGES),
+                        _RELEVANT_MESSAGES_QUERY,
+                        _relevant_messages_params(query_string, np.array(query_embedding), user_id, session_id),
                     )
-                    current_time = datetime.now(timezone.utc)
-                    messages = [
-                        (
-                            row[0],
-                            row[1],
-                            row[2],
-                            row[3],
-                            int((current_time - row[3].replace(tzinfo=timezone.utc)).total_seconds() / 60),
-                        )
-                        for row in cur.fetchall()
-                    ]
+                    messages = _message_records(cur.fetchall(), datetime.now(timezone.utc))
         except Exception as e:
-            print(f"Error retrieving relevant messages by vector similarity: {e}")
+            logger.error("Error retrieving relevant messages by vector similarity: %s", e)
     # Return the list of formatted messages (or an empty list if an error occurred)
     return messages
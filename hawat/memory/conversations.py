@@ -1,137 +1,346 @@
-from collections import defaultdict
+import logging
+import threading
 from datetime import datetime, timedelta, timezone
 
 import numpy as np
-from pgvector.psycopg import register_vector
+import psycopg
+from psycopg import sql
 
-from hawat.embeddings import get_embedding
-from hawat.memory.context import format_message_log
-from hawat.memory.schema import get_connection_pool
+from hawat.embeddings import EMBEDDING_COLUMN, embedded_through_column, get_embedding, get_embeddings
+from hawat.memory.formatting import format_message_log
+from hawat.memory.schema import (
+    CONVERSATION_ACTIVITY_CHANNEL,
+    DEFAULT_SESSION_ID,
+    DEFAULT_USER_ID,
+    get_connection_pool,
+    get_conninfo,
+    get_written_embedding_models,
+)
 
-CONVO_THRESHOLD = timedelta(minutes=30)
+logger = logging.getLogger(__name__)
 
+CONVO_THRESHOLD = timedelta(minutes=30)
+SUMMARY_LEASE = timedelta(minutes=10)  # How long a claimed conversation is reserved for the worker summarizing it
 
-def _most_recent_message() -> datetime:
-    """Retrieves the timestamp of the most recent message from the PostgreSQL database"""
-    try:
-        pool = get_connection_pool()
-        if pool:
-            with pool.connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT timestamp FROM messages ORDER BY id DESC LIMIT 1")
-                    result = cur.fetchone()
-                    if result:
-                        return result[0]
-        return None  # Return None if no message found or error
-    except Exception as e:
-        print(f"Error retrieving most recent message timestamp: {e}")
-        return None
+# Returns the session's most recently active conversation if it is recent enough, otherwise inserts and returns a new
+# one. A new conversation's activity starts at the message it was created for, so it is found by the next lookup even
+# before that message is written.
+_RESOLVE_CONVERSATION_QUERY = """
+    WITH latest AS (
+        SELECT id, last_message_at FROM conversations
+        WHERE user_id = %(user_id)s AND session_id = %(session_id)s AND last_message_at IS NOT NULL
+        ORDER BY last_message_at DESC LIMIT 1
+    ), created AS (
+        INSERT INTO conversations (summary, timestamp, last_message_at, user_id, session_id)
+        SELECT NULL, NULL, %(timestamp)s, %(user_id)s, %(session_id)s
+        WHERE NOT EXISTS (SELECT 1 FROM latest WHERE last_message_at >= %(since)s)
+        RETURNING id
+    )
+    SELECT id FROM latest WHERE last_message_at >= %(since)s
+    UNION ALL
+    SELECT id FROM created
+"""
+# Arbitrary key for the advisory locks that serialize conversation creation, paired with a hash of the session. Two
+# sessions whose hashes collide only wait on each other.
+_CONVERSATION_LOCK_KEY = 4_281_766
 
+# The conversation currently in progress in each session and the time of its latest message, as
+# {(user id, session id): (conversation id, naive UTC datetime)}
+_current_conversations = {}
+# A lock per session, held while its conversation is resolved in the database, so lookups for the same session wait
+# for one resolution while other sessions go ahead
+_session_locks = {}
+# Guards both dicts. It is never held across a database round trip.
+_current_conversation_lock = threading.Lock()
 
-def _most_recent_conversation_id() -> int:
-    """Retrieves the greatest ID value from the conversations table in the PostgreSQL database"""
-    try:
-        pool = get_connection_pool()
-        if pool:
-            with pool.connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT id FROM conversations ORDER BY id DESC LIMIT 1")
-                    result = cur.fetchone()
-                    if result:
-                        return result[0]
-        return None  # Return None if no conversation found or error
-    except Exception as e:
-        print(f"Error retrieving most recent conversation id: {e}")
-        return None
 
+def _resolve_current_conversation(timestamp: datetime, user_id: str, session_id: str) -> int | None:
+    """Finds the conversation that is current at `timestamp` in a session in the database, creating one if none is
 
-def _record_new_conversation():
+    The lookup and the insert run as one statement inside a transaction holding the session's advisory lock, so
+    concurrent writers, including other Hawat processes, agree on a single new conversation instead of each creating
+    one, while other sessions go ahead.
+    """
     pool = get_connection_pool()
     if pool:
         try:
             with pool.connection() as conn:
-                register_vector(conn)
                 with conn.cursor() as cur:
                     cur.execute(
-                        """INSERT INTO conversations (summary, embedding, timestamp) VALUES (%s, %s, %s)""",
-                        (
-                            None,
-                            None,
-                            None,
-                        ),
+                        "SELECT pg_advisory_xact_lock(%s, hashtext(%s))",
+                        (_CONVERSATION_LOCK_KEY, f"{user_id}/{session_id}"),
+                        prepare=True,
+                    )
+                    cur.execute(
+                        _RESOLVE_CONVERSATION_QUERY,
+                        {
+                            "since": timestamp - CONVO_THRESHOLD,
+                            "timestamp": timestamp,
+                            "user_id": user_id,
+                            "session_id": session_id,
+                        },
+                        prepare=True,
                     )
+                    result = cur.fetchone()
                 conn.commit()
-                print(f"Successfully created new conversation")
+                if result:
+                    return result[0]
         except Exception as e:
-            print(f"Error recording message to database: {e}")
+            logger.error("Error resolving current conversation: %s", e)
+    return None
 
 
-def get_current_conversation_id() -> int:
-    """Retrieves the ID of the current conversation from the database
+def get_current_conversation_id(
+    timestamp: datetime | None = None, user_id: str = DEFAULT_USER_ID, session_id: str = DEFAULT_SESSION_ID
+) -> int:
+    """Retrieves the ID of a session's current conversation
 
     A conversation is current if the most recent message associated with that conversation is less than CONVO_THRESHOLD minutes old.
     If no conversation is current then a new conversation should be created and its ID returned.
 
+    Each session's active conversation and the time of its latest activity are tracked in-process, so the database is
+    only consulted when the tracked conversation has gone stale. Only lookups for the same session wait for each
+    other while it is consulted.
+
+    Args:
+        timestamp (datetime | None): When the message being recorded was sent, aware or naive UTC. Defaults to now.
+        user_id (str): The user the message belongs to.
+        session_id (str): The user's session the message was sent in.
+
     Returns:
         int: id of the current conversation
     """
-    current_time = datetime.now(timezone.utc)
-    most_recent_message = _most_recent_message()
-    if most_recent_message and ((current_time - most_recent_message.replace(tzinfo=timezone.utc)) < CONVO_THRESHOLD):
-        conversation_id = _most_recent_conversation_id()
-        if conversation_id:
+    timestamp = timestamp or datetime.now(timezone.utc)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    session = (user_id, session_id)
+    with _current_conversation_lock:
+        conversation_id = _tracked_conversation_id(session, timestamp)
+        if conversation_id is not None:
             return conversation_id
-    _record_new_conversation()
-    return _most_recent_conversation_id()
+        session_lock = _session_locks.setdefault(session, threading.Lock())
+    with session_lock:
+        # Another lookup may have resolved the conversation while this one waited for the session
+        with _current_conversation_lock:
+            conversation_id = _tracked_conversation_id(session, timestamp)
+            if conversation_id is not None:
+                return conversation_id
+        conversation_id = _resolve_current_conversation(timestamp, user_id, session_id)
+        with _current_conversation_lock:
+            # Forget sessions that have gone quiet, so the tracking doesn't grow with every session ever seen
+            for stale in [
+                key for key, (_, last) in _current_conversations.items() if timestamp - last >= CONVO_THRESHOLD
+            ]:
+                del _current_conversations[stale]
+            for idle in [
+                key
+                for key, lock in _session_locks.items()
+                if key != session and key not in _current_conversations and not lock.locked()
+            ]:
+                del _session_locks[idle]
+            if conversation_id:
+                _current_conversations[session] = (conversation_id, timestamp)
+        return conversation_id
 
 
-def get_unsummarized_conversations() -> tuple[dict[int, list[str]], dict[int, datetime]]:
+def _tracked_conversation_id(session: tuple[str, str], timestamp: datetime) -> int | None:
+    """Returns the session's tracked conversation if it is still current at `timestamp`, noting the activity
+
+    Must be called with `_current_conversation_lock` held.
+    """
+    if session in _current_conversations:
+        conversation_id, last_activity = _current_conversations[session]
+        if timestamp - last_activity < CONVO_THRESHOLD:
+            _current_conversations[session] = (conversation_id, max(last_activity, timestamp))
+            return conversation_id
+    return None
+
+
+def get_unsummarized_conversation_ids(idle_for: timedelta | None = None) -> list[int]:
+    """Retrieves the ids of conversations that have messages newer than their summary and aren't claimed
+
+    This is an index lookup on `conversations_unsummarized_idx`, so it costs the same however long the history is.
+
+    Args:
+        idle_for (timedelta | None): Only include conversations whose latest message is at least this old.
+    """
     pool = get_connection_pool()
-    messages = []
+    conversation_ids = []
     if pool:
         try:
+            idle_since = datetime.now(timezone.utc).replace(tzinfo=None) - idle_for if idle_for is not None else None
             with pool.connection() as conn, conn.cursor() as cur:
                 cur.execute(
-                    """SELECT m.id, m.sender, m.content, m.timestamp, c.id AS conversation_id FROM conversations_messages AS cm INNER JOIN conversations AS c ON cm.conversation_id = c.id INNER JOIN messages AS m ON cm.message_id = m.id WHERE c.summary IS NULL OR c.summary = '' OR c.timestamp < (SELECT Max(msg.timestamp) FROM messages AS msg INNER JOIN conversations_messages AS conmsg ON msg.id=conmsg.message_id WHERE conmsg.conversation_id = c.id) ORDER BY m.timestamp"""
+                    """SELECT id FROM conversations WHERE last_message_id > COALESCE(summarized_through, 0) AND (summary_claimed_until IS NULL OR summary_claimed_until < now()) AND (%(idle_since)s::timestamp IS NULL OR last_message_at <= %(idle_since)s) ORDER BY id""",
+                    {"idle_since": idle_since},
                 )
-                current_time = datetime.now(timezone.utc)
-                messages = [
-                    (
-                        row[0],
-                        row[1],
-                        row[2],
-                        row[3],
-                        int((current_time - row[3].replace(tzinfo=timezone.utc)).total_seconds() / 60),
-                        row[4],
+                conversation_ids = [row[0] for row in cur.fetchall()]
+        except Exception as e:
+            logger.error("Error getting unsummarized conversations from database: %s", e)
+    return conversation_ids
+
+
+class ConversationActivityListener:
+    """Receives the ids of conversations as messages are recorded in them, by this or any other Hawat process
+
+    Listens on its own connection outside the pool, since LISTEN lasts as long as the session.
+    """
+
+    def __init__(self):
+        self._conn = psycopg.connect(get_conninfo(), autocommit=True)
+        self._conn.execute(sql.SQL("LISTEN {channel}").format(channel=sql.Identifier(CONVERSATION_ACTIVITY_CHANNEL)))
+
+    def wait(self, timeout: float) -> list[int]:
+        """Waits up to `timeout` seconds for activity and returns the ids of the active conversations, if any
+
+        Raises:
+            psycopg.Error: If the connection is lost, after which the listener should be closed and replaced.
+        """
+        return [int(notify.payload) for notify in self._conn.notifies(timeout=timeout, stop_after=1)]
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def claim_unsummarized_conversation(conversation_id: int) -> tuple[int, str | None, list[str], datetime, int] | None:
+    """Claims a conversation for summarizing and reads the messages it has received since it was last summarized
+
+    The claim is a lease of SUMMARY_LEASE taken with `FOR UPDATE SKIP LOCKED` and committed straight away, so several
+    workers or Hawat processes can share the backlog without summarizing the same conversation twice, and no lock or
+    connection is held while the summary is generated. `update_conversation_summary` ends the lease, as does
+    `release_conversation_claim` if the summary could not be generated.
+
+    Only messages after the conversation's high-water mark (`summarized_through`) are read, so the cost of
+    summarizing grows with new messages rather than with the length of the conversation.
+
+    Args:
+        conversation_id (int): The conversation to claim.
+
+    Returns:
+        tuple[int, str | None, list[str], datetime, int] | None: The conversation's id, its previous summary, its new
+            messages formatted for the prompt, and the timestamp and id of its newest message. None if another worker
+            holds the conversation, it has nothing new, or the database is unavailable.
+    """
+    pool = get_connection_pool()
+    rows = []
+    if pool:
+        try:
+            with pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    """UPDATE conversations SET summary_claimed_until = now() + %s WHERE id = (SELECT id FROM conversations WHERE id = %s AND last_message_id > COALESCE(summarized_through, 0) AND (summary_claimed_until IS NULL OR summary_claimed_until < now()) FOR UPDATE SKIP LOCKED) RETURNING summary, COALESCE(summarized_through, 0)""",
+                    (SUMMARY_LEASE, conversation_id),
+                )
+                claimed = cur.fetchone()
+                if claimed:
+                    cur.execute(
+                        """SELECT m.id, m.sender, m.content, m.timestamp FROM conversations_messages AS cm INNER JOIN messages AS m ON cm.message_id = m.id WHERE cm.conversation_id = %s AND m.id > %s ORDER BY m.timestamp, m.id""",
+                        (conversation_id, claimed[1]),
                     )
-                    for row in cur.fetchall()
-                ]
+                    rows = cur.fetchall()
+                conn.commit()
+        except Exception as e:
+            logger.error("Error claiming conversation %s: %s", conversation_id, e)
+    if not rows:
+        return None
+    current_time = datetime.now(timezone.utc)
+    messages = [
+        (
+            row[0],
+            row[1],
+            row[2],
+            row[3],
+            int((current_time - row[3].replace(tzinfo=timezone.utc)).total_seconds() / 60),
+        )
+        for row in rows
+    ]
+    return (
+        conversation_id,
+        claimed[0],
+        format_message_log(messages),
+        messages[-1][3].replace(tzinfo=timezone.utc),
+        max(message[0] for message in messages),
+    )
+
+
+def release_conversation_claim(conversation_id: int) -> None:
+    """Gives up a claim from `claim_unsummarized_conversation` so the conversation can be retried straight away"""
+    pool = get_connection_pool()
+    if pool:
+        try:
+            with pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    """UPDATE conversations SET summary_claimed_until = NULL WHERE id = %s""", (conversation_id,)
+                )
+                conn.commit()
         except Exception as e:
-            print(f"Error getting unsummarized conversations from database: {e}")
-    conversations = defaultdict(list)
-    _ = [conversations[m[5]].append(m[:5]) for m in messages]
-    return {k: format_message_log(v) for k, v in conversations.items()}, {
-        k: v[-1][3].replace(tzinfo=timezone.utc) for k, v in conversations.items()
-    }
+            logger.error("Error releasing conversation %s: %s", conversation_id, e)
 
 
-def update_conversation_summary(id: int, summary: str, timestamp: datetime) -> None:
+def update_conversation_summary(
+    id: int, summary: str, timestamp: datetime, summarized_through: int | None = None
+) -> None:
+    """Stores a conversation's new summary and ends any claim on it
+
+    Args:
+        id (int): The conversation's id.
+        summary (str): The new summary.
+        timestamp (datetime): Timestamp of the newest message covered by the summary.
+        summarized_through (int | None): Id of the newest message covered by the summary.
+    """
     pool = get_connection_pool()
     if pool:
         try:
             embedding = np.array(get_embedding(summary))
+            other_embeddings = get_other_model_embeddings([summary])
             with pool.connection() as conn:
-                register_vector(conn)
                 with conn.cursor() as cur:
                     cur.execute(
-                        """UPDATE conversations SET summary=%s, embedding=%s, timestamp=%s WHERE id=%s""",
+                        sql.SQL(
+                            """UPDATE conversations SET summary=%s, {embedding}=%s, timestamp=%s, summarized_through=COALESCE(%s, summarized_through), {through}=COALESCE(%s, summarized_through, 0), summary_claimed_until=NULL WHERE id=%s"""
+                        ).format(
+                            embedding=sql.Identifier(EMBEDDING_COLUMN),
+                            through=sql.Identifier(embedded_through_column(EMBEDDING_COLUMN)),
+                        ),
                         (
                             summary,
                             embedding,
                             timestamp,
+                            summarized_through,
+                            summarized_through,
                             id,
                         ),
                     )
+                    # The summary each column was embedded from is recorded, so a backfill can tell when it changed
+                    for column, (other_embedding,) in other_embeddings:
+                        cur.execute(
+                            sql.SQL(
+                                "UPDATE conversations SET {column} = %s, {through} = COALESCE(summarized_through, 0) "
+                                "WHERE id = %s"
+                            ).format(
+                                column=sql.Identifier(column),
+                                through=sql.Identifier(embedded_through_column(column)),
+                            ),
+                            (np.array(other_embedding), id),
+                        )
                 conn.commit()
         except Exception as e:
-            print(f"Error recording message to database: {e}")
+            logger.error("Error recording message to database: %s", e)
+
+
+def get_other_model_embeddings(texts: list[str]) -> list[tuple[str, list[list[float]]]]:
+    """Embeds texts with every other model whose column new rows are written to
+
+    These are models that `hawat_reembed` is backfilling, or has made active before this process was restarted with
+    them. A model that can't be run is logged and skipped, so recording doesn't depend on it.
+
+    Returns:
+        list[tuple[str, list[list[float]]]]: Each other model's column and the texts' embeddings, in order.
+    """
+    embeddings = []
+    for model, column in get_written_embedding_models():
+        if column != EMBEDDING_COLUMN:
+            try:
+                embeddings.append((column, get_embeddings(texts, model)))
+            except Exception as e:
+                logger.error("Error embedding with %s: %s", model, e)
+    return embeddings
@@ -0,0 +1,11 @@
+from datetime import datetime
+
+from arrow import Arrow
+
+
+def format_message_log(messages: list[tuple[int, str, str, datetime, int]]) -> list[str]:
+    # message_tuple[1] is the sender, message_tuple[4] is minutes ago, message_tuple[2] is the content
+    return [
+        f"{message_tuple[1]} [{Arrow.fromdatetime(message_tuple[3]).humanize()}]:\n{message_tuple[2]}"
+        for message_tuple in messages
+    ]
@@ -1,35 +1,139 @@
+import logging
+from datetime import datetime, timezone
+
 import numpy as np
-from pgvector.psycopg import register_vector
+import psycopg
+from psycopg import sql
+
+from hawat.embeddings import EMBEDDING_COLUMN, get_embeddings
+from hawat.memory.conversations import get_current_conversation_id, get_other_model_embeddings
+from hawat.memory.schema import DEFAULT_SESSION_ID, DEFAULT_USER_ID, get_connection_pool
+from hawat.metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Inserts a message, links it to its conversation and records it as the conversation's latest activity in one
+# statement, returning the new message's id
+_INSERT_MESSAGE_QUERY = sql.SQL(
+    """
+    WITH inserted AS (
+        INSERT INTO messages (sender, content, {embedding}, timestamp, user_id, session_id)
+        VALUES (%(sender)s, %(content)s, %(embedding)s, %(timestamp)s, %(user_id)s, %(session_id)s)
+        RETURNING id, timestamp
+    ), linked AS (
+        INSERT INTO conversations_messages (conversation_id, message_id) SELECT %(conversation_id)s, id FROM inserted
+    )
+    UPDATE conversations
+    SET last_message_id = GREATEST(last_message_id, inserted.id),
+        last_message_at = GREATEST(last_message_at, inserted.timestamp)
+    FROM inserted
+    WHERE conversations.id = %(conversation_id)s
+    RETURNING inserted.id
+"""
+).format(embedding=sql.Identifier(EMBEDDING_COLUMN))
+# Stores a message's embedding from another model that is being backfilled or has been switched to
+_UPDATE_OTHER_EMBEDDING_QUERY = "UPDATE messages SET {column} = %s WHERE id = %s"
+
+
+def record_message(
+    message: str,
+    sender: str = "user",
+    timestamp: datetime | None = None,
+    user_id: str = DEFAULT_USER_ID,
+    session_id: str = DEFAULT_SESSION_ID,
+):
+    """Records a user message to the PostgreSQL database.
+
+    Args:
+        message (str): The message content.
+        sender (str): Who sent the message.
+        timestamp (datetime | None): When the message was sent, aware or naive UTC. Defaults to now.
+        user_id (str): The user the message belongs to.
+        session_id (str): The user's session the message was sent in.
+    """
+    record_messages([(sender, message, timestamp)], user_id, session_id)
+
+
+def record_messages(
+    messages: list[tuple[str, str, datetime | None]],
+    user_id: str = DEFAULT_USER_ID,
+    session_id: str = DEFAULT_SESSION_ID,
+) -> list[int]:
+    """Records several messages to the PostgreSQL database in a single transaction.
+
+    The messages are embedded in one batch and written with one pipelined round trip, so a whole turn is stored
+    together or not at all.
+
+    Args:
+        messages (list[tuple[str, str, datetime | None]]): (sender, content, timestamp) for each message, in order.
+            Timestamps are aware or naive UTC, and default to now.
+        user_id (str): The user the messages belong to.
+        session_id (str): The user's session the messages were sent in, whose current conversation they join.
+
+    Returns:
+        list[int]: The ids of the recorded messages, or an empty list if they could not be recorded.
+    """
+    try:
+        return insert_messages(messages, user_id, session_id)
+    except Exception as e:
+        logger.error("Error recording messages to database: %s", e)
+        return []
 
-from hawat.embeddings import get_embedding
-from hawat.memory.conversations import get_current_conversation_id
-from hawat.memory.schema import get_connection_pool
 
+def insert_messages(
+    messages: list[tuple[str, str, datetime | None]],
+    user_id: str = DEFAULT_USER_ID,
+    session_id: str = DEFAULT_SESSION_ID,
+) -> list[int]:
+    """Records several messages like `record_messages`, but raises instead of logging when they can't be recorded
 
-def record_message(message: str, sender: str = "user"):
-    """Records a user message to the PostgreSQL database."""
-    conversation_id = get_current_conversation_id()
+    Raises:
+        psycopg.DataError: If a message can't be stored, e.g. because its content contains a NUL byte.
+        psycopg.OperationalError: If there is no connection to the database.
+    """
+    if not messages:
+        return []
+    rows = []
+    for sender, content, timestamp in messages:
+        # Stored as naive UTC, like the rest of the timestamps in the database
+        timestamp = timestamp or datetime.now(timezone.utc)
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        rows.append((sender, content, timestamp, get_current_conversation_id(timestamp, user_id, session_id)))
+    message_ids = []
     pool = get_connection_pool()
-    if pool:
-        try:
-            with pool.connection() as conn:
-                register_vector(conn)
-                with conn.cursor() as cur:
-                    embedding = get_embedding(message)
-                    cur.execute(
-                        """INSERT INTO messages (sender, content, embedding) VALUES (%s, %s, %s)""",
-                        (sender, message, np.array(embedding)),
-                    )
-                    cur.execute("""SELECT id FROM messages ORDER BY id DESC LIMIT 1""")
-                    msg_id = cur.fetchone()[0]
-                    cur.execute(
-                        """INSERT INTO conversations_messages (conversation_id, message_id) VALUES (%s, %s)""",
-                        (
-                            conversation_id,
-                            msg_id,
-                        ),
-                    )
-                conn.commit()
-                print(f"Successfully recorded message with embedding: {message}")
-        except Exception as e:
-            print(f"Error recording message to database: {e}")
+    if not pool:
+        raise psycopg.OperationalError("No connection pool to record messages with")
+    with timed("persistence.embedding"):
+        embeddings = get_embeddings([content for _, content, _, _ in rows])
+        other_embeddings = get_other_model_embeddings([content for _, content, _, _ in rows])
+    with timed("persistence.write"), pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.executemany(
+                _INSERT_MESSAGE_QUERY,
+                [
+                    {
+                        "sender": sender,
+                        "content": content,
+                        "embedding": np.array(embedding),
+                        "timestamp": timestamp,
+                        "conversation_id": conversation_id,
+                        "user_id": user_id,
+                        "session_id": session_id,
+                    }
+                    for (sender, content, timestamp, conversation_id), embedding in zip(rows, embeddings)
+                ],
+                returning=True,
+            )
+            while True:
+                message_ids.append(cur.fetchone()[0])
+                if not cur.nextset():
+                    break
+            for column, column_embeddings in other_embeddings:
+                cur.executemany(
+                    sql.SQL(_UPDATE_OTHER_EMBEDDING_QUERY).format(column=sql.Identifier(column)),
+                    [(np.array(embedding), id) for embedding, id in zip(column_embeddings, message_ids)],
+                )
+        conn.commit()
+        logger.debug("Successfully recorded %s messages with embeddings", len(message_ids))
+    return message_ids
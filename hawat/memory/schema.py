@@ -1,8 +1,17 @@
+import logging
 import os
+import threading
+import time
 
+import psycopg
 from pgvector.psycopg import register_vector
+from psycopg import sql
 from psycopg_pool import ConnectionPool
 
+from hawat.embeddings import ORIGINAL_EMBEDDING_MODEL_NAME, embedded_through_column
+
+logger = logging.getLogger(__name__)
+
 # Database connection details - TODO: Make this configurable (e.g., environment variables)
 DB_NAME = os.getenv("DB_NAME", "hawat")
 DB_USER = os.getenv("DB_USER", "hawat")
@@ -10,103 +19,595 @@ DB_PASSWORD = os.getenv("DB_PASSWORD", "123456abcdef")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5431")
 
+# Connection pool sizing. The pool keeps at least DB_POOL_MIN_SIZE connections open, and closes connections beyond
+# that after DB_POOL_MAX_IDLE_SECONDS unused and any connection after DB_POOL_MAX_LIFETIME_SECONDS.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "4"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "16"))
+DB_POOL_MAX_IDLE_SECONDS = float(os.getenv("DB_POOL_MAX_IDLE_SECONDS", "600"))
+DB_POOL_MAX_LIFETIME_SECONDS = float(os.getenv("DB_POOL_MAX_LIFETIME_SECONDS", "3600"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))  # Wait for a free connection
+# Check each connection is alive when it is checked out, which costs a round trip per checkout
+DB_POOL_CHECK = os.getenv("DB_POOL_CHECK", "false").lower() in ("1", "true", "yes")
+# Executions of a query before it is prepared on the server. "off" disables prepared statements, which transaction
+# pooling in PgBouncer before 1.21 needs.
+DB_PREPARE_THRESHOLD = os.getenv("DB_PREPARE_THRESHOLD", "5")
+# Seconds between reads of the embedding model registry by writers, which also embed for models being backfilled
+EMBEDDING_REGISTRY_REFRESH_SECONDS = float(os.getenv("EMBEDDING_REGISTRY_REFRESH_SECONDS", "60"))
+
+# The user and session that messages belong to when a client doesn't say, and that existing history is assigned to
+DEFAULT_USER_ID = "default"
+DEFAULT_SESSION_ID = "default"
+
+# Notified with a conversation's id whenever messages are recorded in it
+CONVERSATION_ACTIVITY_CHANNEL = "hawat_conversation_activity"
+
+# The compact HNSW indexes, by mode: the quantizing expression each indexes the embeddings through, its operator
+# class and its distance operator. halfvec keeps cosine distance at half precision, and bit compares the signs of each
+# dimension by Hamming distance, at a 32nd of the size.
+COMPACT_INDEXES = {
+    "halfvec": ("{column}::halfvec({dimensions})", "halfvec_cosine_ops", "<=>"),
+    "bit": ("binary_quantize({column})::bit({dimensions})", "bit_hamming_ops", "<~>"),
+}
+
 # Global connection pool
 _connection_pool = None
+# The installed pgvector version, read when the pool opens a connection
+_vector_version = None
+# The models that new rows are embedded with, as (name, column) pairs, and when they were last read
+_written_embedding_models = []
+_written_embedding_models_read_at = None
+_written_embedding_models_lock = threading.Lock()
+
+
+def get_conninfo() -> str:
+    return f"dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD} host={DB_HOST} port={DB_PORT}"
 
 
 def get_connection_pool():
-    """Initializes and returns a global connection pool."""
+    """Initializes and returns a global connection pool.
+
+    The schema is not created here; run `hawat_migrate` once after installing or upgrading Hawat.
+    """
     global _connection_pool
     if _connection_pool is None:
         try:
+            prepare_threshold = None if DB_PREPARE_THRESHOLD.lower() == "off" else int(DB_PREPARE_THRESHOLD)
             _connection_pool = ConnectionPool(
-                f"dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD} host={DB_HOST} port={DB_PORT}"
+                get_conninfo(),
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=max(DB_POOL_MAX_SIZE, DB_POOL_MIN_SIZE),
+                max_idle=DB_POOL_MAX_IDLE_SECONDS,
+                max_lifetime=DB_POOL_MAX_LIFETIME_SECONDS,
+                timeout=DB_POOL_TIMEOUT_SECONDS,
+                check=ConnectionPool.check_connection if DB_POOL_CHECK else None,
+                configure=_configure_connection,
+                kwargs={"prepare_threshold": prepare_threshold},
+                open=True,
             )
-            # Ensure the `vector` extension and `messages` table exist when the pool is first created
-            with _connection_pool.connection() as conn:
-                _create_tables(conn)
+            _connection_pool.wait(DB_POOL_TIMEOUT_SECONDS)
         except Exception as e:
-            print(f"Error initializing connection pool or creating tables: {e}")
+            logger.error("Error initializing connection pool: %s", e)
+            if _connection_pool is not None:
+                _connection_pool.close()
             _connection_pool = None  # Reset pool if initialization fails
     return _connection_pool
 
 
-def _create_tables(conn):
-    """Creates tables that must exist for system function"""
-    _create_vector_extension(conn)
-    _create_messages_table(conn)
-    _create_conversations_table(conn)
-    _create_conversations_messages_table(conn)
+def _configure_connection(conn):
+    """Registers the pgvector types once for each connection the pool opens, and notes the pgvector version"""
+    global _vector_version
+    try:
+        register_vector(conn)
+    except psycopg.ProgrammingError as e:
+        logger.warning("The vector extension is missing, run hawat_migrate: %s", e)
+    if _vector_version is None:
+        result = conn.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'").fetchone()
+        if result:
+            _vector_version = tuple(int(part) for part in result[0].split(".")[:3])
+    # The pool only accepts connections left idle
+    conn.commit()
 
 
-def _create_vector_extension(conn):
-    """Initialize the pgvector extension in the database"""
+def get_vector_extension_version() -> tuple[int, ...] | None:
+    """Returns the installed pgvector version, e.g. (0, 8, 0), or None if it is unknown or not installed
+
+    The version is read when the pool opens its first connection, so it costs no round trip here.
+    """
+    if _vector_version is None:
+        get_connection_pool()
+    return _vector_version
+
+
+def get_active_embedding_model() -> str | None:
+    """Retrieves the name of the embedding model marked active in the `embedding_models` registry"""
+    pool = get_connection_pool()
+    if pool:
+        try:
+            with pool.connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT name FROM embedding_models WHERE active")
+                result = cur.fetchone()
+                if result:
+                    return result[0]
+        except Exception as e:
+            logger.error("Error retrieving active embedding model: %s", e)
+    return None
+
+
+def get_written_embedding_models() -> list[tuple[str, str]]:
+    """Retrieves the embedding models that new messages and summaries are embedded with
+
+    These are the active model and any model `hawat_reembed` is backfilling, so their columns stay complete while
+    Hawat processes switch over from one to the other. The registry is read at most once every
+    EMBEDDING_REGISTRY_REFRESH_SECONDS.
+
+    Returns:
+        list[tuple[str, str]]: Each model's name and column, or the last known ones if the registry can't be read.
+    """
+    global _written_embedding_models, _written_embedding_models_read_at
+    with _written_embedding_models_lock:
+        now = time.monotonic()
+        if (
+            _written_embedding_models_read_at is not None
+            and now - _written_embedding_models_read_at < EMBEDDING_REGISTRY_REFRESH_SECONDS
+        ):
+            return _written_embedding_models
+        _written_embedding_models_read_at = now
+        pool = get_connection_pool()
+        if pool:
+            try:
+                with pool.connection() as conn, conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT name, column_name FROM embedding_models WHERE active OR backfilling ORDER BY name",
+                        prepare=True,
+                    )
+                    _written_embedding_models = cur.fetchall()
+            except Exception as e:
+                logger.error("Error retrieving the embedding models to write: %s", e)
+        return _written_embedding_models
+
+
+def get_schema_version() -> int | None:
+    """Returns the newest migration applied to the database, 0 if none are, or None if it can't be reached"""
     try:
-        with conn.cursor() as cur:
-            cur.execute("""CREATE EXTENSION IF NOT EXISTS vector;""")
-            conn.commit()
+        with psycopg.connect(get_conninfo()) as conn:
+            if conn.execute("SELECT to_regclass('schema_migrations')").fetchone()[0] is None:
+                return 0
+            return conn.execute("SELECT COALESCE(Max(version), 0) FROM schema_migrations").fetchone()[0]
     except Exception as e:
-        print(f"Error initializing pgvector: {e}")
+        logger.error("Error retrieving the schema version: %s", e)
+    return None
 
 
-def _create_messages_table(conn):
-    """Creates the messages table if it doesn\'t exist."""
-    # This function should only be called once during connection pool initialization
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS messages (
-                    id SERIAL PRIMARY KEY,
-                    sender TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    embedding VECTOR(384),
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-                CREATE INDEX IF NOT EXISTS messages_timestamp_idx ON messages (timestamp);
-                CREATE INDEX IF NOT EXISTS messages_embedding_idx ON messages USING HNSW (embedding vector_cosine_ops);
+def create_index_concurrently(pool, index: str, definition: sql.Composable) -> None:
+    """
+    Builds an index without blocking writes, replacing any invalid leftover of an interrupted build.
+
+    Args:
+        pool (ConnectionPool): The pool to take a connection from.
+        index (str): The index's name.
+        definition (sql.Composable): The rest of the CREATE INDEX statement, e.g. `ON messages USING HNSW (...)`.
+    """
+    with pool.connection() as conn:
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT i.indisvalid FROM pg_index AS i INNER JOIN pg_class AS c ON c.oid = i.indexrelid WHERE c.relname = %s""",
+                    (index,),
+                )
+                result = cur.fetchone()
+                if result and not result[0]:
+                    # A previous build was interrupted
+                    cur.execute(sql.SQL("DROP INDEX CONCURRENTLY {index}").format(index=sql.Identifier(index)))
+                cur.execute(
+                    sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} {definition}").format(
+                        index=sql.Identifier(index), definition=definition
+                    )
+                )
+        finally:
+            conn.autocommit = False
+
+
+def compact_index_distance(column: sql.Composable, mode: str, dimensions: int) -> sql.Composable:
+    """
+    The distance between a column and the `%(embedding)s` parameter that a compact HNSW index serves.
+
+    Both sides go through the same quantizing expression the index is built on, so the planner can use the index to
+    order by it.
+
+    Args:
+        column (sql.Composable): The embedding column.
+        mode (str): "halfvec" or "bit", one of COMPACT_INDEXES.
+        dimensions (int): The column's dimensions.
+    """
+    expression, _, operator = COMPACT_INDEXES[mode]
+    return sql.SQL("{column} {operator} {query}").format(
+        column=sql.SQL(expression).format(column=column, dimensions=sql.Literal(dimensions)),
+        operator=sql.SQL(operator),
+        query=sql.SQL(expression).format(column=sql.SQL("%(embedding)s::vector"), dimensions=sql.Literal(dimensions)),
+    )
+
+
+def compact_index_definition(table: str, column: str, mode: str, dimensions: int) -> sql.Composable:
+    """The `ON ... USING HNSW (...)` part of a compact index's CREATE INDEX statement, for `create_index_concurrently`"""
+    expression, operator_class, _ = COMPACT_INDEXES[mode]
+    return sql.SQL("ON {table} USING HNSW (({expression}) {operator_class})").format(
+        table=sql.Identifier(table),
+        expression=sql.SQL(expression).format(column=sql.Identifier(column), dimensions=sql.Literal(dimensions)),
+        operator_class=sql.SQL(operator_class),
+    )
+
+
+def migrate() -> int:
+    """
+    Applies the migrations the database hasn't had yet, in order, and records each in `schema_migrations`.
+
+    Each migration commits together with its record, so an interrupted run resumes with the migration that failed.
+    A session advisory lock keeps concurrent runs from applying the same migration twice. Databases created before
+    migrations were versioned replay every migration, which are written to leave existing tables as they are.
+
+    Returns:
+        int: The schema version after migrating.
+
+    Raises:
+        psycopg.Error: If the database can't be reached or a migration fails.
+    """
+    with psycopg.connect(get_conninfo()) as conn:
+        # Released when the connection closes, whether or not the migrations succeed
+        conn.execute("SELECT pg_advisory_lock(hashtext('hawat_migrate'))")
+        conn.execute(
             """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
             )
+        """
+        )
         conn.commit()
-    except Exception as e:
-        print(f"Error creating messages table: {e}")
+        applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+        for version, name, migration in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info("Applying migration %s: %s", version, name)
+            migration(conn)
+            conn.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            conn.commit()
+    return SCHEMA_VERSION
+
+
+def _create_vector_extension(conn):
+    """Initialize the pgvector extension in the database"""
+    with conn.cursor() as cur:
+        cur.execute("""CREATE EXTENSION IF NOT EXISTS vector;""")
+
+
+def _create_messages_table(conn):
+    """Creates the messages table if it doesn\'t exist."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id SERIAL PRIMARY KEY,
+                sender TEXT NOT NULL,
+                content TEXT NOT NULL,
+                embedding VECTOR(384),
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS messages_timestamp_idx ON messages (timestamp);
+            CREATE INDEX IF NOT EXISTS messages_embedding_idx ON messages USING HNSW (embedding vector_cosine_ops);
+            CREATE INDEX IF NOT EXISTS messages_content_tsv_idx ON messages USING GIN (to_tsvector('english', content));
+        """
+        )
 
 
 def _create_conversations_table(conn):
     """Creates the conversations table if it doesn\'t exist"""
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id SERIAL PRIMARY KEY,
-                    summary TEXT,
-                    embedding VECTOR(384),
-                    timestamp TIMESTAMP
-                );
-                CREATE INDEX IF NOT EXISTS conversations_embedding_idx ON conversations USING HNSW (embedding vector_cosine_ops);
+    with conn.cursor() as cur:
+        cur.execute(
             """
-            )
-        conn.commit()
-    except Exception as e:
-        print(f"Error creating conversations table: {e}")
+            CREATE TABLE IF NOT EXISTS conversations (
+                id SERIAL PRIMARY KEY,
+                summary TEXT,
+                embedding VECTOR(384),
+                timestamp TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS conversations_embedding_idx ON conversations USING HNSW (embedding vector_cosine_ops);
+        """
+        )
 
 
 def _create_conversations_messages_table(conn):
     """Creates the conversations_messages table if it doesn\'t exist"""
-    try:
-        with conn.cursor() as cur:
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversations_messages (
+                conversation_id INTEGER NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+                message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+                PRIMARY KEY (conversation_id, message_id)
+            );
+            CREATE INDEX IF NOT EXISTS conversations_messages_conversation_id_idx ON conversations_messages (conversation_id);
+            CREATE INDEX IF NOT EXISTS conversations_messages_message_id_idx ON conversations_messages (message_id);
+        """
+        )
+
+
+def _add_conversations_summarized_through(conn):
+    """Adds the conversations.summarized_through high-water mark if it doesn\'t exist
+
+    Conversations that were summarized before the column existed are marked as summarized through the newest message
+    their summary covers, so they are not summarized again from scratch.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summarized_through INTEGER;
+            UPDATE conversations AS c SET summarized_through = (
+                SELECT Max(m.id) FROM messages AS m
+                INNER JOIN conversations_messages AS cm ON cm.message_id = m.id
+                WHERE cm.conversation_id = c.id AND m.timestamp <= c.timestamp
+            )
+            WHERE c.summarized_through IS NULL AND c.summary IS NOT NULL AND c.summary <> '';
+        """
+        )
+
+
+def _add_conversations_activity(conn):
+    """Adds the columns and index that track which conversations need summarizing if they don\'t exist
+
+    `last_message_id` and `last_message_at` are kept up to date as messages are recorded, and the partial index covers
+    exactly the conversations with messages newer than their summary. The columns are backfilled once when they are
+    first added.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """SELECT 1 FROM information_schema.columns WHERE table_name = 'conversations' AND column_name = 'last_message_id'"""
+        )
+        if cur.fetchone() is None:
             cur.execute(
                 """
-                CREATE TABLE IF NOT EXISTS conversations_messages (
-                    conversation_id INTEGER NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
-                    message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
-                    PRIMARY KEY (conversation_id, message_id)
-                );
-                CREATE INDEX IF NOT EXISTS conversations_messages_conversation_id_idx ON conversations_messages (conversation_id);
-                CREATE INDEX IF NOT EXISTS conversations_messages_message_id_idx ON conversations_messages (message_id);
+                ALTER TABLE conversations
+                    ADD COLUMN last_message_id INTEGER,
+                    ADD COLUMN last_message_at TIMESTAMP,
+                    ADD COLUMN summary_claimed_until TIMESTAMPTZ;
+                UPDATE conversations AS c SET last_message_id = latest.id, last_message_at = latest.timestamp
+                FROM (
+                    SELECT cm.conversation_id, Max(m.id) AS id, Max(m.timestamp) AS timestamp FROM messages AS m
+                    INNER JOIN conversations_messages AS cm ON cm.message_id = m.id
+                    GROUP BY cm.conversation_id
+                ) AS latest
+                WHERE latest.conversation_id = c.id;
             """
             )
-        conn.commit()
-    except Exception as e:
-        print(f"Error creating conversations_messages table: {e}")
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS conversations_unsummarized_idx ON conversations (id)
+                WHERE last_message_id > COALESCE(summarized_through, 0);
+        """
+        )
+
+
+def _create_embedding_models_table(conn):
+    """Creates the embedding_models registry if it doesn\'t exist
+
+    Each embedding model has its own column in `messages` and `conversations`. The registry records the column and
+    dimensions for each model, how far `hawat_reembed` has backfilled it, and which model is active. The original
+    model, stored in the plain `embedding` columns, is registered as active on a new registry.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embedding_models (
+                name TEXT PRIMARY KEY,
+                column_name TEXT NOT NULL UNIQUE,
+                dimensions INTEGER NOT NULL,
+                active BOOLEAN NOT NULL DEFAULT FALSE,
+                messages_checkpoint INTEGER NOT NULL DEFAULT 0,
+                conversations_checkpoint INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS embedding_models_active_idx ON embedding_models (active) WHERE active;
+        """
+        )
+        cur.execute(
+            """
+            INSERT INTO embedding_models (name, column_name, dimensions, active)
+            SELECT %s, 'embedding', 384, TRUE WHERE NOT EXISTS (SELECT 1 FROM embedding_models);
+        """,
+            (ORIGINAL_EMBEDDING_MODEL_NAME,),
+        )
+
+
+def _create_terms_tables(conn):
+    """Creates the entities and keywords tables if they don\'t exist
+
+    Reflection extracts named entities, keywords and subjects from each conversation, stored as one lowercased array
+    per conversation with a GIN index so they can be matched against a query's words with `&&`.
+    `conversations.terms_extracted_through` is the id of the newest message terms have been extracted from.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entities (
+                conversation_id INTEGER PRIMARY KEY REFERENCES conversations (id) ON DELETE CASCADE,
+                names TEXT[] NOT NULL DEFAULT '{}'
+            );
+            CREATE INDEX IF NOT EXISTS entities_names_idx ON entities USING GIN (names);
+            CREATE TABLE IF NOT EXISTS keywords (
+                conversation_id INTEGER PRIMARY KEY REFERENCES conversations (id) ON DELETE CASCADE,
+                terms TEXT[] NOT NULL DEFAULT '{}'
+            );
+            CREATE INDEX IF NOT EXISTS keywords_terms_idx ON keywords USING GIN (terms);
+            ALTER TABLE conversations ADD COLUMN IF NOT EXISTS terms_extracted_through INTEGER;
+            CREATE INDEX IF NOT EXISTS conversations_unextracted_idx ON conversations (id)
+                WHERE last_message_id > COALESCE(terms_extracted_through, 0);
+        """
+        )
+
+
+def _create_response_cache_table(conn):
+    """Creates the response_cache table if it doesn\'t exist
+
+    Holds the replies cached by `hawat.response_cache` when RESPONSE_CACHE is "postgres". Lookups only compare the
+    entries that share a context fingerprint, so the fingerprint index narrows them down before any distances are
+    computed. The embedding column has no fixed dimensions, and the embedding model is part of the fingerprint.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS response_cache (
+                id SERIAL PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                embedding vector NOT NULL,
+                response TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL,
+                last_hit_at TIMESTAMP NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS response_cache_fingerprint_idx ON response_cache (fingerprint, created_at);
+            CREATE INDEX IF NOT EXISTS response_cache_last_hit_at_idx ON response_cache (last_hit_at);
+        """
+        )
+
+
+def _add_users_and_sessions(conn):
+    """Adds the user and session columns to `messages` and `conversations`, and their indexes, if they don\'t exist
+
+    Every query is filtered by user, so each user's retrieval only reads their own rows. The composite indexes serve
+    the time window and current conversation lookups of one session, and the exact similarity search of users with
+    few messages. The HNSW indexes are shared, and their filtered searches rely on `hnsw.iterative_scan` to return
+    enough rows for users with a small share of the history. Existing rows belong to the default user and session.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            sql.SQL(
+                """
+            ALTER TABLE messages
+                ADD COLUMN IF NOT EXISTS user_id TEXT NOT NULL DEFAULT {user_id},
+                ADD COLUMN IF NOT EXISTS session_id TEXT NOT NULL DEFAULT {session_id};
+            ALTER TABLE conversations
+                ADD COLUMN IF NOT EXISTS user_id TEXT NOT NULL DEFAULT {user_id},
+                ADD COLUMN IF NOT EXISTS session_id TEXT NOT NULL DEFAULT {session_id};
+        """
+            ).format(user_id=sql.Literal(DEFAULT_USER_ID), session_id=sql.Literal(DEFAULT_SESSION_ID))
+        )
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS messages_user_timestamp_idx ON messages (user_id, timestamp);
+            CREATE INDEX IF NOT EXISTS messages_session_timestamp_idx ON messages (user_id, session_id, timestamp);
+            CREATE INDEX IF NOT EXISTS conversations_session_activity_idx
+                ON conversations (user_id, session_id, last_message_at);
+            CREATE INDEX IF NOT EXISTS conversations_user_idx ON conversations (user_id);
+        """
+        )
+
+
+def _add_conversation_activity_notifications(conn):
+    """Notifies CONVERSATION_ACTIVITY_CHANNEL with a conversation's id when messages are recorded in it
+
+    Recording a message advances its conversation's `last_message_id`, which fires the trigger. Notifications are
+    delivered when the transaction commits, and identical ones from the same transaction are delivered once, so a
+    turn's messages lead to a single notification.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            sql.SQL(
+                """
+            CREATE OR REPLACE FUNCTION notify_conversation_activity() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify({channel}, NEW.id::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            DROP TRIGGER IF EXISTS conversations_activity_notify ON conversations;
+            CREATE TRIGGER conversations_activity_notify
+                AFTER UPDATE OF last_message_id ON conversations
+                FOR EACH ROW WHEN (NEW.last_message_id IS DISTINCT FROM OLD.last_message_id)
+                EXECUTE FUNCTION notify_conversation_activity();
+        """
+            ).format(channel=sql.Literal(CONVERSATION_ACTIVITY_CHANNEL))
+        )
+
+
+def _create_clusters_tables(conn):
+    """Creates the clusters and cluster_members tables and the conversations.clustered_through mark if they don\'t exist
+
+    Reflection groups each user's summarized conversations into topic clusters, kept as a centroid per cluster and a
+    membership row per conversation, and `clustered_through` records the summary each conversation was last clustered
+    by. Centroids belong to the embedding column they were computed in. The partial indexes find the conversations
+    whose summaries are newer than their cluster assignment, and those that were never assigned one.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS clusters (
+                id SERIAL PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                embedding_column TEXT NOT NULL,
+                centroid vector NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS clusters_user_idx ON clusters (user_id, embedding_column);
+            CREATE TABLE IF NOT EXISTS cluster_members (
+                conversation_id INTEGER PRIMARY KEY REFERENCES conversations (id) ON DELETE CASCADE,
+                cluster_id INTEGER NOT NULL REFERENCES clusters (id) ON DELETE CASCADE
+            );
+            CREATE INDEX IF NOT EXISTS cluster_members_cluster_id_idx ON cluster_members (cluster_id);
+            ALTER TABLE conversations ADD COLUMN IF NOT EXISTS clustered_through INTEGER;
+            CREATE INDEX IF NOT EXISTS conversations_unclustered_idx ON conversations (id)
+                WHERE summarized_through > COALESCE(clustered_through, 0);
+            CREATE INDEX IF NOT EXISTS conversations_never_clustered_idx ON conversations (user_id)
+                WHERE clustered_through IS NULL;
+        """
+        )
+
+
+def _add_embedding_models_backfilling(conn):
+    """Adds the embedding_models.backfilling flag if it doesn\'t exist
+
+    `hawat_reembed` sets it while it backfills a model and clears it when the model becomes active. Hawat embeds new
+    messages and summaries with every active or backfilling model, so a backfill never misses rows written while it
+    runs or before every process has switched to the new model. Each model's column in `conversations` also gets a
+    `<column>_through` companion recording the `summarized_through` its embedding was computed for, so summaries
+    that changed since they were embedded can be found.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            ALTER TABLE embedding_models ADD COLUMN IF NOT EXISTS backfilling BOOLEAN NOT NULL DEFAULT FALSE;
+        """
+        )
+        cur.execute("SELECT column_name, active FROM embedding_models")
+        for column, active in cur.fetchall():
+            cur.execute(
+                sql.SQL("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS {through} INTEGER").format(
+                    through=sql.Identifier(embedded_through_column(column))
+                )
+            )
+            # Only the active model's embeddings are known to follow every summary. The others are embedded again.
+            if active:
+                cur.execute(
+                    sql.SQL(
+                        "UPDATE conversations SET {through} = COALESCE(summarized_through, 0) WHERE {column} IS NOT NULL"
+                    ).format(through=sql.Identifier(embedded_through_column(column)), column=sql.Identifier(column))
+                )
+
+
+# Every change to the schema, applied in order by `migrate`. Add new migrations at the end with the next version and
+# never change one that has been released.
+MIGRATIONS = [
+    (1, "vector extension", _create_vector_extension),
+    (2, "messages", _create_messages_table),
+    (3, "conversations", _create_conversations_table),
+    (4, "conversations_messages", _create_conversations_messages_table),
+    (5, "conversations.summarized_through", _add_conversations_summarized_through),
+    (6, "conversation activity", _add_conversations_activity),
+    (7, "embedding_models", _create_embedding_models_table),
+    (8, "entities and keywords", _create_terms_tables),
+    (9, "response_cache", _create_response_cache_table),
+    (10, "users and sessions", _add_users_and_sessions),
+    (11, "conversation activity notifications", _add_conversation_activity_notifications),
+    (12, "conversation clusters", _create_clusters_tables),
+    (13, "embedding_models.backfilling", _add_embedding_models_backfilling),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
@@ -0,0 +1,114 @@
+import logging
+import re
+
+from hawat.memory.formatting import format_message_log
+from hawat.memory.schema import get_connection_pool
+
+logger = logging.getLogger(__name__)
+
+# The longest multi-word term a query's words are matched against
+MAX_TERM_WORDS = 3
+
+# Conversations with messages newer than their extracted terms, with those messages, oldest conversation first
+_UNEXTRACTED_MESSAGES_QUERY = """
+    SELECT c.id, m.id, m.sender, m.content, m.timestamp
+    FROM (
+        SELECT id, COALESCE(terms_extracted_through, 0) AS extracted_through FROM conversations
+        WHERE last_message_id > COALESCE(terms_extracted_through, 0)
+        ORDER BY id LIMIT %s
+    ) AS c
+    INNER JOIN conversations_messages AS cm ON cm.conversation_id = c.id
+    INNER JOIN messages AS m ON m.id = cm.message_id AND m.id > c.extracted_through
+    ORDER BY c.id, m.timestamp, m.id
+"""
+# Merges newly extracted terms into a conversation's existing ones and moves its high-water mark
+_UPDATE_TERMS_QUERY = """
+    WITH merged_entities AS (
+        INSERT INTO entities (conversation_id, names) VALUES (%(conversation_id)s, %(entities)s)
+        ON CONFLICT (conversation_id) DO UPDATE
+        SET names = ARRAY(SELECT DISTINCT unnest(entities.names || EXCLUDED.names))
+    ), merged_keywords AS (
+        INSERT INTO keywords (conversation_id, terms) VALUES (%(conversation_id)s, %(keywords)s)
+        ON CONFLICT (conversation_id) DO UPDATE
+        SET terms = ARRAY(SELECT DISTINCT unnest(keywords.terms || EXCLUDED.terms))
+    )
+    UPDATE conversations SET terms_extracted_through = GREATEST(terms_extracted_through, %(extracted_through)s)
+    WHERE id = %(conversation_id)s
+"""
+
+
+def normalize_term(term: str) -> str:
+    """Lowercases a term and collapses its whitespace, the form terms are stored and matched in"""
+    return " ".join(term.lower().split())
+
+
+def query_terms(text: str) -> list[str]:
+    """
+    Lists the words and short phrases of a piece of text that could match a stored entity or keyword.
+
+    Args:
+        text (str): The text, usually the user's message.
+
+    Returns:
+        list[str]: Every run of up to MAX_TERM_WORDS words, normalized like stored terms.
+    """
+    words = re.findall(r"[\w'-]+", text.lower())
+    return sorted({" ".join(words[i : i + n]) for n in range(1, MAX_TERM_WORDS + 1) for i in range(len(words) - n + 1)})
+
+
+def get_conversations_without_terms(limit: int) -> list[tuple[int, list[str], int]]:
+    """Retrieves conversations with messages that terms have not been extracted from yet
+
+    Only the messages after each conversation's `terms_extracted_through` mark are read, and the conversations are
+    found through the `conversations_unextracted_idx` partial index.
+
+    Args:
+        limit (int): The most conversations to return.
+
+    Returns:
+        list[tuple[int, list[str], int]]: Each conversation's id, its new messages formatted for the prompt, and the
+            id of its newest message.
+    """
+    pool = get_connection_pool()
+    conversations = {}
+    if pool:
+        try:
+            with pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(_UNEXTRACTED_MESSAGES_QUERY, (limit,))
+                for conversation_id, *message in cur.fetchall():
+                    conversations.setdefault(conversation_id, []).append((*message, 0))
+        except Exception as e:
+            logger.error("Error getting conversations without extracted terms: %s", e)
+    return [
+        (conversation_id, format_message_log(messages), max(message[0] for message in messages))
+        for conversation_id, messages in conversations.items()
+    ]
+
+
+def update_conversation_terms(
+    conversation_id: int, entities: list[str], keywords: list[str], extracted_through: int
+) -> None:
+    """Adds newly extracted terms to a conversation's entities and keywords
+
+    Args:
+        conversation_id (int): The conversation's id.
+        entities (list[str]): Named entities found in the conversation's new messages.
+        keywords (list[str]): Keywords and subjects found in the conversation's new messages.
+        extracted_through (int): Id of the newest message the terms were extracted from.
+    """
+    pool = get_connection_pool()
+    if pool:
+        try:
+            with pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    _UPDATE_TERMS_QUERY,
+                    {
+                        "conversation_id": conversation_id,
+                        "entities": sorted({normalize_term(term) for term in entities} - {""}),
+                        "keywords": sorted({normalize_term(term) for term in keywords} - {""}),
+                        "extracted_through": extracted_through,
+                    },
+                )
+                conn.commit()
+        except Exception as e:
+            logger.error("Error updating terms for conversation %s: %s", conversation_id, e)
@@ -0,0 +1,211 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+import psycopg
+
+from hawat.memory.messages import insert_messages
+from hawat.memory.schema import DEFAULT_SESSION_ID, DEFAULT_USER_ID
+
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "1000"))  # Callers block once this many turns are waiting
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "32"))  # Most messages taken off the queue at once
+# Retries of a session's failed write before its unwritten messages are dropped
+WRITE_MAX_RETRIES = int(os.getenv("WRITE_MAX_RETRIES", "8"))
+WRITE_RETRY_BASE_SECONDS = float(os.getenv("WRITE_RETRY_BASE_SECONDS", "1"))
+WRITE_RETRY_MAX_SECONDS = float(os.getenv("WRITE_RETRY_MAX_SECONDS", "30"))
+
+logger = logging.getLogger(__name__)
+
+_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+# Messages that have been accepted but not yet written, oldest first, as (sender, content, timestamp, user id,
+# session id), so readers can see their own writes
+_pending = []
+_pending_lock = threading.Lock()
+_worker = None
+_worker_lock = threading.Lock()
+_STOP = object()
+
+
+def enqueue_message(
+    message: str, sender: str = "user", user_id: str = DEFAULT_USER_ID, session_id: str = DEFAULT_SESSION_ID
+) -> None:
+    """Queues a message to be recorded to the database by the background writer.
+
+    Args:
+        message (str): The message content.
+        sender (str): Who sent the message.
+        user_id (str): The user the message belongs to.
+        session_id (str): The user's session the message was sent in.
+    """
+    enqueue_messages([(sender, message, None)], user_id, session_id)
+
+
+def enqueue_messages(
+    messages: list[tuple[str, str, datetime | None]],
+    user_id: str = DEFAULT_USER_ID,
+    session_id: str = DEFAULT_SESSION_ID,
+) -> None:
+    """Queues messages, such as the two halves of a turn, to be recorded together by the background writer.
+
+    Messages are written in the order they are queued, and messages queued together are written in the same
+    transaction. Until a message is written it is returned by `get_pending_messages`, so the next turn's context
+    still includes it.
+
+    Args:
+        messages (list[tuple[str, str, datetime | None]]): (sender, content, timestamp) for each message, in order.
+            Timestamps are aware or naive UTC, and default to now.
+        user_id (str): The user the messages belong to.
+        session_id (str): The user's session the messages were sent in.
+    """
+    _start_worker()
+    entries = []
+    for sender, content, timestamp in messages:
+        timestamp = timestamp or datetime.now(timezone.utc)
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        entries.append((sender, content, timestamp, user_id, session_id))
+    with _pending_lock:
+        _pending.extend(entries)
+    _queue.put(entries)
+
+
+def get_pending_messages(
+    user_id: str = DEFAULT_USER_ID, session_id: str = DEFAULT_SESSION_ID
+) -> list[tuple[None, str, str, datetime, int]]:
+    """Returns a session's messages that are queued but not yet written, in the same shape as messages read from the
+    database
+
+    The id is None because the database has not assigned one yet.
+    """
+    with _pending_lock:
+        entries = [entry for entry in _pending if entry[3:] == (user_id, session_id)]
+    current_time = datetime.now(timezone.utc).replace(tzinfo=None)
+    return [
+        (None, sender, content, timestamp, int((current_time - timestamp).total_seconds() / 60))
+        for sender, content, timestamp, _, _ in entries
+    ]
+
+
+def flush() -> None:
+    """Blocks until every queued message has been written"""
+    if _worker is not None:
+        _queue.join()
+
+
+def stop() -> None:
+    """Writes every queued message and stops the background writer"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            return
+        _queue.put(_STOP)
+        _worker.join()
+        _worker = None
+
+
+def _start_worker() -> None:
+    global _worker
+    if _worker is None:
+        with _worker_lock:
+            if _worker is None:
+                _worker = threading.Thread(target=_run, name="hawat-writer", daemon=True)
+                _worker.start()
+                atexit.register(stop)
+
+
+def _run() -> None:
+    """Writes queued messages in batches until told to stop
+
+    When a session's write fails, its messages stay pending and are written again with exponential backoff, together
+    with the session's newer messages, while other sessions' messages keep being written. They are dropped once the
+    write has failed WRITE_MAX_RETRIES more times, and at once if the database rejects them as invalid. When the
+    writer stops, messages waiting to be retried get one last attempt instead of waiting out their backoff.
+    """
+    unwritten = {}  # {(user id, session id): [items whose write failed, failed attempts, monotonic retry time]}
+    stopping = False
+    while not stopping:
+        timeout = None
+        if unwritten:
+            timeout = max(min(retry_at for _, _, retry_at in unwritten.values()) - time.monotonic(), 0)
+        batch = _take_batch(timeout, WRITE_BATCH_SIZE)
+        if batch and batch[-1] is _STOP:
+            batch.pop()
+            stopping = True
+            _queue.task_done()
+        # Each session's messages are written in a transaction of their own, in the order they were queued
+        sessions = {}
+        for item in batch:
+            if not item:
+                _queue.task_done()
+            elif item[0][3:] in unwritten:
+                # Waits behind the session's failed messages so they are stored in order
+                unwritten[item[0][3:]][0].append(item)
+            else:
+                sessions.setdefault(item[0][3:], ([], 0))[0].append(item)
+        now = time.monotonic()
+        for session, (items, attempts, retry_at) in list(unwritten.items()):
+            if retry_at <= now:
+                del unwritten[session]
+                sessions[session] = (items, attempts)
+        for session, (items, attempts) in sessions.items():
+            _write_session(session, items, attempts, unwritten)
+    for session, (items, _, _) in list(unwritten.items()):
+        del unwritten[session]
+        _write_session(session, items, WRITE_MAX_RETRIES, unwritten)
+
+
+def _write_session(session: tuple[str, str], items: list[list[tuple]], attempts: int, unwritten: dict) -> None:
+    """Writes a session's queued items in one transaction, or schedules them to be tried again in `unwritten`"""
+    try:
+        insert_messages([entry[:3] for item in items for entry in item], *session)
+    except psycopg.DataError as e:
+        if len(items) > 1:
+            # Write the items one at a time, so only the ones that can't be stored are dropped
+            for i, item in enumerate(items):
+                _write_session(session, [item], attempts, unwritten)
+                if session in unwritten:
+                    unwritten[session][0].extend(items[i + 1 :])
+                    return
+            return
+        logger.error("Dropping %s messages that can't be stored: %s", len(items[0]), e)
+        _finish(items)
+        return
+    except Exception as e:
+        if attempts >= WRITE_MAX_RETRIES:
+            logger.error("Dropping %s messages that could not be recorded: %s", sum(len(item) for item in items), e)
+            _finish(items)
+            return
+        delay = min(WRITE_RETRY_BASE_SECONDS * 2**attempts, WRITE_RETRY_MAX_SECONDS)
+        logger.warning("Error recording messages, retrying in %.1fs: %s", delay, e)
+        unwritten[session] = [items, attempts + 1, time.monotonic() + delay]
+        return
+    _finish(items)
+
+
+def _take_batch(timeout: float | None, size: int) -> list:
+    """Takes queued items until they hold `size` messages or the queue is empty
+
+    Waits up to `timeout` seconds for the first item, or for as long as it takes if `timeout` is None.
+    """
+    batch = []
+    try:
+        batch.append(_queue.get(timeout=timeout))
+        while batch[-1] is not _STOP and sum(len(item) for item in batch) < size:
+            batch.append(_queue.get_nowait())
+    except queue.Empty:
+        pass
+    return batch
+
+
+def _finish(items: list[list[tuple]]) -> None:
+    """Stops returning the items' messages as pending and marks the items as done"""
+    with _pending_lock:
+        for item in items:
+            for entry in item:
+                _pending.remove(entry)
+    for _ in items:
+        _queue.task_done()
@@ -0,0 +1,189 @@
+import logging
+import os
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))  # Port for the Prometheus /metrics endpoint, 0 disables it
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+# Wrap stages in OpenTelemetry spans. Needs opentelemetry-api, and an SDK and exporter to send the spans anywhere,
+# e.g. by running Hawat under `opentelemetry-instrument`.
+OTEL_TRACING = os.getenv("OTEL_TRACING", "false").lower() in ("1", "true", "yes")
+
+# Histogram bucket upper bounds in seconds, from a cached embedding up to a slow LLM reply
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Histogram bucket upper bounds in tokens, from an empty section up to a long conversation history
+TOKEN_BUCKETS = (0, 50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+logger = logging.getLogger(__name__)
+
+_tracer = None
+if OTEL_TRACING:
+    try:
+        from opentelemetry import trace
+
+        _tracer = trace.get_tracer("hawat")
+    except ImportError:
+        logger.warning("OTEL_TRACING is set but opentelemetry-api is not installed, so no spans will be recorded")
+
+
+class Histogram:
+    """A Prometheus histogram, durations by default, with one series per value of its label"""
+
+    def __init__(
+        self, name: str, documentation: str, buckets: tuple[float, ...] = LATENCY_BUCKETS, label: str = "stage"
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.label = label
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """Adds one value, usually a duration, to a stage's series"""
+        with self._lock:
+            series = self._series.get(stage)
+            if series is None:
+                series = self._series[stage] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += seconds
+            series["count"] += 1
+
+    def render(self) -> list[str]:
+        """Formats every series in the Prometheus text exposition format"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {stage: dict(values, buckets=list(values["buckets"])) for stage, values in self._series.items()}
+        for stage, values in sorted(series.items()):
+            for bound, count in zip(self.buckets, values["buckets"]):
+                lines.append(f'{self.name}_bucket{{{self.label}="{stage}",le="{bound:g}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{self.label}="{stage}",le="+Inf"}} {values["count"]}')
+            lines.append(f'{self.name}_sum{{{self.label}="{stage}"}} {values["sum"]}')
+            lines.append(f'{self.name}_count{{{self.label}="{stage}"}} {values["count"]}')
+        return lines
+
+
+# Seconds spent in each stage of a turn, e.g. "context.embedding", "prompt", "llm" or "persistence.write"
+STAGE_DURATION = Histogram("hawat_stage_duration_seconds", "Seconds spent in each stage of handling a message.")
+# Tokens in each section of the context sent with a message, e.g. "similar_messages", "current_conversation" or "total"
+CONTEXT_TOKENS = Histogram(
+    "hawat_context_tokens", "Tokens in each section of a message's context.", TOKEN_BUCKETS, label="section"
+)
+
+# Callbacks that add other modules' metrics to the /metrics page at scrape time
+_collectors: list[Callable[[], list[str]]] = []
+
+
+def register_collector(collector: Callable[[], list[str]]) -> None:
+    """
+    Adds a callback whose lines, already in the Prometheus text exposition format, are included in every scrape.
+
+    Args:
+        collector (Callable[[], list[str]]): Returns the metric lines, including their HELP and TYPE comments.
+    """
+    _collectors.append(collector)
+
+
+def observe(stage: str, seconds: float) -> None:
+    """
+    Records how long a stage that has already finished took.
+
+    When tracing is enabled, the stage is also recorded as a span ending now, under the current span.
+
+    Args:
+        stage (str): The stage's name.
+        seconds (float): How long it took.
+    """
+    STAGE_DURATION.observe(stage, seconds)
+    if _tracer is not None:
+        end = time.time_ns()
+        _tracer.start_span(stage, start_time=end - int(seconds * 1e9)).end(end_time=end)
+
+
+def observe_context_tokens(token_counts: dict[str, int]) -> None:
+    """
+    Records the tokens each section of a message's context used.
+
+    Args:
+        token_counts (dict[str, int]): The tokens used by each section and in total, as filled in by context building.
+    """
+    for section, tokens in token_counts.items():
+        CONTEXT_TOKENS.observe(section, tokens)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """
+    Times the enclosed block as a stage, inside a span of its own when tracing is enabled.
+
+    Don't hold it open across a generator's `yield`, since the span would be left current in the consumer's context;
+    time those stages with `observe` instead.
+
+    Args:
+        stage (str): The stage's name.
+    """
+    start = time.perf_counter()
+    try:
+        if _tracer is None:
+            yield
+        else:
+            with _tracer.start_as_current_span(stage):
+                yield
+    finally:
+        STAGE_DURATION.observe(stage, time.perf_counter() - start)
+
+
+def render_metrics() -> str:
+    """Returns every metric in the Prometheus text exposition format"""
+    lines = STAGE_DURATION.render() + CONTEXT_TOKENS.render()
+    for collector in _collectors:
+        try:
+            lines.extend(collector())
+        except Exception as e:
+            logger.error("Error collecting metrics: %s", e)
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug(format, *args)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        content = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> ThreadingHTTPServer | None:
+    """
+    Serves the metrics at /metrics from a daemon thread.
+
+    Args:
+        port (int): The port to listen on. 0 disables the endpoint.
+        host (str): The address to listen on.
+
+    Returns:
+        ThreadingHTTPServer | None: The running server, or None if it is disabled or could not start.
+    """
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error("Error starting the metrics endpoint on port %s: %s", port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="hawat-metrics", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
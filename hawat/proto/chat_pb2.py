@@ -17,7 +17,7 @@ _sym_db = _symbol_database.Default()
 
 
 DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(
-    b'\n\x16hawat/proto/chat.proto"\x1d\n\nClientChat\x12\x0f\n\x07message\x18\x01 \x01(\t"\x1d\n\nServerChat\x12\x0f\n\x07message\x18\x01 \x01(\t24\n\tHawatChat\x12\'\n\tsend_chat\x12\x0b.ClientChat\x1a\x0b.ServerChat"\x00\x62\x06proto3'
+    b'\n\x16hawat/proto/chat.proto"B\n\nClientChat\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\x0f\n\x07user_id\x18\x02 \x01(\t\x12\x12\n\nsession_id\x18\x03 \x01(\t"\x1d\n\nServerChat\x12\x0f\n\x07message\x18\x01 \x01(\t2a\n\tHawatChat\x12\'\n\tsend_chat\x12\x0b.ClientChat\x1a\x0b.ServerChat"\x00\x12+\n\x0bstream_chat\x12\x0b.ClientChat\x1a\x0b.ServerChat"\x00\x30\x01\x62\x06proto3'
 )
 
 _globals = globals()
@@ -26,9 +26,9 @@ _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, "hawat.proto.chat_pb2", _glo
 if not _descriptor._USE_C_DESCRIPTORS:
     DESCRIPTOR._loaded_options = None
     _globals["_CLIENTCHAT"]._serialized_start = 26
-    _globals["_CLIENTCHAT"]._serialized_end = 55
-    _globals["_SERVERCHAT"]._serialized_start = 57
-    _globals["_SERVERCHAT"]._serialized_end = 86
-    _globals["_HAWATCHAT"]._serialized_start = 88
-    _globals["_HAWATCHAT"]._serialized_end = 140
+    _globals["_CLIENTCHAT"]._serialized_end = 92
+    _globals["_SERVERCHAT"]._serialized_start = 94
+    _globals["_SERVERCHAT"]._serialized_end = 123
+    _globals["_HAWATCHAT"]._serialized_start = 125
+    _globals["_HAWATCHAT"]._serialized_end = 222
 # @@protoc_insertion_point(module_scope)
@@ -42,6 +42,12 @@ class HawatChatStub(object):
             response_deserializer=hawat_dot_proto_dot_chat__pb2.ServerChat.FromString,
             _registered_method=True,
         )
+        self.stream_chat = channel.unary_stream(
+            "/HawatChat/stream_chat",
+            request_serializer=hawat_dot_proto_dot_chat__pb2.ClientChat.SerializeToString,
+            response_deserializer=hawat_dot_proto_dot_chat__pb2.ServerChat.FromString,
+            _registered_method=True,
+        )
 
 
 class HawatChatServicer(object):
@@ -53,6 +59,12 @@ class HawatChatServicer(object):
         context.set_details("Method not implemented!")
         raise NotImplementedError("Method not implemented!")
 
+    def stream_chat(self, request, context):
+        """Send a chat message from the client to the server and stream the reply back as it is generated."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details("Method not implemented!")
+        raise NotImplementedError("Method not implemented!")
+
 
 def add_HawatChatServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -61,6 +73,11 @@ def add_HawatChatServicer_to_server(servicer, server):
             request_deserializer=hawat_dot_proto_dot_chat__pb2.ClientChat.FromString,
             response_serializer=hawat_dot_proto_dot_chat__pb2.ServerChat.SerializeToString,
         ),
+        "stream_chat": grpc.unary_stream_rpc_method_handler(
+            servicer.stream_chat,
+            request_deserializer=hawat_dot_proto_dot_chat__pb2.ClientChat.FromString,
+            response_serializer=hawat_dot_proto_dot_chat__pb2.ServerChat.SerializeToString,
+        ),
     }
     generic_handler = grpc.method_handlers_generic_handler("HawatChat", rpc_method_handlers)
     server.add_generic_rpc_handlers((generic_handler,))
@@ -100,3 +117,33 @@ class HawatChat(object):
             metadata,
             _registered_method=True,
         )
+
+    @staticmethod
+    def stream_chat(
+        request,
+        target,
+        options=(),
+        channel_credentials=None,
+        call_credentials=None,
+        insecure=False,
+        compression=None,
+        wait_for_ready=None,
+        timeout=None,
+        metadata=None,
+    ):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            "/HawatChat/stream_chat",
+            hawat_dot_proto_dot_chat__pb2.ClientChat.SerializeToString,
+            hawat_dot_proto_dot_chat__pb2.ServerChat.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True,
+        )
@@ -1,56 +1,251 @@
+import logging
+import os
+import random
 import threading
 import time
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 
-import schedule
 from arrow import Arrow
 
-from hawat.language import get_conversation_summary
-from hawat.memory.conversations import get_unsummarized_conversations, update_conversation_summary
+from hawat.language import get_conversation_summary, get_conversations_keys_names_subjects
+from hawat.memory.clusters import assign_conversation_cluster, get_unclustered_conversations
+from hawat.memory.conversations import (
+    CONVO_THRESHOLD,
+    ConversationActivityListener,
+    claim_unsummarized_conversation,
+    get_unsummarized_conversation_ids,
+    release_conversation_claim,
+    update_conversation_summary,
+)
+from hawat.memory.terms import get_conversations_without_terms, update_conversation_terms
+from hawat.tokens import truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+REFLECTION_CONCURRENCY = int(os.getenv("REFLECTION_CONCURRENCY", "2"))  # Summaries generated at the same time
+REFLECTION_REQUESTS_PER_MINUTE = float(os.getenv("REFLECTION_REQUESTS_PER_MINUTE", "20"))
+REFLECTION_BURST = int(os.getenv("REFLECTION_BURST", str(REFLECTION_CONCURRENCY)))
+REFLECTION_MAX_RETRIES = int(os.getenv("REFLECTION_MAX_RETRIES", "3"))
+REFLECTION_RETRY_BASE_SECONDS = float(os.getenv("REFLECTION_RETRY_BASE_SECONDS", "2"))
+TERMS_BATCH_SIZE = int(os.getenv("TERMS_BATCH_SIZE", "5"))  # Conversations per entity and keyword extraction request
+TERMS_CONVERSATIONS_PER_RUN = int(os.getenv("TERMS_CONVERSATIONS_PER_RUN", "50"))
+TERMS_MAX_TOKENS_PER_CONVERSATION = int(os.getenv("TERMS_MAX_TOKENS_PER_CONVERSATION", "2000"))
+# Seconds a conversation must go without messages before it is summarized, so a burst of messages gets one summary
+REFLECTION_IDLE_SECONDS = float(os.getenv("REFLECTION_IDLE_SECONDS", str(CONVO_THRESHOLD.total_seconds())))
+# Seconds between sweeps for idle conversations whose notifications were missed, e.g. while Hawat was stopped
+REFLECTION_POLL_SECONDS = float(os.getenv("REFLECTION_POLL_SECONDS", "900"))
+REFLECTION_LISTEN_RETRY_SECONDS = 60  # Wait before listening again after the connection is lost
+CLUSTER_BATCH_SIZE = int(os.getenv("CLUSTER_BATCH_SIZE", "500"))  # Conversations read per batch when clustering
 
 # A lock to ensure only one instance of the task runs at a time
 task_lock = threading.Lock()
 
+_executor = ThreadPoolExecutor(max_workers=REFLECTION_CONCURRENCY, thread_name_prefix="hawat-reflection")
+
 
-def run_minutely_task():
+class TokenBucket:
+    """Blocking token-bucket rate limiter shared between threads"""
+
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Waits until a token is available and takes it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Limits reflection's requests to the OpenAI-compatible endpoint
+_rate_limiter = TokenBucket(REFLECTION_REQUESTS_PER_MINUTE, REFLECTION_BURST)
+
+
+def reflect(conversation_ids: list[int] | None = None) -> None:
     """
-    This function will be run once every hour.
-    It acquires a lock to ensure only one instance runs at a time.
+    Summarizes conversations, extracts their terms and assigns them to topic clusters, one run at a time.
+
+    Args:
+        conversation_ids (list[int] | None): The conversations to summarize. By default, every conversation that has
+            been idle for REFLECTION_IDLE_SECONDS since messages newer than its summary.
     """
-    # Attempt to acquire the lock without blocking
-    if task_lock.acquire(blocking=False):
-        try:
-            # Add your minutely task logic here
-            summarize_conversations()
-        finally:
-            task_lock.release()  # Release the lock whether the task succeeds or fails
-    else:
-        print("Skipping minutely task: another instance is already running.")
+    with task_lock:
+        if conversation_ids is None:
+            summarize_conversations(idle_for=timedelta(seconds=REFLECTION_IDLE_SECONDS))
+        else:
+            summarize_conversations(conversation_ids)
+        extract_conversation_terms()
+        cluster_conversations()
 
 
 def start_reflection_thread():
-    # Schedule the task to run every minute
-    schedule.every().minute.at(":00").do(run_minutely_task)
-
-    def run_scheduler():
-        while True:
-            schedule.run_pending()
-            time.sleep(1)  # Check every second for pending jobs
+    """
+    Starts reflecting on conversations in a daemon thread, as they go idle.
 
-    # Start the scheduler in a daemon thread
-    thread = threading.Thread(target=run_scheduler, daemon=True)
+    Recording messages notifies the thread of their conversation, and each notification restarts that conversation's
+    idle timer, so it is summarized once, REFLECTION_IDLE_SECONDS after its last message. A sweep when the thread
+    starts and every REFLECTION_POLL_SECONDS after catches conversations whose notifications were missed, and stands in
+    for the notifications while the thread can't listen for them.
+    """
+    thread = threading.Thread(target=_run_reflection, name="hawat-reflection-scheduler", daemon=True)
     thread.start()
     return thread
 
 
-def summarize_conversations() -> None:
-    unsummarized_conversations, conversation_times = get_unsummarized_conversations()
-    if len(unsummarized_conversations) == 0:
+def _run_reflection() -> None:
+    idle_at = {}  # {conversation id: monotonic time it will have been idle for REFLECTION_IDLE_SECONDS}
+    next_sweep = time.monotonic()
+    listener = None
+    while True:
+        now = time.monotonic()
+        due = [id for id, at in idle_at.items() if at <= now]
+        try:
+            if now >= next_sweep:
+                next_sweep = now + REFLECTION_POLL_SECONDS
+                reflect()
+            if due:
+                reflect(due)
+        except Exception as e:
+            logger.error("Error reflecting on conversations: %s", e)
+        for id in due:
+            del idle_at[id]
+
+        timeout = max(min([next_sweep, *idle_at.values()]) - time.monotonic(), 0)
+        if listener is None:
+            try:
+                listener = ConversationActivityListener()
+            except Exception as e:
+                logger.warning(
+                    "Could not listen for new messages, polling every %ss instead: %s", REFLECTION_POLL_SECONDS, e
+                )
+                time.sleep(min(timeout, REFLECTION_LISTEN_RETRY_SECONDS))
+                continue
+        try:
+            for id in listener.wait(timeout):
+                idle_at[id] = time.monotonic() + REFLECTION_IDLE_SECONDS
+        except Exception as e:
+            logger.warning("Stopped listening for new messages: %s", e)
+            listener.close()
+            listener = None
+
+
+def summarize_conversations(conversation_ids: list[int] | None = None, idle_for: timedelta | None = None) -> None:
+    """
+    Summarizes conversations' new messages, several at a time.
+
+    Args:
+        conversation_ids (list[int] | None): The conversations to summarize. By default, every conversation with
+            messages newer than its summary.
+        idle_for (timedelta | None): When the conversations aren't given, only summarize those without messages for
+            this long.
+    """
+    if conversation_ids is None:
+        conversation_ids = get_unsummarized_conversation_ids(idle_for)
+    if len(conversation_ids) == 0:
         return
-    print(f"Found {len(unsummarized_conversations)} unsummarized conversations.")
-    conversation_summaries = [
-        [id, get_conversation_summary("\n".join(messages)), conversation_times[id]]
-        for id, messages in unsummarized_conversations.items()
-    ]
-    _ = [update_conversation_summary(*convo) for convo in conversation_summaries]
-    print(f"Updated {len(conversation_summaries)} conversation summaries")
+    logger.info("Found %s unsummarized conversations.", len(conversation_ids))
+    futures = {_executor.submit(summarize_conversation, id): id for id in conversation_ids}
+    updated = 0
+    for future in as_completed(futures):
+        try:
+            updated += future.result()
+        except Exception as e:
+            logger.error("Error summarizing conversation %s: %s", futures[future], e)
+    logger.info("Updated %s conversation summaries", updated)
+
+
+def summarize_conversation(conversation_id: int) -> bool:
+    """Summarizes one conversation's new messages, unless another worker has already claimed it
+
+    Returns:
+        bool: Whether the conversation's summary was updated
+    """
+    conversation = claim_unsummarized_conversation(conversation_id)
+    if conversation is None:
+        return False
+    id, previous_summary, messages, timestamp, last_message_id = conversation
+    try:
+        # Only the previous summary and the messages since it are sent to the model
+        summary = _with_retries(get_conversation_summary, "\n".join(messages), previous_summary)
+    except Exception:
+        release_conversation_claim(id)
+        raise
+    update_conversation_summary(id, summary, timestamp, last_message_id)
+    return True
+
+
+def extract_conversation_terms() -> None:
+    """Extracts named entities, keywords and subjects from conversations' new messages, several per request"""
+    conversations = get_conversations_without_terms(TERMS_CONVERSATIONS_PER_RUN)
+    if len(conversations) == 0:
+        return
+    batches = [conversations[i : i + TERMS_BATCH_SIZE] for i in range(0, len(conversations), TERMS_BATCH_SIZE)]
+    futures = {_executor.submit(extract_terms_from_batch, batch): batch for batch in batches}
+    updated = 0
+    for future in as_completed(futures):
+        try:
+            updated += future.result()
+        except Exception as e:
+            logger.error("Error extracting terms from conversations %s: %s", [c[0] for c in futures[future]], e)
+    logger.info("Extracted terms from %s of %s conversations", updated, len(conversations))
+
+
+def extract_terms_from_batch(conversations: list[tuple[int, list[str], int]]) -> int:
+    """Extracts terms from a batch of conversations with one request and stores them
+
+    Returns:
+        int: How many of the conversations had terms stored. The others are tried again on the next run.
+    """
+    formatted_convos = {
+        id: truncate_to_tokens("\n".join(messages), TERMS_MAX_TOKENS_PER_CONVERSATION)
+        for id, messages, _ in conversations
+    }
+    terms = _with_retries(get_conversations_keys_names_subjects, formatted_convos)
+    for id, _, last_message_id in conversations:
+        if id in terms:
+            update_conversation_terms(
+                id, terms[id]["entities"], terms[id]["keywords"] + terms[id]["subjects"], last_message_id
+            )
+    return sum(id in terms for id, _, _ in conversations)
+
+
+def cluster_conversations() -> None:
+    """Assigns every conversation whose summary changed since it was last clustered to a topic cluster
+
+    Clustering only reads and writes the database, so the whole backlog is worked through in batches of
+    CLUSTER_BATCH_SIZE, stopping early if an assignment fails so it is retried on the next run.
+    """
+    clustered = 0
+    while True:
+        conversations = get_unclustered_conversations(CLUSTER_BATCH_SIZE)
+        assigned = sum(assign_conversation_cluster(*conversation) for conversation in conversations)
+        clustered += assigned
+        if assigned < len(conversations) or len(conversations) < CLUSTER_BATCH_SIZE:
+            break
+    if clustered:
+        logger.info("Clustered %s conversations", clustered)
+
+
+def _with_retries(function, *args):
+    """Calls the model through the rate limiter, retrying failures with exponential backoff and jitter"""
+    for attempt in range(REFLECTION_MAX_RETRIES + 1):
+        _rate_limiter.acquire()
+        try:
+            return function(*args)
+        except Exception as e:
+            if attempt == REFLECTION_MAX_RETRIES:
+                raise
+            delay = REFLECTION_RETRY_BASE_SECONDS * 2**attempt * random.uniform(0.5, 1.5)
+            logger.warning("Model request failed (%s), retrying in %.1fs", e, delay)
+            time.sleep(delay)
@@ -0,0 +1,234 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from hawat.embeddings import EMBEDDING_MODEL_NAME
+from hawat.memory.schema import DEFAULT_USER_ID, get_connection_pool
+from hawat.metrics import register_collector
+
+# "off", "memory" to keep cached replies in this process, or "postgres" to share them through the response_cache table
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "off")
+# Cosine similarity a message needs with a cached one to reuse its reply, when the retrieved context is the same
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.95"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))  # Entries kept, least recently used evicted first
+
+logger = logging.getLogger(__name__)
+
+# The closest unexpired entry with the same fingerprint, and its cosine similarity to the message
+_LOOKUP_QUERY = """
+    SELECT id, response, 1 - (embedding <=> %(embedding)s) AS similarity FROM response_cache
+    WHERE fingerprint = %(fingerprint)s AND created_at > %(expires_before)s
+    ORDER BY embedding <=> %(embedding)s LIMIT 1
+"""
+_TOUCH_QUERY = "UPDATE response_cache SET last_hit_at = %s WHERE id = %s"
+_INSERT_QUERY = """
+    INSERT INTO response_cache (fingerprint, embedding, response, created_at, last_hit_at)
+    VALUES (%(fingerprint)s, %(embedding)s, %(response)s, %(now)s, %(now)s)
+"""
+# Drops expired entries, then the least recently used ones beyond RESPONSE_CACHE_SIZE
+_EVICT_QUERY = """
+    DELETE FROM response_cache WHERE created_at <= %(expires_before)s OR id IN (
+        SELECT id FROM response_cache ORDER BY last_hit_at DESC OFFSET %(size)s
+    )
+"""
+
+
+def context_fingerprint(retrieved_ids: dict[str, list], user_id: str = DEFAULT_USER_ID) -> str:
+    """
+    Fingerprints the context retrieved for a message, so a cached reply is only reused with the same memories.
+
+    The current conversation is identified by its id rather than by its messages, which change with every turn. A
+    reply is therefore reused for the same question asked again later in the same conversation, even though the
+    conversation has moved on since, but never for the same question in another conversation.
+
+    Args:
+        retrieved_ids (dict[str, list]): The retrieved records by kind, as filled in by `get_formatted_context`: the
+            ids of the "messages", "conversations" and "current_conversation" records.
+        user_id (str): The user the memories belong to, so replies are never shared between users.
+
+    Returns:
+        str: A hash of the embedding model, the user and the sorted records of each kind.
+    """
+    parts = [EMBEDDING_MODEL_NAME, user_id] + [f"{kind}:{sorted(ids)}" for kind, ids in sorted(retrieved_ids.items())]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    A cache of replies keyed by the message's embedding and a fingerprint of its retrieved context.
+
+    A lookup hits when an unexpired entry has the same fingerprint and an embedding within RESPONSE_CACHE_SIMILARITY
+    of the message's. Subclasses implement `_lookup` and `_store`, and the base class keeps hit-rate metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "misses": 0, "stores": 0, "errors": 0}
+
+    def lookup(self, embedding: list[float], fingerprint: str) -> str | None:
+        """Returns the cached reply for a message, or None on a miss"""
+        try:
+            response = self._lookup(np.asarray(embedding, dtype=np.float32), fingerprint)
+        except Exception as e:
+            logger.error("Error looking up a cached response: %s", e)
+            self._count("errors")
+            response = None
+        self._count("hits" if response is not None else "misses")
+        return response
+
+    def store(self, embedding: list[float], fingerprint: str, response: str) -> None:
+        """Caches the reply to a message"""
+        try:
+            self._store(np.asarray(embedding, dtype=np.float32), fingerprint, response)
+            self._count("stores")
+        except Exception as e:
+            logger.error("Error caching a response: %s", e)
+            self._count("errors")
+
+    def metrics(self) -> dict:
+        """Returns the lookup, store and error counts and the hit rate"""
+        with self._lock:
+            metrics = dict(self._metrics)
+        lookups = metrics["hits"] + metrics["misses"]
+        metrics["hit_rate"] = metrics["hits"] / lookups if lookups else None
+        return metrics
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._metrics[key] += 1
+
+    def _lookup(self, embedding: np.ndarray, fingerprint: str) -> str | None:
+        raise NotImplementedError
+
+    def _store(self, embedding: np.ndarray, fingerprint: str, response: str) -> None:
+        raise NotImplementedError
+
+
+class MemoryResponseCache(ResponseCache):
+    """Keeps cached replies in this process, in least recently used order"""
+
+    def __init__(self):
+        super().__init__()
+        self._entries = OrderedDict()
+        self._next_id = 0
+
+    def _lookup(self, embedding: np.ndarray, fingerprint: str) -> str | None:
+        expires_before = time.monotonic() - RESPONSE_CACHE_TTL_SECONDS
+        query = embedding / np.linalg.norm(embedding)
+        best_id, best_similarity = None, RESPONSE_CACHE_SIMILARITY
+        with self._lock:
+            for entry_id, (entry_fingerprint, entry_embedding, _, created) in list(self._entries.items()):
+                if created <= expires_before:
+                    del self._entries[entry_id]
+                elif (
+                    entry_fingerprint == fingerprint
+                    and (similarity := float(query @ entry_embedding)) >= best_similarity
+                ):
+                    best_id, best_similarity = entry_id, similarity
+            if best_id is None:
+                return None
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][2]
+
+    def _store(self, embedding: np.ndarray, fingerprint: str, response: str) -> None:
+        with self._lock:
+            self._entries[self._next_id] = (
+                fingerprint,
+                embedding / np.linalg.norm(embedding),
+                response,
+                time.monotonic(),
+            )
+            self._next_id += 1
+            while len(self._entries) > RESPONSE_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+
+class PostgresResponseCache(ResponseCache):
+    """Keeps cached replies in the response_cache table, shared by every Hawat process using the database"""
+
+    def _lookup(self, embedding: np.ndarray, fingerprint: str) -> str | None:
+        pool = get_connection_pool()
+        if not pool:
+            return None
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    _LOOKUP_QUERY,
+                    {
+                        "embedding": embedding,
+                        "fingerprint": fingerprint,
+                        "expires_before": now - timedelta(seconds=RESPONSE_CACHE_TTL_SECONDS),
+                    },
+                    prepare=True,
+                )
+                row = cur.fetchone()
+                if row is None or row[2] < RESPONSE_CACHE_SIMILARITY:
+                    return None
+                cur.execute(_TOUCH_QUERY, (now, row[0]))
+            conn.commit()
+        return row[1]
+
+    def _store(self, embedding: np.ndarray, fingerprint: str, response: str) -> None:
+        pool = get_connection_pool()
+        if not pool:
+            return
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    _INSERT_QUERY,
+                    {"fingerprint": fingerprint, "embedding": embedding, "response": response, "now": now},
+                )
+                cur.execute(
+                    _EVICT_QUERY,
+                    {
+                        "expires_before": now - timedelta(seconds=RESPONSE_CACHE_TTL_SECONDS),
+                        "size": RESPONSE_CACHE_SIZE,
+                    },
+                )
+            conn.commit()
+
+
+_RESPONSE_CACHES = {"memory": MemoryResponseCache, "postgres": PostgresResponseCache}
+_response_cache = _RESPONSE_CACHES[RESPONSE_CACHE]() if RESPONSE_CACHE in _RESPONSE_CACHES else None
+
+
+def get_response_cache() -> ResponseCache | None:
+    """Returns the response cache selected by RESPONSE_CACHE, or None if it is off"""
+    return _response_cache
+
+
+def set_response_cache(cache: ResponseCache | None) -> None:
+    """Replaces the response cache, or turns it off with None"""
+    global _response_cache
+    _response_cache = cache
+
+
+# Prometheus name, type and description of the cache metrics exported on /metrics
+_EXPORTED_CACHE_METRICS = {
+    "hits": ("hawat_response_cache_hits_total", "counter", "Messages answered from the response cache."),
+    "misses": ("hawat_response_cache_misses_total", "counter", "Response cache lookups that found no reply."),
+    "stores": ("hawat_response_cache_stores_total", "counter", "Replies added to the response cache."),
+    "errors": ("hawat_response_cache_errors_total", "counter", "Response cache lookups and stores that failed."),
+}
+
+
+def _render_cache_metrics() -> list[str]:
+    if _response_cache is None:
+        return []
+    metrics = _response_cache.metrics()
+    lines = []
+    for key, (name, metric_type, documentation) in _EXPORTED_CACHE_METRICS.items():
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}", f"{name} {metrics[key]}"]
+    return lines
+
+
+register_collector(_render_cache_metrics)
@@ -0,0 +1,64 @@
+import logging
+import math
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# "approximate" estimates four characters per token. Any other value is loaded as a HuggingFace tokenizer, so the
+# chat model's own tokenizer can be used, e.g. "Qwen/Qwen3-8B".
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "approximate")
+_CHARACTERS_PER_TOKEN = 4
+
+# Process-wide tokenizer, loaded once on first use
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def _get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                from transformers import AutoTokenizer
+
+                _tokenizer = AutoTokenizer.from_pretrained(PROMPT_TOKENIZER)
+                logger.info("Loaded tokenizer %s", PROMPT_TOKENIZER)
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens in a piece of text with the configured tokenizer.
+
+    Args:
+        text (str): The text to count.
+
+    Returns:
+        int: The number of tokens.
+    """
+    if PROMPT_TOKENIZER == "approximate":
+        return math.ceil(len(text) / _CHARACTERS_PER_TOKEN)
+    return len(_get_tokenizer().encode(text, add_special_tokens=False))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Shortens a piece of text to at most `max_tokens` tokens, keeping its beginning.
+
+    Args:
+        text (str): The text to shorten.
+        max_tokens (int): The most tokens to keep.
+
+    Returns:
+        str: The text, cut at a token boundary if it was too long.
+    """
+    if max_tokens <= 0:
+        return ""
+    if PROMPT_TOKENIZER == "approximate":
+        return text[: max_tokens * _CHARACTERS_PER_TOKEN]
+    tokenizer = _get_tokenizer()
+    token_ids = tokenizer.encode(text, add_special_tokens=False)
+    if len(token_ids) <= max_tokens:
+        return text
+    return tokenizer.decode(token_ids[:max_tokens])
@@ -0,0 +1,185 @@
+from contextlib import contextmanager
+
+import numpy as np
+import pytest
+
+from hawat.memory import clusters
+from hawat.memory.clusters import assign_conversation_cluster
+
+
+class FakeDatabase:
+    """Keeps clusters, their members and conversation embeddings, and answers the clustering queries from them"""
+
+    def __init__(self):
+        self.embeddings = {}
+        self.clusters = {}
+        self.members = {}
+        self.clustered_through = {}
+        self.updated_centroids = []
+
+    @contextmanager
+    def connection(self):
+        yield FakeConnection(self)
+
+    def add_cluster(self, user_id: str, *conversations: tuple[int, list[float]]) -> int:
+        cluster_id = len(self.clusters) + 1
+        for conversation_id, embedding in conversations:
+            self.embeddings[conversation_id] = np.array(embedding)
+            self.members[conversation_id] = cluster_id
+        self.clusters[cluster_id] = {"user_id": user_id, "centroid": None, "size": 0}
+        self._update_centroids([cluster_id])
+        return cluster_id
+
+    def _update_centroids(self, cluster_ids: list[int]) -> None:
+        for cluster_id in cluster_ids:
+            member_embeddings = [self.embeddings[c] for c, cluster in self.members.items() if cluster == cluster_id]
+            if member_embeddings:
+                self.clusters[cluster_id]["centroid"] = np.mean(member_embeddings, axis=0)
+                self.clusters[cluster_id]["size"] = len(member_embeddings)
+
+
+class FakeConnection:
+    def __init__(self, database: FakeDatabase):
+        self.database = database
+
+    def cursor(self):
+        return FakeCursor(self.database)
+
+    def commit(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, database: FakeDatabase):
+        self.database = database
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query, params=None):
+        database = self.database
+        self.rows = []
+        if query is clusters._NEAREST_CLUSTER_QUERY:
+            user_clusters = [(i, c) for i, c in database.clusters.items() if c["user_id"] == params["user_id"]]
+            ranked = sorted((_cosine_distance(c["centroid"], params["embedding"]), i, c) for i, c in user_clusters)
+            self.rows = [(i, c["size"], distance, len(user_clusters)) for distance, i, c in ranked[:1]]
+        elif query is clusters._CREATE_CLUSTER_QUERY:
+            cluster_id = max(database.clusters, default=0) + 1
+            database.clusters[cluster_id] = {"user_id": params["user_id"], "centroid": params["embedding"], "size": 0}
+            self.rows = [(cluster_id,)]
+        elif query is clusters._ASSIGN_MEMBER_QUERY:
+            database.members[params[0]] = params[1]
+        elif query is clusters._UPDATE_CENTROIDS_QUERY:
+            database.updated_centroids.append(sorted(params[0]))
+            database._update_centroids(params[0])
+        elif query is clusters._DELETE_EMPTY_CLUSTERS_QUERY:
+            for cluster_id in params[0]:
+                if cluster_id not in database.members.values():
+                    database.clusters.pop(cluster_id, None)
+        elif query.startswith("SELECT cluster_id FROM cluster_members"):
+            cluster_id = database.members.get(params[0])
+            self.rows = [(cluster_id,)] if cluster_id is not None else []
+        elif query.startswith("UPDATE conversations SET clustered_through"):
+            database.clustered_through[params[1]] = params[0]
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+def _cosine_distance(a: np.ndarray, b: np.ndarray) -> float:
+    return 1 - float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(clusters, "get_connection_pool", lambda: database)
+    monkeypatch.setattr(clusters, "CLUSTER_DISTANCE_THRESHOLD", 0.5)
+    monkeypatch.setattr(clusters, "CLUSTER_MAX_SIZE", 200)
+    monkeypatch.setattr(clusters, "CLUSTER_MAX_PER_USER", 2000)
+    return database
+
+
+def _assign(database: FakeDatabase, conversation_id: int, embedding: list[float], user_id: str = "alice") -> bool:
+    database.embeddings[conversation_id] = np.array(embedding)
+    return assign_conversation_cluster(conversation_id, user_id, np.array(embedding), 100 + conversation_id)
+
+
+def test_conversation_joins_the_nearest_cluster(database):
+    near = database.add_cluster("alice", (1, [1.0, 0.0, 0.0]))
+    database.add_cluster("alice", (2, [0.0, 1.0, 0.0]))
+
+    assert _assign(database, 3, [0.9, 0.1, 0.0])
+
+    assert database.members[3] == near
+    assert database.clusters[near]["size"] == 2
+    assert database.clustered_through[3] == 103
+
+
+def test_conversation_past_the_threshold_starts_a_new_cluster(database):
+    database.add_cluster("alice", (1, [1.0, 0.0, 0.0]))
+
+    assert _assign(database, 2, [0.0, 0.0, 1.0])
+
+    assert database.members[2] not in (database.members[1], None)
+    assert len(database.clusters) == 2
+    np.testing.assert_allclose(database.clusters[database.members[2]]["centroid"], [0.0, 0.0, 1.0])
+
+
+def test_conversation_starts_a_new_cluster_when_the_nearest_is_full(database, monkeypatch):
+    monkeypatch.setattr(clusters, "CLUSTER_MAX_SIZE", 1)
+    full = database.add_cluster("alice", (1, [1.0, 0.0, 0.0]))
+
+    assert _assign(database, 2, [1.0, 0.0, 0.0])
+
+    assert database.members[2] != full
+
+
+def test_conversation_joins_the_nearest_cluster_once_the_user_has_the_most_clusters(database, monkeypatch):
+    monkeypatch.setattr(clusters, "CLUSTER_MAX_PER_USER", 1)
+    only = database.add_cluster("alice", (1, [1.0, 0.0, 0.0]))
+
+    assert _assign(database, 2, [0.0, 0.0, 1.0])
+
+    assert database.members[2] == only
+    assert len(database.clusters) == 1
+
+
+def test_other_users_clusters_are_not_joined(database):
+    database.add_cluster("bob", (1, [1.0, 0.0, 0.0]))
+
+    assert _assign(database, 2, [1.0, 0.0, 0.0], user_id="alice")
+
+    assert database.clusters[database.members[2]]["user_id"] == "alice"
+
+
+def test_joining_moves_the_centroid_to_the_mean_of_the_members(database):
+    cluster_id = database.add_cluster("alice", (1, [1.0, 0.0, 0.0]))
+
+    _assign(database, 2, [0.6, 0.8, 0.0])
+
+    assert database.updated_centroids[-1] == [cluster_id]
+    np.testing.assert_allclose(database.clusters[cluster_id]["centroid"], [0.8, 0.4, 0.0])
+
+
+def test_moving_updates_both_centroids_and_removes_an_emptied_cluster(database):
+    left = database.add_cluster("alice", (1, [1.0, 0.0, 0.0]))
+    joined = database.add_cluster("alice", (2, [0.0, 1.0, 0.0]), (3, [0.0, 0.9, 0.1]))
+
+    # Conversation 1 was summarized again and its summary is now about the other topic
+    assert _assign(database, 1, [0.0, 1.0, 0.0])
+
+    assert database.members[1] == joined
+    assert database.updated_centroids[-1] == sorted([left, joined])
+    assert left not in database.clusters
+    assert database.clusters[joined]["size"] == 3
+
+
+def test_assignment_fails_without_a_database(monkeypatch):
+    monkeypatch.setattr(clusters, "get_connection_pool", lambda: None)
+
+    assert not assign_conversation_cluster(1, "alice", np.array([1.0, 0.0]), 10)
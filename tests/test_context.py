@@ -0,0 +1,114 @@
+from datetime import datetime
+
+import pytest
+
+from hawat import tokens
+from hawat.memory import context
+from hawat.memory.context import ENTRY_SEPARATOR, TRUNCATED_MARKER, _fit_to_budget, _trim_history, _with_pending
+from hawat.tokens import count_tokens
+
+
+@pytest.fixture(autouse=True)
+def approximate_tokens(monkeypatch):
+    # Four characters per token, so budgets can be worked out by hand
+    monkeypatch.setattr(tokens, "PROMPT_TOKENIZER", "approximate")
+
+
+def test_fit_to_budget_keeps_entries_in_priority_order_until_the_budget_is_spent():
+    entries = ["a" * 40, "b" * 40, "c" * 40]
+    separator = count_tokens(ENTRY_SEPARATOR)
+
+    kept, used = _fit_to_budget(entries, 20 + separator)
+
+    assert kept == entries[:2]
+    assert used == 20 + separator
+
+
+def test_fit_to_budget_stops_at_the_first_entry_that_does_not_fit():
+    entries = ["a" * 40, "b" * 400, "c" * 4]
+
+    kept, used = _fit_to_budget(entries, 50)
+
+    assert kept == entries[:1]
+    assert used == 10
+
+
+def test_fit_to_budget_truncates_a_first_entry_that_is_too_long():
+    kept, used = _fit_to_budget(["a" * 400, "b" * 4], 20)
+
+    assert len(kept) == 1
+    assert kept[0].endswith(TRUNCATED_MARKER)
+    assert kept[0].startswith("a")
+    assert used == count_tokens(kept[0]) <= 20
+
+
+def test_fit_to_budget_keeps_everything_without_a_budget():
+    entries = ["a" * 400, "b" * 400]
+
+    kept, used = _fit_to_budget(entries, 0)
+
+    assert kept == entries
+    assert used == 200 + count_tokens(ENTRY_SEPARATOR)
+
+
+def test_fit_to_budget_of_no_entries():
+    assert _fit_to_budget([], 100) == ([], 0)
+
+
+def _history(*lengths: int) -> list[tuple]:
+    return [(id, "User", "x" * length, None, 0) for id, length in enumerate(lengths, start=1)]
+
+
+def test_trim_history_keeps_a_history_that_fits(monkeypatch):
+    monkeypatch.setattr(context, "HISTORY_TRIM_STEP", 2)
+    history = _history(40, 40, 40)
+
+    assert _trim_history(history, 30) == history
+
+
+def test_trim_history_drops_the_oldest_messages_in_whole_steps(monkeypatch):
+    monkeypatch.setattr(context, "HISTORY_TRIM_STEP", 2)
+    history = _history(40, 40, 40, 40, 40)
+
+    # Dropping one message would fit, but the cut moves in steps of two so the history stays a stable prefix
+    assert _trim_history(history, 40) == history[2:]
+
+
+def test_trim_history_keeps_the_newest_message(monkeypatch):
+    monkeypatch.setattr(context, "HISTORY_TRIM_STEP", 8)
+    history = _history(40, 40, 400)
+
+    assert _trim_history(history, 10) == history[-1:]
+
+
+def test_trim_history_without_a_budget(monkeypatch):
+    monkeypatch.setattr(context, "HISTORY_TRIM_STEP", 2)
+    history = _history(400, 400)
+
+    assert _trim_history(history, 0) == history
+
+
+def test_trim_history_keeps_its_cut_while_the_conversation_grows(monkeypatch):
+    monkeypatch.setattr(context, "HISTORY_TRIM_STEP", 4)
+    history = _history(*[40] * 10)
+
+    trimmed = _trim_history(history, 70)
+    grown = _trim_history(history + _history(*[40] * 11)[10:], 70)
+
+    assert trimmed == history[4:]
+    assert grown[0] == trimmed[0]
+
+
+def test_with_pending_appends_messages_not_read_from_the_database():
+    sent = datetime(2026, 1, 1, 12, 0)
+    stored = [(1, "User", "hello", sent, 0)]
+    pending = [(None, "User", "hello", sent, 0), (None, "Hawat", "hi there", sent, 0)]
+
+    assert _with_pending(stored, pending) == stored + pending[1:]
+
+
+def test_with_pending_keeps_a_repeated_message_sent_at_another_time():
+    stored = [(1, "User", "thanks", datetime(2026, 1, 1, 12, 0), 5)]
+    pending = [(None, "User", "thanks", datetime(2026, 1, 1, 12, 5), 0)]
+
+    assert _with_pending(stored, pending) == stored + pending
@@ -0,0 +1,104 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+from hawat.memory import conversations
+from hawat.memory.conversations import CONVO_THRESHOLD, get_current_conversation_id
+
+NOW = datetime(2026, 1, 1, 12, 0)
+
+
+class FakeResolver:
+    """Stands in for the database lookup, numbering new conversations and waiting for `release` if it is given"""
+
+    def __init__(self, release: threading.Event | None = None):
+        self.release = release
+        self.calls = []
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, timestamp, user_id, session_id):
+        with self.lock:
+            self.calls.append((user_id, session_id))
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+            conversation_id = len(self.calls)
+        if self.release is not None:
+            self.release.wait(5)
+        with self.lock:
+            self.in_flight -= 1
+        return conversation_id
+
+
+@pytest.fixture(autouse=True)
+def tracking(monkeypatch):
+    monkeypatch.setattr(conversations, "_current_conversations", {})
+    monkeypatch.setattr(conversations, "_session_locks", {})
+
+
+def test_tracked_conversation_is_reused_without_the_database(monkeypatch):
+    resolver = FakeResolver()
+    monkeypatch.setattr(conversations, "_resolve_current_conversation", resolver)
+
+    first = get_current_conversation_id(NOW, "alice", "a")
+    second = get_current_conversation_id(NOW + timedelta(minutes=5), "alice", "a")
+
+    assert first == second == 1
+    assert resolver.calls == [("alice", "a")]
+
+
+def test_stale_conversation_is_resolved_again(monkeypatch):
+    resolver = FakeResolver()
+    monkeypatch.setattr(conversations, "_resolve_current_conversation", resolver)
+
+    get_current_conversation_id(NOW, "alice", "a")
+
+    assert get_current_conversation_id(NOW + CONVO_THRESHOLD, "alice", "a") == 2
+
+
+def test_sessions_are_tracked_separately(monkeypatch):
+    monkeypatch.setattr(conversations, "_resolve_current_conversation", FakeResolver())
+
+    assert get_current_conversation_id(NOW, "alice", "a") == 1
+    assert get_current_conversation_id(NOW, "alice", "b") == 2
+    assert get_current_conversation_id(NOW, "bob", "a") == 3
+
+
+def test_other_sessions_are_resolved_while_one_waits_on_the_database(monkeypatch):
+    release = threading.Event()
+    resolver = FakeResolver(release)
+    monkeypatch.setattr(conversations, "_resolve_current_conversation", resolver)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(get_current_conversation_id, NOW, "alice", session) for session in ("a", "b")]
+        deadline = time.monotonic() + 5
+        while resolver.most_in_flight < 2 and time.monotonic() < deadline:
+            time.sleep(0.005)
+        release.set()
+        assert sorted(future.result() for future in futures) == [1, 2]
+
+    assert resolver.most_in_flight == 2
+
+
+def test_concurrent_lookups_for_a_session_resolve_it_once(monkeypatch):
+    release = threading.Event()
+    resolver = FakeResolver(release)
+    monkeypatch.setattr(conversations, "_resolve_current_conversation", resolver)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(get_current_conversation_id, NOW, "alice", "a") for _ in range(4)]
+        release.set()
+        assert [future.result() for future in futures] == [1] * 4
+
+    assert resolver.calls == [("alice", "a")]
+
+
+def test_failed_resolution_is_not_tracked(monkeypatch):
+    monkeypatch.setattr(conversations, "_resolve_current_conversation", lambda timestamp, user_id, session_id: None)
+
+    assert get_current_conversation_id(NOW, "alice", "a") is None
+    assert conversations._current_conversations == {}
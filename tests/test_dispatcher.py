@@ -0,0 +1,132 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+from hawat import dispatcher, language, memory
+from hawat.memory import context
+from hawat.response_cache import MemoryResponseCache, get_response_cache, set_response_cache
+
+EARLIER = datetime(2026, 1, 1, 12, 0)
+
+
+class FakeDatabase:
+    """Answers the context queries of each session from `conversations` and `windows`"""
+
+    def __init__(self):
+        self.conversations = {}
+        self.windows = {}
+        self.similar_messages = [(1, "User", "My cat is called Gurney.", EARLIER)]
+        self.related_conversations = [(7, "The user adopted a cat.", EARLIER)]
+
+    @contextmanager
+    def connection(self):
+        yield FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, database: FakeDatabase):
+        self.database = database
+
+    @contextmanager
+    def pipeline(self):
+        yield
+
+    def cursor(self):
+        return FakeCursor(self.database)
+
+    def execute(self, query, params=None, prepare=None):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, database: FakeDatabase):
+        self.database = database
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query, params=None, prepare=None):
+        session = params.get("session_id")
+        if query is context._CURRENT_CONVERSATION_ID_QUERY:
+            conversation_id = self.database.conversations.get(session)
+            self.rows = [(conversation_id,)] if conversation_id is not None else []
+        elif query is context._RELEVANT_MESSAGES_QUERY:
+            self.rows = self.database.similar_messages
+        elif query is context._RELATED_CONVERSATIONS_QUERY:
+            self.rows = self.database.related_conversations
+        else:
+            self.rows = self.database.windows.get(session, [])
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(context, "get_connection_pool", lambda: database)
+    monkeypatch.setattr(context, "get_vector_extension_version", lambda: (0, 8, 0))
+    monkeypatch.setattr(context, "get_embedding", lambda text: [1.0, 0.0])
+    monkeypatch.setattr(dispatcher, "get_embedding", lambda text: [1.0, 0.0])
+    monkeypatch.setattr(memory, "enqueue_messages", lambda messages, user_id, session_id: None)
+    monkeypatch.setattr(language, "PROMPT_LAYOUT", "template")
+    previous = get_response_cache()
+    set_response_cache(MemoryResponseCache())
+    yield database
+    set_response_cache(previous)
+
+
+@pytest.fixture
+def model(monkeypatch):
+    prompts = []
+
+    def get_conversation_response(message, context, history=None):
+        prompts.append(context)
+        return f"reply {len(prompts)}"
+
+    monkeypatch.setattr(language, "get_conversation_response", get_conversation_response)
+    return prompts
+
+
+def test_a_question_repeated_later_in_the_conversation_is_answered_from_the_cache(database, model):
+    database.conversations["a"] = 5
+    database.windows["a"] = [(10, "User", "Hi!", EARLIER)]
+    question = "What should I name my new kitten?"
+
+    first = dispatcher.process_message(question, "alice", "a")
+    database.windows["a"] += [(11, "User", question, EARLIER), (12, "Hawat", first, EARLIER)]
+    second = dispatcher.process_message(question, "alice", "a")
+
+    assert first == second == "reply 1"
+    assert len(model) == 1
+    assert get_response_cache().metrics()["hits"] == 1
+
+
+def test_a_question_is_not_answered_from_another_conversations_cache(database, model):
+    database.conversations.update(a=5, b=6)
+    question = "Suggest a good name for it."
+
+    assert dispatcher.process_message(question, "alice", "a") == "reply 1"
+    assert dispatcher.process_message(question, "alice", "b") == "reply 2"
+    assert get_response_cache().metrics()["hits"] == 0
+
+
+def test_replies_are_not_cached_before_the_sessions_conversation_is_stored(database, model, monkeypatch):
+    monkeypatch.setattr(
+        context, "get_pending_messages", lambda user_id, session_id: [(None, "User", "Hi!", EARLIER, 0)]
+    )
+    question = "Suggest a good name for it."
+
+    dispatcher.process_message(question, "alice", "a")
+    dispatcher.process_message(question, "alice", "a")
+
+    assert len(model) == 2
+    assert get_response_cache().metrics()["stores"] == 0
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from hawat import embeddings
+from hawat.embeddings import Embedder, check_onnx_agreement, load_embedding_model
+
+
+class FakeModel:
+    """Embeds each text as a fixed random vector, plus `noise` times another random vector"""
+
+    def __init__(self, noise: float = 0.0):
+        self.noise = noise
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        rng = np.random.default_rng(0)
+        embeddings = []
+        for _ in texts:
+            embedding, error = rng.standard_normal(384), rng.standard_normal(384)
+            embeddings.append((embedding + self.noise * error).tolist())
+        return embeddings
+
+
+@pytest.fixture(autouse=True)
+def threshold(monkeypatch):
+    monkeypatch.setattr(embeddings, "EMBEDDING_ONNX_MIN_SIMILARITY", 0.99)
+
+
+def test_onnx_model_that_agrees_with_torch_is_accepted():
+    assert check_onnx_agreement(FakeModel(noise=0.05), FakeModel()) >= 0.99
+
+
+def test_onnx_model_that_drifts_from_torch_is_refused():
+    with pytest.raises(RuntimeError, match="EMBEDDING_ONNX_MIN_SIMILARITY"):
+        check_onnx_agreement(FakeModel(noise=0.5), FakeModel())
+
+
+def test_loading_the_onnx_backend_checks_it_against_torch(monkeypatch):
+    loaded = []
+
+    def hugging_face_embeddings(model_name, model_kwargs, encode_kwargs):
+        backend = model_kwargs.get("backend", "torch")
+        loaded.append(backend)
+        return FakeModel(noise=0.5 if backend == "onnx" else 0.0)
+
+    monkeypatch.setattr(embeddings, "HuggingFaceEmbeddings", hugging_face_embeddings)
+
+    with pytest.raises(RuntimeError):
+        load_embedding_model("sentence-transformers/all-MiniLM-L6-v2", "cpu", "onnx")
+    assert loaded == ["onnx", "torch"]
+
+    loaded.clear()
+    load_embedding_model("sentence-transformers/all-MiniLM-L6-v2", "cpu", "torch")
+    assert loaded == ["torch"]
+
+
+def test_embedders_must_implement_embed():
+    class Incomplete(Embedder):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,63 @@
+import asyncio
+import threading
+
+import pytest
+
+from hawat.grpc_server import _iterate_in_thread
+
+
+async def _collect(generator) -> list[str]:
+    return [item async for item in _iterate_in_thread(generator)]
+
+
+def test_items_are_handed_over_in_order_from_one_chat_thread():
+    threads = set()
+
+    def generate():
+        for piece in ("Hel", "lo", "!"):
+            threads.add(threading.current_thread().name)
+            yield piece
+
+    assert asyncio.run(_collect(generate())) == ["Hel", "lo", "!"]
+    assert len(threads) == 1
+    assert threads.pop().startswith("hawat-chat")
+
+
+def test_errors_are_raised_after_the_items_before_them():
+    received = []
+
+    def generate():
+        yield "partial"
+        raise ValueError("stream broke")
+
+    async def consume():
+        async for item in _iterate_in_thread(generate()):
+            received.append(item)
+
+    with pytest.raises(ValueError, match="stream broke"):
+        asyncio.run(consume())
+    assert received == ["partial"]
+
+
+def test_generator_is_closed_when_the_consumer_stops_early():
+    closed = threading.Event()
+    next_piece = threading.Event()
+
+    def generate():
+        try:
+            yield "first"
+            next_piece.wait(5)
+            yield "second"
+            yield "third"
+        finally:
+            closed.set()
+
+    async def consume_one():
+        stream = _iterate_in_thread(generate())
+        assert await anext(stream) == "first"
+        await stream.aclose()
+        next_piece.set()
+
+    asyncio.run(consume_one())
+
+    assert closed.wait(5)
@@ -0,0 +1,105 @@
+import json
+
+import pytest
+
+from hawat import language
+from hawat.language import get_conversation_keys_names_subjects, get_conversations_keys_names_subjects
+
+CONVERSATIONS = {1: "User: I adopted a cat.", 2: "User: Planning a trip to Lisbon."}
+CAT_TERMS = {"subjects": ["pets"], "entities": ["Gurney"], "keywords": ["cat", "adoption"]}
+TRIP_TERMS = {"subjects": ["travel"], "entities": ["Lisbon"], "keywords": ["trip"]}
+
+
+@pytest.fixture
+def model(monkeypatch):
+    """Replies to every request with `model.content`, and records the requests in `model.requests`"""
+
+    class FakeModel:
+        content = ""
+        requests = []
+
+    def send_to_model(system_prompt, user_prompt, **kwargs):
+        FakeModel.requests.append((user_prompt, kwargs))
+        return FakeModel.content
+
+    monkeypatch.setattr(language, "send_to_model", send_to_model)
+    return FakeModel
+
+
+def _reply(*entries: dict) -> str:
+    return json.dumps({"conversations": list(entries)})
+
+
+def test_terms_are_returned_for_each_conversation(model):
+    model.content = _reply({"id": 1, **CAT_TERMS}, {"id": 2, **TRIP_TERMS})
+
+    assert get_conversations_keys_names_subjects(CONVERSATIONS) == {1: CAT_TERMS, 2: TRIP_TERMS}
+    assert len(model.requests) == 1
+    assert "User: I adopted a cat." in model.requests[0][0]
+    assert "User: Planning a trip to Lisbon." in model.requests[0][0]
+
+
+@pytest.mark.parametrize("content", ["", "not json", '{"conversations": [', "```json\n{}\n```"])
+def test_malformed_json_returns_no_terms(model, content):
+    model.content = content
+
+    assert get_conversations_keys_names_subjects(CONVERSATIONS) == {}
+
+
+@pytest.mark.parametrize("content", ["[]", "{}", '{"conversations": {"id": 1}}', '"conversations"'])
+def test_a_response_without_a_conversations_list_returns_no_terms(model, content):
+    model.content = content
+
+    assert get_conversations_keys_names_subjects(CONVERSATIONS) == {}
+
+
+def test_conversations_missing_from_the_response_are_left_out(model):
+    model.content = _reply({"id": 2, **TRIP_TERMS})
+
+    assert get_conversations_keys_names_subjects(CONVERSATIONS) == {2: TRIP_TERMS}
+
+
+def test_conversations_that_were_not_asked_about_are_ignored(model):
+    model.content = _reply({"id": 1, **CAT_TERMS}, {"id": 3, **TRIP_TERMS}, {"id": "2", **TRIP_TERMS})
+
+    assert get_conversations_keys_names_subjects(CONVERSATIONS) == {1: CAT_TERMS}
+
+
+@pytest.mark.parametrize(
+    "entry",
+    [
+        {"id": 1, **CAT_TERMS, "entities": ["Gurney", 7]},
+        {"id": 1, **CAT_TERMS, "keywords": "cat"},
+        {"id": 1, **CAT_TERMS, "subjects": [["pets"]]},
+        {"id": 1, **CAT_TERMS, "entities": None},
+        {"id": 1, "subjects": ["pets"], "entities": ["Gurney"]},
+        ["pets", "Gurney", "cat"],
+    ],
+)
+def test_malformed_entries_are_left_out(model, entry):
+    model.content = _reply(entry, {"id": 2, **TRIP_TERMS})
+
+    assert get_conversations_keys_names_subjects(CONVERSATIONS) == {2: TRIP_TERMS}
+
+
+def test_json_schema_mode_asks_for_structured_output(model, monkeypatch):
+    monkeypatch.setattr(language, "NER_RESPONSE_FORMAT", "json_schema")
+    model.content = _reply({"id": 1, **CAT_TERMS})
+
+    get_conversations_keys_names_subjects({1: CONVERSATIONS[1]})
+
+    response_format = model.requests[-1][1]["response_format"]
+    assert response_format["type"] == "json_schema"
+    assert response_format["json_schema"]["schema"] is language.NER_RESPONSE_SCHEMA
+
+
+def test_single_conversation_terms(model):
+    model.content = _reply({"id": 0, **CAT_TERMS})
+
+    assert get_conversation_keys_names_subjects(CONVERSATIONS[1]) == CAT_TERMS
+
+
+def test_single_conversation_without_terms(model):
+    model.content = "not json"
+
+    assert get_conversation_keys_names_subjects(CONVERSATIONS[1]) is None
@@ -0,0 +1,149 @@
+import httpx
+import pytest
+from openai import APIConnectionError, BadRequestError
+
+from hawat import llm
+from hawat.llm import BackendUnavailable, LLMBackend, complete_chat, set_backends, stream_chat
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+class FakeBackend(LLMBackend):
+    """Replies with its name, after failing with each of `errors` in turn"""
+
+    def __init__(self, name: str, errors: list[Exception] | None = None):
+        super().__init__(name, "fake-model")
+        self.errors = list(errors or [])
+        self.calls = 0
+
+    def _complete(self, messages, timeout, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return f"reply from {self.name}"
+
+    def _stream(self, messages, timeout, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        yield f"reply from {self.name}"
+        yield "!"
+
+
+def _connection_error() -> APIConnectionError:
+    return APIConnectionError(request=httpx.Request("POST", "http://localhost/v1/chat/completions"))
+
+
+def _bad_request() -> BadRequestError:
+    request = httpx.Request("POST", "http://localhost/v1/chat/completions")
+    return BadRequestError("bad request", response=httpx.Response(400, request=request), body=None)
+
+
+@pytest.fixture(autouse=True)
+def backends(monkeypatch):
+    monkeypatch.setattr(llm, "LLM_MAX_RETRIES", 1)
+    monkeypatch.setattr(llm, "LLM_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr(llm, "LLM_COOLDOWN_SECONDS", 30)
+    monkeypatch.setattr(llm, "_backoff", lambda attempt: None)
+    previous = llm.get_backends()
+    yield
+    set_backends(previous)
+
+
+def test_complete_chat_uses_the_first_backend():
+    primary, fallback = FakeBackend("primary"), FakeBackend("fallback")
+    set_backends([primary, fallback])
+
+    assert complete_chat(MESSAGES) == "reply from primary"
+    assert fallback.calls == 0
+
+
+def test_complete_chat_fails_over_to_the_next_backend():
+    primary, fallback = FakeBackend("primary", [_connection_error()]), FakeBackend("fallback")
+    set_backends([primary, fallback])
+
+    assert complete_chat(MESSAGES) == "reply from fallback"
+    assert primary.metrics()["errors"] == 1
+
+
+def test_complete_chat_retries_the_backend_list():
+    primary = FakeBackend("primary", [_connection_error()])
+    fallback = FakeBackend("fallback", [_connection_error()])
+    set_backends([primary, fallback])
+
+    assert complete_chat(MESSAGES) == "reply from primary"
+    assert primary.calls == 2
+
+
+def test_complete_chat_raises_the_last_error_once_retries_run_out():
+    set_backends([FakeBackend("primary", [_connection_error()] * 2)])
+
+    with pytest.raises(APIConnectionError):
+        complete_chat(MESSAGES)
+
+
+def test_complete_chat_does_not_fail_over_a_request_error():
+    primary, fallback = FakeBackend("primary", [_bad_request()]), FakeBackend("fallback")
+    set_backends([primary, fallback])
+
+    with pytest.raises(BadRequestError):
+        complete_chat(MESSAGES)
+    assert fallback.calls == 0
+
+
+def test_backend_cools_down_after_repeated_failures():
+    primary, fallback = FakeBackend("primary", [_connection_error()] * 2), FakeBackend("fallback")
+    set_backends([primary, fallback])
+
+    complete_chat(MESSAGES)
+    complete_chat(MESSAGES)
+    assert complete_chat(MESSAGES) == "reply from fallback"
+
+    assert primary.calls == 2
+    assert primary.metrics()["available"] is False
+    with pytest.raises(BackendUnavailable):
+        primary.complete(MESSAGES, 1)
+
+
+def test_stream_chat_fails_over_before_the_first_piece():
+    primary, fallback = FakeBackend("primary", [_connection_error()]), FakeBackend("fallback")
+    set_backends([primary, fallback])
+
+    assert list(stream_chat(MESSAGES)) == ["reply from fallback", "!"]
+
+
+def test_stream_chat_does_not_start_over_once_replying():
+    class BrokenStream(FakeBackend):
+        def _stream(self, messages, timeout, **kwargs):
+            self.calls += 1
+            yield "partial"
+            raise _connection_error()
+
+    primary, fallback = BrokenStream("primary"), FakeBackend("fallback")
+    set_backends([primary, fallback])
+    pieces = []
+
+    with pytest.raises(APIConnectionError):
+        for piece in stream_chat(MESSAGES):
+            pieces.append(piece)
+    assert pieces == ["partial"]
+    assert fallback.calls == 0
+
+
+@pytest.mark.parametrize("configured", ["[]", "{}", '{"name": "primary"}'])
+def test_backends_must_be_a_list_of_at_least_one(monkeypatch, configured):
+    monkeypatch.setattr(llm, "LLM_BACKENDS", configured)
+
+    with pytest.raises(ValueError, match="at least one backend"):
+        llm._load_backends()
+
+
+def test_backends_default_to_the_openai_settings(monkeypatch):
+    monkeypatch.setattr(llm, "LLM_BACKENDS", None)
+
+    assert [backend.name for backend in llm._load_backends()] == ["backend-0"]
+
+
+def test_set_backends_rejects_an_empty_list():
+    with pytest.raises(ValueError):
+        set_backends([])
@@ -0,0 +1,43 @@
+from hawat.metrics import Histogram
+
+
+def test_histogram_counts_each_value_in_every_bucket_it_fits():
+    histogram = Histogram("test_seconds", "Test durations.", buckets=(0.1, 1.0))
+
+    histogram.observe("llm", 0.05)
+    histogram.observe("llm", 0.5)
+    histogram.observe("llm", 5.0)
+
+    lines = histogram.render()
+    assert 'test_seconds_bucket{stage="llm",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="llm",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="llm",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{stage="llm"} 5.55' in lines
+    assert 'test_seconds_count{stage="llm"} 3' in lines
+
+
+def test_histogram_counts_a_value_on_a_bound_in_that_bucket():
+    histogram = Histogram("test_seconds", "Test durations.", buckets=(1.0,))
+
+    histogram.observe("turn", 1.0)
+
+    assert 'test_seconds_bucket{stage="turn",le="1"} 1' in histogram.render()
+
+
+def test_histogram_renders_its_help_and_type_and_series_in_order():
+    histogram = Histogram("test_tokens", "Test tokens.", buckets=(100,), label="section")
+    histogram.observe("total", 50)
+    histogram.observe("similar_messages", 200)
+
+    lines = histogram.render()
+
+    assert lines[:2] == ["# HELP test_tokens Test tokens.", "# TYPE test_tokens histogram"]
+    assert lines[2] == 'test_tokens_bucket{section="similar_messages",le="100"} 0'
+    assert lines[-1] == 'test_tokens_count{section="total"} 1'
+
+
+def test_empty_histogram_renders_only_its_help_and_type():
+    assert Histogram("test_seconds", "Test durations.").render() == [
+        "# HELP test_seconds Test durations.",
+        "# TYPE test_seconds histogram",
+    ]
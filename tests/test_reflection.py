@@ -0,0 +1,62 @@
+import pytest
+
+from hawat import reflection
+from hawat.reflection import TokenBucket
+
+
+class FakeClock:
+    """Stands in for time.monotonic and time.sleep, so waiting advances the clock instantly"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(reflection.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(reflection.time, "sleep", clock.sleep)
+    return clock
+
+
+def test_token_bucket_allows_a_burst_without_waiting(clock):
+    bucket = TokenBucket(rate_per_minute=60, burst=3)
+
+    for _ in range(3):
+        bucket.acquire()
+
+    assert clock.sleeps == []
+
+
+def test_token_bucket_waits_for_a_token_once_the_burst_is_spent(clock):
+    bucket = TokenBucket(rate_per_minute=30, burst=1)
+
+    bucket.acquire()
+    bucket.acquire()
+
+    assert clock.sleeps == [pytest.approx(2.0)]
+
+
+def test_token_bucket_refills_over_time_up_to_its_capacity(clock):
+    bucket = TokenBucket(rate_per_minute=60, burst=2)
+    bucket.acquire()
+    bucket.acquire()
+
+    clock.now += 60
+    for _ in range(2):
+        bucket.acquire()
+    bucket.acquire()
+
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+def test_token_bucket_capacity_is_at_least_one():
+    assert TokenBucket(rate_per_minute=60, burst=0).capacity == 1
@@ -0,0 +1,89 @@
+import pytest
+
+from hawat import response_cache
+from hawat.response_cache import MemoryResponseCache, context_fingerprint
+
+RETRIEVED = {"messages": [3, 1], "conversations": [7], "current_conversation": [10]}
+
+
+def test_fingerprint_ignores_the_order_records_were_retrieved_in():
+    reordered = {"conversations": [7], "messages": [1, 3], "current_conversation": [10]}
+
+    assert context_fingerprint(RETRIEVED, "alice") == context_fingerprint(reordered, "alice")
+
+
+def test_fingerprint_differs_between_users():
+    assert context_fingerprint(RETRIEVED, "alice") != context_fingerprint(RETRIEVED, "bob")
+
+
+def test_fingerprint_differs_with_the_current_conversation():
+    # The same follow-up with the same memories but in another conversation must not reuse the reply
+    other_conversation = dict(RETRIEVED, current_conversation=[20])
+
+    assert context_fingerprint(RETRIEVED, "alice") != context_fingerprint(other_conversation, "alice")
+
+
+def test_fingerprint_differs_with_the_retrieved_memories():
+    assert context_fingerprint(RETRIEVED, "alice") != context_fingerprint(dict(RETRIEVED, messages=[1]), "alice")
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(response_cache, "RESPONSE_CACHE_SIMILARITY", 0.95)
+    monkeypatch.setattr(response_cache, "RESPONSE_CACHE_TTL_SECONDS", 3600)
+    monkeypatch.setattr(response_cache, "RESPONSE_CACHE_SIZE", 2)
+    return MemoryResponseCache()
+
+
+def test_memory_cache_hits_a_similar_message_with_the_same_fingerprint(cache):
+    cache.store([1.0, 0.0], "context", "Hello!")
+
+    assert cache.lookup([0.99, 0.05], "context") == "Hello!"
+    assert cache.metrics()["hits"] == 1
+
+
+def test_memory_cache_misses_with_another_fingerprint(cache):
+    cache.store([1.0, 0.0], "context", "Hello!")
+
+    assert cache.lookup([1.0, 0.0], "other context") is None
+
+
+def test_memory_cache_misses_a_dissimilar_message(cache):
+    cache.store([1.0, 0.0], "context", "Hello!")
+
+    assert cache.lookup([0.0, 1.0], "context") is None
+    assert cache.metrics()["misses"] == 1
+
+
+def test_memory_cache_returns_the_closest_reply(cache):
+    cache.store([1.0, 0.0], "context", "far")
+    cache.store([0.99, 0.1], "context", "close")
+
+    assert cache.lookup([0.98, 0.12], "context") == "close"
+
+
+def test_memory_cache_evicts_the_least_recently_used_entry(cache):
+    cache.store([1.0, 0.0], "first", "one")
+    cache.store([1.0, 0.0], "second", "two")
+    cache.lookup([1.0, 0.0], "first")
+    cache.store([1.0, 0.0], "third", "three")
+
+    assert cache.lookup([1.0, 0.0], "second") is None
+    assert cache.lookup([1.0, 0.0], "first") == "one"
+    assert cache.lookup([1.0, 0.0], "third") == "three"
+
+
+def test_memory_cache_expires_entries(cache, monkeypatch):
+    cache.store([1.0, 0.0], "context", "Hello!")
+    monkeypatch.setattr(response_cache, "RESPONSE_CACHE_TTL_SECONDS", 0)
+
+    assert cache.lookup([1.0, 0.0], "context") is None
+
+
+def test_memory_cache_hit_rate(cache):
+    assert cache.metrics()["hit_rate"] is None
+    cache.store([1.0, 0.0], "context", "Hello!")
+    cache.lookup([1.0, 0.0], "context")
+    cache.lookup([1.0, 0.0], "other context")
+
+    assert cache.metrics()["hit_rate"] == 0.5
@@ -0,0 +1,40 @@
+from hawat.memory.terms import MAX_TERM_WORDS, normalize_term, query_terms
+
+
+def test_query_terms_lists_every_run_of_words_up_to_the_longest_term():
+    assert query_terms("New York City pizza") == [
+        "city",
+        "city pizza",
+        "new",
+        "new york",
+        "new york city",
+        "pizza",
+        "york",
+        "york city",
+        "york city pizza",
+    ]
+    assert MAX_TERM_WORDS == 3
+
+
+def test_query_terms_are_normalized_like_stored_terms():
+    terms = query_terms("Tell me about  PostgreSQL, please!")
+
+    assert "postgresql" in terms
+    assert "about postgresql" in terms
+    assert all(term == normalize_term(term) for term in terms)
+
+
+def test_query_terms_keep_apostrophes_and_hyphens_inside_words():
+    terms = query_terms("Hawat's follow-up")
+
+    assert "hawat's" in terms
+    assert "follow-up" in terms
+    assert "hawat's follow-up" in terms
+
+
+def test_query_terms_are_unique():
+    assert query_terms("yes yes yes") == ["yes", "yes yes", "yes yes yes"]
+
+
+def test_query_terms_of_text_without_words():
+    assert query_terms("?! ...") == []
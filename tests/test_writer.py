@@ -0,0 +1,157 @@
+import threading
+import time
+
+import psycopg
+import pytest
+
+from hawat.memory import writer
+from hawat.memory.writer import enqueue_messages, flush, get_pending_messages
+
+
+class FakeDatabase:
+    """Stands in for insert_messages, failing the writes that `fail` returns an exception for"""
+
+    def __init__(self, fail=lambda messages, session: None):
+        self.fail = fail
+        self.calls = []
+        self.stored = {}
+        self.lock = threading.Lock()
+
+    def insert_messages(self, messages, user_id, session_id):
+        with self.lock:
+            self.calls.append((session_id, [content for _, content, _ in messages]))
+            error = self.fail(messages, session_id)
+            if error is not None:
+                raise error
+            self.stored.setdefault(session_id, []).extend(content for _, content, _ in messages)
+            return list(range(len(messages)))
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(writer, "insert_messages", database.insert_messages)
+    monkeypatch.setattr(writer, "WRITE_RETRY_BASE_SECONDS", 0.01)
+    monkeypatch.setattr(writer, "WRITE_MAX_RETRIES", 3)
+    yield database
+    writer.stop()
+
+
+def _turn(*contents: str) -> list[tuple]:
+    return [("User", content, None) for content in contents]
+
+
+def _blocking(insert_messages, session: str, release: threading.Event):
+    """Makes writes for a session wait until `release` is set"""
+
+    def wrapper(messages, user_id, session_id):
+        try:
+            return insert_messages(messages, user_id, session_id)
+        finally:
+            if session_id == session:
+                release.wait(5)
+
+    return wrapper
+
+
+def _wait_for(condition, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_queued_messages_are_written_in_order(database):
+    enqueue_messages(_turn("one", "two"), "alice", "a")
+    enqueue_messages(_turn("three"), "alice", "a")
+    flush()
+
+    assert database.stored == {"a": ["one", "two", "three"]}
+    assert get_pending_messages("alice", "a") == []
+
+
+def test_failed_write_is_retried_and_stays_pending_until_written(database):
+    failures = [psycopg.OperationalError("connection lost")] * 2
+    database.fail = lambda messages, session: failures.pop() if failures else None
+
+    enqueue_messages(_turn("one"), "alice", "a")
+    _wait_for(lambda: len(database.calls) >= 1)
+    assert [m[2] for m in get_pending_messages("alice", "a")] == ["one"]
+    flush()
+
+    assert database.stored == {"a": ["one"]}
+    assert len(database.calls) == 3
+    assert get_pending_messages("alice", "a") == []
+
+
+def test_newer_messages_wait_behind_their_sessions_failed_ones(database, monkeypatch):
+    monkeypatch.setattr(writer, "WRITE_RETRY_BASE_SECONDS", 0.2)
+    failures = [psycopg.OperationalError("connection lost")]
+    database.fail = lambda messages, session: failures.pop() if failures else None
+
+    enqueue_messages(_turn("one"), "alice", "a")
+    _wait_for(lambda: len(database.calls) == 1)
+    enqueue_messages(_turn("two"), "alice", "a")
+    flush()
+
+    assert database.stored == {"a": ["one", "two"]}
+    assert database.calls[-1] == ("a", ["one", "two"])
+
+
+def test_other_sessions_are_written_while_one_backs_off(database, monkeypatch):
+    monkeypatch.setattr(writer, "WRITE_RETRY_BASE_SECONDS", 60)
+    database.fail = lambda messages, session: psycopg.OperationalError("timeout") if session == "a" else None
+
+    enqueue_messages(_turn("stuck"), "alice", "a")
+    _wait_for(lambda: len(database.calls) == 1)
+    enqueue_messages(_turn("hello"), "bob", "b")
+
+    _wait_for(lambda: database.stored.get("b") == ["hello"], timeout=2)
+    assert [m[2] for m in get_pending_messages("alice", "a")] == ["stuck"]
+    assert len(database.calls) == 2
+
+
+def test_messages_the_database_rejects_are_dropped_without_retrying(database, monkeypatch):
+    def fail(messages, session):
+        if any("\x00" in content for _, content, _ in messages):
+            return psycopg.DataError("PostgreSQL text fields cannot contain NUL (0x00) bytes")
+        return None
+
+    database.fail = fail
+    busy = threading.Event()
+    monkeypatch.setattr(writer, "insert_messages", _blocking(database.insert_messages, "gate", busy))
+    enqueue_messages(_turn("hold the writer"), "carol", "gate")
+    _wait_for(lambda: len(database.calls) == 1)
+    # Queued while the writer is busy, so they are written together
+    enqueue_messages(_turn("before"), "alice", "a")
+    enqueue_messages(_turn("bad\x00"), "alice", "a")
+    enqueue_messages(_turn("after"), "alice", "a")
+    busy.set()
+    flush()
+
+    assert database.stored["a"] == ["before", "after"]
+    assert sum(call == ("a", ["bad\x00"]) for call in database.calls) == 1
+    assert get_pending_messages("alice", "a") == []
+
+
+def test_messages_are_dropped_after_the_last_retry(database):
+    database.fail = lambda messages, session: psycopg.OperationalError("connection refused")
+
+    enqueue_messages(_turn("lost"), "alice", "a")
+    flush()
+
+    assert len(database.calls) == writer.WRITE_MAX_RETRIES + 1
+    assert database.stored == {}
+    assert get_pending_messages("alice", "a") == []
+
+
+def test_pending_messages_are_only_returned_to_their_session(database, monkeypatch):
+    monkeypatch.setattr(writer, "WRITE_RETRY_BASE_SECONDS", 60)
+    database.fail = lambda messages, session: psycopg.OperationalError("timeout")
+
+    enqueue_messages(_turn("for alice"), "alice", "a")
+    _wait_for(lambda: len(database.calls) == 1)
+
+    assert [(m[0], m[1], m[2]) for m in get_pending_messages("alice", "a")] == [(None, "User", "for alice")]
+    assert get_pending_messages("alice", "other") == []
+    assert get_pending_messages("bob", "a") == []